@@ -1,15 +1,23 @@
 '''This file is used to move old data from the database into a long-term storage system'''
 
-import os
 from os import environ as ENV
-from datetime import datetime
+from datetime import datetime, timedelta
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import gzip
+import io
 import json
 import logging
+import resource
 
 from dotenv import load_dotenv
 from pymssql import connect, Connection, exceptions
+import pyarrow as pa
+import pyarrow.parquet as pq
 from boto3 import client
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
 import pytz
 
 TABLES_IN_DATABASE = [
@@ -23,6 +31,38 @@ TABLES_IN_DATABASE = [
 ]
 METADATA_FOLDER = "metadata/"
 READING_FOLDER = "readings/"
+WATERMARK_KEY = METADATA_FOLDER + "reading_watermark.json"
+READING_CHUNK_SIZE = 100000
+FETCH_SIZE = 5000
+ARCHIVE_FORMATS = ("csv", "parquet")
+READING_SCHEMA = pa.schema([
+    ("reading_id", pa.int64()),
+    ("soil_moisture", pa.float64()),
+    ("temperature", pa.float64()),
+    ("timestamp", pa.timestamp("s")),
+    ("plant_id", pa.int16()),
+    ("botanist_id", pa.int16()),
+    ("last_watered", pa.timestamp("s")),
+])
+READING_CHUNK_QUERY = '''
+SELECT TOP (%s) * FROM delta.reading
+WHERE reading_id > %s AND reading_id <= %s
+ORDER BY reading_id
+'''
+ROLLUP_FOLDER = "rollups/"
+ROLLUP_RESOLUTIONS_IN_SECONDS = {"5min": 300, "hour": 3600, "day": 86400}
+ROLLUP_MEASUREMENTS = ("temperature", "soil_moisture")
+ROLLUP_SCHEMA = pa.schema(
+    [("plant_id", pa.int16()), ("timestamp", pa.timestamp("s")),
+     ("reading_count", pa.int32())]
+    + [(f"{measurement}_{statistic}", pa.float64())
+       for measurement in ROLLUP_MEASUREMENTS
+       for statistic in ("min", "max", "sum", "mean")])
+EPOCH = datetime(1970, 1, 1)
+DELETE_BATCH_SIZE = 5000
+MEGABYTE = 1024 * 1024
+UPLOAD_PART_SIZE_IN_MB = 8
+UPLOAD_CONCURRENCY = 4
 
 
 def get_connection() -> Connection:
@@ -52,64 +92,292 @@ def load_s3_client() -> client:
                   )
 
 
-def get_data_from_rds(conn: Connection, table_name: str) -> list[dict]:
-    '''Queries all reading data from the rds database'''
+def get_max_reading_id(conn: Connection) -> int:
+    '''Returns the highest reading id currently in the database'''
+    with conn.cursor() as cur:
+        cur.execute("SELECT MAX(reading_id) AS max_reading_id FROM delta.reading")
+        result = cur.fetchone()
+
+    return (result or {}).get("max_reading_id") or 0
+
+
+def get_peak_rss_in_mb() -> float:
+    '''Returns the peak resident memory of this process in megabytes'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def log_export_stats(name: str, rows: int, elapsed: float) -> None:
+    '''Logs the export throughput and the peak memory used so far'''
+    logging.info("Exported %s rows of %s at %.0f rows/sec, peak RSS %.1f MB",
+                 rows, name, rows / elapsed if elapsed else 0, get_peak_rss_in_mb())
+
+
+def get_bucket_start(timestamp: datetime, resolution_in_seconds: int) -> datetime:
+    '''Returns the start of the rollup bucket a timestamp falls in'''
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution_in_seconds)
+
+
+def update_rollups(rollups: dict, readings: list[dict]) -> None:
+    '''Adds readings to the running min, max, sum and count of each plant's
+    measurements for every rollup resolution'''
+    for reading in readings:
+        for resolution, seconds in ROLLUP_RESOLUTIONS_IN_SECONDS.items():
+            key = (resolution, reading["plant_id"],
+                   get_bucket_start(reading["timestamp"], seconds))
+            rollup = rollups.get(key)
+
+            if rollup is None:
+                rollups[key] = {"reading_count": 1,
+                                **{f"{measurement}_{statistic}": reading[measurement]
+                                   for measurement in ROLLUP_MEASUREMENTS
+                                   for statistic in ("min", "max", "sum")}}
+                continue
+
+            rollup["reading_count"] += 1
+            for measurement in ROLLUP_MEASUREMENTS:
+                value = reading[measurement]
+                rollup[f"{measurement}_min"] = min(rollup[f"{measurement}_min"], value)
+                rollup[f"{measurement}_max"] = max(rollup[f"{measurement}_max"], value)
+                rollup[f"{measurement}_sum"] += value
+
+
+def export_rollups(rollups: dict, chunk_name: str) -> dict:
+    '''Writes the rollups of a chunk into one in-memory parquet file per resolution
+    and bucket date. Sums and counts are kept so that buckets split across chunks can
+    be combined later. Returns the buffer to upload for each object name.'''
+    partition_rows = {}
+    for (resolution, plant_id, bucket_start), rollup in rollups.items():
+        row = {"plant_id": plant_id, "timestamp": bucket_start, **rollup}
+        for measurement in ROLLUP_MEASUREMENTS:
+            row[f"{measurement}_mean"] = row[f"{measurement}_sum"] / row["reading_count"]
+        partition_rows.setdefault(
+            f"{ROLLUP_FOLDER}{resolution}/date={bucket_start:%Y-%m-%d}", []).append(row)
+
+    buffers = {}
+    for partition, rows in partition_rows.items():
+        buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_pylist(rows, ROLLUP_SCHEMA), buffer, compression="zstd")
+        buffers[f"{partition}/{chunk_name}"] = buffer
+    return buffers
+
+
+def stream_query_to_csv(conn: Connection, query: str, params: tuple, name: str,
+                        fileobj: io.BytesIO, fetch_size: int = FETCH_SIZE,
+                        compress: bool = True, rollups: dict = None) -> dict:
+    '''Streams the results of a query as csv, gzip-compressed by default, into a
+    binary file object, holding at most fetch_size rows in memory and adding them
+    to the given rollups. Returns the row count with the first and last rows.'''
+    start = perf_counter()
+    export = {"rows": 0, "first_row": None, "last_row": None}
+
+    if compress:
+        csvfile = gzip.open(fileobj, 'wt', newline='', encoding='utf-8')
+    else:
+        csvfile = io.TextIOWrapper(fileobj, newline='', encoding='utf-8')
 
-    query = f'''
-SELECT * FROM delta.{table_name}
-'''
     try:
         with conn.cursor() as cur:
-            cur.execute(query)
-            data = cur.fetchall()
-
-        return data
-    except exceptions.ProgrammingError as e:
-        logging.error("An error has occurred: %s", e)
-        conn.rollback()
-        return None
-
+            cur.execute(query, params)
+            csvwriter = None
+
+            while rows := cur.fetchmany(fetch_size):
+                if csvwriter is None:
+                    csvwriter = csv.DictWriter(csvfile, fieldnames=rows[0].keys())
+                    csvwriter.writeheader()
+                    export["first_row"] = rows[0]
+
+                csvwriter.writerows(rows)
+                if rollups is not None:
+                    update_rollups(rollups, rows)
+                export["rows"] += len(rows)
+                export["last_row"] = rows[-1]
+    finally:
+        if compress:
+            csvfile.close()
+        else:
+            csvfile.flush()
+            csvfile.detach()
+
+    log_export_stats(name, export["rows"], perf_counter() - start)
+    return export
+
+
+def get_reading_partition(reading: dict, partition_by_plant: bool = False) -> str:
+    '''Returns the hive-style partition path a reading belongs to'''
+    partition = f"date={reading['timestamp']:%Y-%m-%d}"
+    if partition_by_plant:
+        partition += f"/plant_id={reading['plant_id']}"
+    return partition
+
+
+def stream_query_to_parquet(conn: Connection, query: str, params: tuple,
+                            partition_by_plant: bool = False,
+                            fetch_size: int = FETCH_SIZE, rollups: dict = None) -> dict:
+    '''Streams reading query results into in-memory zstd-compressed parquet files
+    partitioned by reading date, and optionally by plant, fetching fetch_size rows at
+    a time and adding them to the given rollups. Returns the row count, the first and
+    last rows and the buffer of each partition.'''
+    start = perf_counter()
+    export = {"rows": 0, "first_row": None, "last_row": None, "partitions": {}}
+    schema = READING_SCHEMA
+    if partition_by_plant:
+        schema = schema.remove(schema.get_field_index("plant_id"))
+    writers = {}
 
-def delete_all_reading_data_from_rds(conn: Connection) -> None:
-    '''Deletes all reading data from the rds database'''
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+
+            while rows := cur.fetchmany(fetch_size):
+                partition_rows = {}
+                for row in rows:
+                    partition_rows.setdefault(
+                        get_reading_partition(row, partition_by_plant), []).append(row)
+
+                for partition, readings in partition_rows.items():
+                    if partition not in writers:
+                        export["partitions"][partition] = io.BytesIO()
+                        writers[partition] = pq.ParquetWriter(export["partitions"][partition],
+                                                              schema, compression="zstd")
+                    writers[partition].write_table(pa.Table.from_pylist(readings, schema))
+                if rollups is not None:
+                    update_rollups(rollups, rows)
+
+                export["first_row"] = export["first_row"] or rows[0]
+                export["last_row"] = rows[-1]
+                export["rows"] += len(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    log_export_stats(f"{len(writers)} parquet partitions", export["rows"],
+                     perf_counter() - start)
+    return export
+
+
+def get_archive_format() -> str:
+    '''Returns the configured file format for archived readings'''
+    archive_format = ENV.get("ARCHIVE_FORMAT", "csv").lower()
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(
+            f"Invalid ARCHIVE_FORMAT {archive_format}, expected one of {ARCHIVE_FORMATS}.")
+    return archive_format
+
+
+def get_chunk_name(after_id: int, extension: str) -> str:
+    '''Names an exported chunk after the first reading id it can hold, which only the
+    watermark decides, so that a retried chunk overwrites the objects of a failed
+    attempt even when newer readings have arrived since'''
+    return f"{after_id + 1}_reading_data.{extension}"
+
+
+def export_reading_chunk(conn: Connection, after_id: int, up_to_id: int,
+                         curr_time: str) -> tuple[dict, dict]:
+    '''Exports the next chunk of readings in the configured format along with their
+    rollups, returning the export summary and the in-memory buffer to upload for
+    each object name'''
+    params = (READING_CHUNK_SIZE, after_id, up_to_id)
+    rollups = {}
+
+    if get_archive_format() == "parquet":
+        export = stream_query_to_parquet(
+            conn, READING_CHUNK_QUERY, params,
+            ENV.get("ARCHIVE_PARTITION_BY_PLANT", "false").lower() == "true",
+            rollups=rollups)
+        if not export["rows"]:
+            return export, {}
+        chunk_name = get_chunk_name(after_id, "parquet")
+        buffers = {f"{READING_FOLDER}{partition}/{chunk_name}": buffer
+                   for partition, buffer in export["partitions"].items()}
+    else:
+        buffer = io.BytesIO()
+        export = stream_query_to_csv(conn, READING_CHUNK_QUERY, params, "reading chunk",
+                                     buffer, rollups=rollups)
+        if not export["rows"]:
+            return export, {}
+        buffers = {f"{READING_FOLDER}{curr_time}/{get_chunk_name(after_id, 'csv.gz')}": buffer}
+
+    buffers.update(export_rollups(rollups, get_chunk_name(after_id, "parquet")))
+    return export, buffers
+
+
+def delete_archived_readings(conn: Connection, up_to_id: int,
+                             batch_size: int = DELETE_BATCH_SIZE) -> int:
+    '''Deletes readings up to and including the given reading id in bounded batches,
+    committing after each so locks are only held briefly. Returns the number of
+    readings deleted.'''
     query = '''
-DELETE FROM delta.reading
+DELETE TOP (%s) FROM delta.reading
+WHERE reading_id <= %s
 '''
-    try:
+    deleted = 0
+    while True:
         with conn.cursor() as cur:
-            cur.execute(query)
-            conn.commit()
-    except exceptions.ProgrammingError as e:
-        logging.error("An error has occurred: %s", e)
-        conn.rollback()
+            cur.execute(query, (batch_size, up_to_id))
+            batch_deleted = cur.rowcount
+        conn.commit()
+
+        deleted += batch_deleted
+        if batch_deleted < batch_size:
+            break
+
+    logging.info("Deleted %s archived readings up to reading id %s", deleted, up_to_id)
+    return deleted
+
+
+def get_reading_watermark(s3_client: client, bucket_name: str) -> dict:
+    '''Returns the id and timestamp of the last reading uploaded to the bucket'''
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=WATERMARK_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return {"reading_id": 0, "timestamp": None}
+
+    return json.loads(response["Body"].read())
 
-    logging.info("All reading data deleted!")
 
+def save_reading_watermark(s3_client: client, bucket_name: str, last_reading: dict) -> None:
+    '''Records the last reading uploaded to the bucket'''
+    watermark = {"reading_id": last_reading["reading_id"],
+                 "timestamp": str(last_reading["timestamp"])}
+    s3_client.put_object(Bucket=bucket_name, Key=WATERMARK_KEY,
+                         Body=json.dumps(watermark).encode("utf-8"))
 
-def load_into_csv(data: list[dict], filename: str) -> None:
-    '''Creates a csv file inside a folder named after today's date'''
 
-    if not data:
-        error_message = f"The data list is empty. No CSV file was created for {
-            filename}."
-        logging.error(error_message)
-        return
-    if not isinstance(data, list):
-        return
-    if not isinstance(data[0], dict):
-        return
+def archive_readings_incrementally(s3_client: client,
+                                   conn: Connection,
+                                   curr_time: str) -> int:
+    '''Uploads readings added since the last watermark in keyset-paginated chunks,
+    advancing the watermark and deleting each chunk from the database once it has
+    been uploaded. A failed upload raises before anything is deleted. Returns the
+    number of readings archived.'''
+    bucket_name = ENV["BUCKET_NAME"]
+    watermark_id = get_reading_watermark(s3_client, bucket_name)["reading_id"]
 
-    headers = data[0].keys()
+    delete_archived_readings(conn, watermark_id)
+    up_to_id = get_max_reading_id(conn)
+    archived = 0
+    start = perf_counter()
 
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        csvwriter = csv.DictWriter(csvfile, fieldnames=headers)
+    while watermark_id < up_to_id:
+        export, buffers = export_reading_chunk(conn, watermark_id, up_to_id, curr_time)
+        if not buffers:
+            break
 
-        csvwriter.writeheader()
+        for object_name, buffer in buffers.items():
+            upload_buffer_to_bucket(s3_client, buffer, bucket_name, object_name)
 
-        for row in data:
-            csvwriter.writerow(row)
+        last_id = export["last_row"]["reading_id"]
+        save_reading_watermark(s3_client, bucket_name, export["last_row"])
+        delete_archived_readings(conn, last_id)
 
-    logging.info("File %s successfully created!", filename)
+        watermark_id = last_id
+        archived += export["rows"]
+
+    log_export_stats("table reading", archived, perf_counter() - start)
+    return archived
 
 
 def get_uk_time() -> str:
@@ -118,53 +386,91 @@ def get_uk_time() -> str:
     return datetime.now(uk_timezone).strftime("%d_%m_%Y")
 
 
-def upload_file_to_bucket(s3_client: client,
-                          filename: str,
-                          bucket_name: str,
-                          object_name: str) -> None:
-    '''Uploads a file to the bucket.'''
+def get_transfer_config() -> TransferConfig:
+    '''Returns the multipart upload settings, tunable through the environment'''
+    part_size = int(ENV.get("UPLOAD_PART_SIZE_IN_MB", UPLOAD_PART_SIZE_IN_MB)) * MEGABYTE
+    return TransferConfig(multipart_threshold=part_size,
+                          multipart_chunksize=part_size,
+                          max_concurrency=int(ENV.get("UPLOAD_CONCURRENCY", UPLOAD_CONCURRENCY)))
+
+
+def upload_buffer_to_bucket(s3_client: client,
+                            buffer: io.BytesIO,
+                            bucket_name: str,
+                            object_name: str) -> dict:
+    '''Uploads an in-memory export to the bucket, split into a parallel multipart
+    upload once it passes the part size. Returns the upload size and throughput.'''
+    size_in_mb = buffer.getbuffer().nbytes / MEGABYTE
+    buffer.seek(0)
+    start = perf_counter()
+
+    s3_client.upload_fileobj(buffer, bucket_name, object_name, Config=get_transfer_config())
+
+    elapsed = perf_counter() - start
+    upload = {"object": object_name,
+              "size_in_mb": size_in_mb,
+              "mb_per_sec": size_in_mb / elapsed if elapsed else 0}
+    logging.info("Uploaded %s to %s (%.2f MB at %.2f MB/s)",
+                 object_name, bucket_name, upload["size_in_mb"], upload["mb_per_sec"])
+    return upload
+
+
+def upload_metadata_table(s3_client: client, table: str) -> dict:
+    '''Exports a metadata table on its own connection and uploads it as csv'''
+    conn = get_connection()
     try:
-        s3_client.upload_file(filename, bucket_name, object_name)
-        log_message = f"File {filename} uploaded to {
-            bucket_name}/{object_name}"
-        logging.info(log_message)
-    except Exception as e:
-        error_message = f"Error uploading file: {e}"
-        logging.error(error_message)
+        buffer = io.BytesIO()
+        export = stream_query_to_csv(conn, f"SELECT * FROM delta.{table}", (),
+                                     f"table {table}", buffer, compress=False)
+    finally:
+        conn.close()
 
+    if not export["rows"]:
+        logging.info("No table data for %s", table)
+        return {"table": table, "rows": 0}
 
-def upload_data_to_s3(s3_client: client,
-                      conn: Connection,
-                      folder_path: str,
-                      curr_time: str) -> list[dict]:
-    '''Uploads all metadata folder to s3 bucket'''
-
-    for table in TABLES_IN_DATABASE:
-        local_filename = f"{folder_path}/{table}_data.csv"
-        if table == 'reading':
-            remote_filename = f"{curr_time}/{table}_data.csv"
-        else:
-            remote_filename = f"{table}_data.csv"
-        table_data = get_data_from_rds(conn, table)
-        if isinstance(table_data, list) and len(table_data) >= 1:
-            load_into_csv(table_data, local_filename)
-        else:
-            logging.info("No table data for %s", table)
-            continue
+    upload = upload_buffer_to_bucket(s3_client, buffer, ENV["BUCKET_NAME"],
+                                     f"{METADATA_FOLDER}{table}_data.csv")
+    return {"table": table, "rows": export["rows"], **upload}
 
-        if table != 'reading':
-            upload_file_to_bucket(s3_client, local_filename, ENV["BUCKET_NAME"],
-                                  METADATA_FOLDER+remote_filename)
-        else:
-            upload_file_to_bucket(s3_client, local_filename, ENV["BUCKET_NAME"],
-                                  READING_FOLDER+remote_filename)
+
+def upload_reading_table(s3_client: client, curr_time: str) -> dict:
+    '''Archives the readings on their own connection'''
+    conn = get_connection()
+    try:
+        return {"table": "reading",
+                "rows": archive_readings_incrementally(s3_client, conn, curr_time)}
+    finally:
+        conn.close()
 
 
-def create_today_folder(folder_name: str) -> str:
-    '''Creates a directory for today's data'''
-    folder_name = os.path.join('tmp', folder_name)
-    os.makedirs(folder_name, exist_ok=True)
-    return folder_name
+def upload_data_to_s3(s3_client: client,
+                      curr_time: str,
+                      tables: list[str] = None) -> list[dict]:
+    '''Exports and uploads the tables to the s3 bucket concurrently, each on its own
+    database connection. Returns the upload summary of each table, raising once every
+    table has finished if any of them failed.'''
+    tables = tables or TABLES_IN_DATABASE
+
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        futures = {table: executor.submit(upload_reading_table, s3_client, curr_time)
+                   if table == 'reading' else
+                   executor.submit(upload_metadata_table, s3_client, table)
+                   for table in tables}
+
+    uploads = []
+    failed_tables = []
+    for table, future in futures.items():
+        try:
+            uploads.append(future.result())
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Error archiving table %s: %s", table, e)
+            failed_tables.append(table)
+
+    if failed_tables:
+        raise RuntimeError(f"Failed to archive tables: {failed_tables}")
+
+    return uploads
 
 
 def lambda_handler(event, context):
@@ -173,11 +479,8 @@ def lambda_handler(event, context):
     logging.info("Lambda function has started")
     load_dotenv()
     current_date = get_uk_time()
-    db_conn = get_connection()
     s3_clt = load_s3_client()
-    folder_path = create_today_folder(current_date)
-    upload_data_to_s3(s3_clt, db_conn, folder_path, current_date)
-    delete_all_reading_data_from_rds(db_conn)
+    upload_data_to_s3(s3_clt, current_date)
 
     logging.info("Lambda function has finished")
 
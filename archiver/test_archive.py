@@ -1,9 +1,18 @@
 '''File used for testing the archive file for the storing long term data'''
+import csv
+import gzip
+import io
+from datetime import datetime
 import pytest
+import pyarrow as pa
+import pyarrow.parquet as pq
 from unittest.mock import patch, MagicMock
-from archive import get_connection, get_data_from_rds, upload_data_to_s3
+from archive import get_connection, upload_data_to_s3, \
+    archive_readings_incrementally, delete_archived_readings, stream_query_to_csv, \
+    stream_query_to_parquet, export_reading_chunk, upload_buffer_to_bucket, update_rollups
 from os import environ as ENV
-from pymssql import exceptions
+import boto3
+from moto import mock_aws
 
 
 class TestGetConnection:
@@ -57,80 +66,392 @@ class TestGetConnection:
             exc_info.value) == "\"'DB_USER' missing from environment variables.\""
 
 
-class TestGetDataFromRDS:
-    '''Contains tests for getting data from the database function'''
+@pytest.fixture
+def s3_client():
+    '''Creates a local stand-in for the s3 bucket'''
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="my_bucket")
+        ENV["BUCKET_NAME"] = "my_bucket"
+        yield s3
 
-    @patch('archive.Connection')
-    def test_get_data_success(self, mock_connection):
-        """Test successful data retrieval from the RDS database."""
-        mock_cursor = MagicMock()
-        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
-        mock_cursor.fetchall.return_value = [{'id': 1, 'value': 'test'}]
 
-        data = get_data_from_rds(mock_connection, 'test_table')
+def get_mock_conn(rows: list[dict]) -> MagicMock:
+    '''Returns a connection whose cursor fetches the given rows in one chunk'''
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+    mock_cursor.fetchmany.side_effect = [rows, []] if rows else [[]]
+    return mock_conn
 
-        assert mock_cursor.execute.call_count == 1
-        assert data == [{'id': 1, 'value': 'test'}]
 
-    @patch('archive.Connection')
-    def test_get_data_programming_error(self, mock_connection):
-        """Test handling of a ProgrammingError during data retrieval."""
-        mock_cursor = MagicMock()
-        mock_connection.cursor.return_value.__enter__.return_value = mock_cursor
-        mock_cursor.execute.side_effect = exceptions.ProgrammingError(
-            "Error in query")
+def get_table_conn(table_rows: dict) -> MagicMock:
+    '''Returns a connection whose cursor fetches the rows of the table it queries'''
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
-        data = get_data_from_rds(mock_connection, 'test_table')
+    def execute(query, params):  # pylint: disable=unused-argument
+        rows = table_rows[query.split('.')[-1]]
+        mock_cursor.fetchmany.side_effect = [rows, []] if rows else [[]]
 
-        assert mock_cursor.execute.call_count == 1
-        assert not data
-        assert mock_connection.rollback.call_count == 1
+    mock_cursor.execute.side_effect = execute
+    return mock_conn
 
 
 class TestUploadDataToS3:
     '''Contains tests for uploading data to an s3 bucket'''
 
-    @patch('archive.upload_file_to_bucket')
-    @patch('archive.load_into_csv')
-    @patch('archive.get_data_from_rds')
-    def test_upload_data_to_s3(self, mock_get_data_from_rds, mock_load_into_csv, mock_upload_file_to_bucket):
+    @patch('archive.archive_readings_incrementally')
+    @patch('archive.get_connection')
+    def test_upload_data_to_s3(self, mock_get_connection, mock_archive_readings, s3_client):
         """Test the upload_data_to_s3 function including missing data."""
+        table_rows = {'table1': [{'id': 1, 'value': 'test1'}],
+                      'table2': [{'id': 2, 'value': 'test2'}],
+                      'table3': []}
+        mock_get_connection.side_effect = lambda: get_table_conn(table_rows)
+        mock_archive_readings.return_value = 3
 
-        mock_s3_client = MagicMock()
-        mock_conn = MagicMock()
-        curr_time = '2024-06-13-15-30-00'
-        mock_tables = ['table1', 'table2', 'reading']
-        mock_metadata = 'metadata/'
-        mock_reading = 'reading/'
-        fake_folder_path = 'humpty-dumpty'
+        with patch('archive.TABLES_IN_DATABASE', ['table1', 'table2', 'table3', 'reading']):
+            uploads = upload_data_to_s3(s3_client, 'date')
+
+        keys = [obj['Key'] for obj in s3_client.list_objects_v2(
+            Bucket='my_bucket')['Contents']]
+        body = s3_client.get_object(Bucket='my_bucket', Key='metadata/table1_data.csv')['Body']
+
+        assert keys == ['metadata/table1_data.csv', 'metadata/table2_data.csv']
+        assert body.read().decode() == 'id,value\r\n1,test1\r\n'
+        assert [(upload['table'], upload['rows']) for upload in uploads] == [
+            ('table1', 1), ('table2', 1), ('table3', 0), ('reading', 3)]
+        assert mock_get_connection.call_count == 4
+
+    @patch('archive.get_connection')
+    def test_failed_table_is_raised(self, mock_get_connection, s3_client):
+        """Tests that a failing table is reported once the other tables are uploaded."""
+        table_rows = {'table2': [{'id': 2, 'value': 'test2'}]}
+        mock_get_connection.side_effect = lambda: get_table_conn(table_rows)
+
+        with patch('archive.TABLES_IN_DATABASE', ['table1', 'table2']):
+            with pytest.raises(RuntimeError) as exc_info:
+                upload_data_to_s3(s3_client, 'date')
+
+        assert str(exc_info.value) == "Failed to archive tables: ['table1']"
+        assert s3_client.list_objects_v2(Bucket='my_bucket')['KeyCount'] == 1
+
+    @patch('archive.archive_readings_incrementally')
+    @patch('archive.get_connection')
+    def test_tables_upload_concurrently(self, mock_get_connection, mock_archive_readings,
+                                        s3_client):
+        """Tests that every table is exported on its own connection in the thread pool."""
+        mock_get_connection.side_effect = lambda: get_mock_conn([{'id': 1}])
+        mock_archive_readings.return_value = 0
+
+        uploads = upload_data_to_s3(s3_client, 'date')
+
+        assert mock_get_connection.call_count == 7
+        assert s3_client.list_objects_v2(Bucket='my_bucket')['KeyCount'] == 6
+        assert sorted(upload['table'] for upload in uploads) == sorted(
+            ['town', 'country', 'timezone', 'location', 'botanist', 'plant', 'reading'])
+
+
+class TestUploadBufferToBucket:
+    '''Contains tests for uploading in-memory exports'''
+
+    def test_large_buffers_use_multipart(self, s3_client):
+        '''Tests that buffers over the part size are sent as a multipart upload'''
+        buffer = io.BytesIO(b'x' * (6 * 1024 * 1024))
+
+        with patch.dict("os.environ", {"UPLOAD_PART_SIZE_IN_MB": "5"}):
+            upload = upload_buffer_to_bucket(s3_client, buffer, 'my_bucket', 'readings/big')
+
+        head = s3_client.head_object(Bucket='my_bucket', Key='readings/big')
+        assert head['ContentLength'] == 6 * 1024 * 1024
+        assert head['ETag'].endswith('-2"')
+        assert upload['size_in_mb'] == 6
+
+    def test_failed_upload_raises(self, s3_client):
+        '''Tests that upload errors are not swallowed'''
+        with pytest.raises(Exception):
+            upload_buffer_to_bucket(s3_client, io.BytesIO(b'data'), 'missing_bucket', 'key')
+
+
+class TestArchiveReadingsIncrementally:
+    '''Contains tests for the incremental, watermark-based reading archive'''
+
+    @patch('archive.save_reading_watermark')
+    @patch('archive.upload_buffer_to_bucket')
+    @patch('archive.stream_query_to_csv')
+    @patch('archive.delete_archived_readings')
+    @patch('archive.get_max_reading_id')
+    @patch('archive.get_reading_watermark')
+    def test_archives_chunks_after_watermark(self, mock_get_watermark, mock_get_max_id,
+                                             mock_delete, mock_stream, mock_upload,
+                                             mock_save_watermark):
+        '''Tests that each chunk is uploaded, then the watermark advanced and the chunk deleted'''
         ENV["BUCKET_NAME"] = "my_bucket"
+        mock_get_watermark.return_value = {"reading_id": 10, "timestamp": None}
+        mock_get_max_id.return_value = 14
+        last_rows = [{"reading_id": 12, "timestamp": "t"}, {"reading_id": 14, "timestamp": "t"}]
+        mock_stream.side_effect = [
+            {"rows": 2, "first_row": {"reading_id": 11}, "last_row": last_rows[0]},
+            {"rows": 1, "first_row": {"reading_id": 14}, "last_row": last_rows[1]}]
+
+        archived = archive_readings_incrementally(MagicMock(), MagicMock(), 'date')
+
+        assert archived == 3
+        assert [c.args[2][1:] for c in mock_stream.call_args_list] == [(10, 14), (12, 14)]
+        assert [c.args[3] for c in mock_upload.call_args_list] == [
+            'readings/date/11_reading_data.csv.gz', 'readings/date/13_reading_data.csv.gz']
+        assert [c.args[1] for c in mock_delete.call_args_list] == [10, 12, 14]
+        assert [c.args[2] for c in mock_save_watermark.call_args_list] == last_rows
+
+    @patch('archive.save_reading_watermark')
+    @patch('archive.upload_buffer_to_bucket')
+    @patch('archive.stream_query_to_csv')
+    @patch('archive.delete_archived_readings')
+    @patch('archive.get_max_reading_id')
+    @patch('archive.get_reading_watermark')
+    def test_failed_upload_keeps_readings(self, mock_get_watermark, mock_get_max_id,
+                                          mock_delete, mock_stream, mock_upload,
+                                          mock_save_watermark):
+        '''Tests that nothing is deleted or recorded when an upload fails'''
+        ENV["BUCKET_NAME"] = "my_bucket"
+        mock_get_watermark.return_value = {"reading_id": 0, "timestamp": None}
+        mock_get_max_id.return_value = 5
+        mock_stream.return_value = {"rows": 1, "first_row": {"reading_id": 1},
+                                    "last_row": {"reading_id": 1, "timestamp": "t"}}
+        mock_upload.side_effect = RuntimeError("upload failed")
+
+        with pytest.raises(RuntimeError):
+            archive_readings_incrementally(MagicMock(), MagicMock(), 'date')
+
+        assert [c.args[1] for c in mock_delete.call_args_list] == [0]
+        mock_save_watermark.assert_not_called()
+
+    @patch('archive.get_connection')
+    def test_watermark_round_trip(self, mock_get_connection, s3_client):  # pylint: disable=unused-argument
+        '''Tests that the watermark is read back from the bucket on the next run'''
+        rows = [{'reading_id': 7, 'soil_moisture': 20.5, 'temperature': 1.5,
+                 'timestamp': datetime(2024, 6, 10), 'plant_id': 3}]
+        mock_conn = get_mock_conn(rows)
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchone.return_value = {"max_reading_id": 7}
+        mock_cursor.rowcount = 0
+
+        assert archive_readings_incrementally(s3_client, mock_conn, 'date') == 1
+        assert archive_readings_incrementally(s3_client, mock_conn, 'date') == 0
+
+        keys = [obj['Key'] for obj in s3_client.list_objects_v2(
+            Bucket='my_bucket')['Contents']]
+        assert keys == ['metadata/reading_watermark.json', 'readings/date/1_reading_data.csv.gz',
+                        'rollups/5min/date=2024-06-10/1_reading_data.parquet',
+                        'rollups/day/date=2024-06-10/1_reading_data.parquet',
+                        'rollups/hour/date=2024-06-10/1_reading_data.parquet']
+
+    @patch('archive.get_connection')
+    def test_retried_chunk_overwrites_failed_attempt(
+            self, mock_get_connection, s3_client):  # pylint: disable=unused-argument
+        '''Tests that a chunk retried after newer readings arrived replaces the
+        objects of the failed attempt rather than adding a second copy'''
+        rows = [{'reading_id': reading_id, 'soil_moisture': 20.5, 'temperature': 12.5,
+                 'timestamp': datetime(2024, 6, 10, 12, reading_id), 'plant_id': 3,
+                 'botanist_id': 1, 'last_watered': datetime(2024, 6, 10, 9)}
+                for reading_id in range(1, 36)]
+        uploads = []
+
+        def fail_third_upload(s3, buffer, bucket_name, object_name):
+            uploads.append(object_name)
+            if len(uploads) == 3:
+                raise RuntimeError("upload failed")
+            return upload_buffer_to_bucket(s3, buffer, bucket_name, object_name)
+
+        def run(readings: list[dict]) -> int:
+            mock_conn = get_mock_conn(readings)
+            mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+            mock_cursor.fetchone.return_value = {"max_reading_id": readings[-1]['reading_id']}
+            mock_cursor.rowcount = 0
+            return archive_readings_incrementally(s3_client, mock_conn, 'date')
+
+        with patch.dict("os.environ", {"ARCHIVE_FORMAT": "parquet"}):
+            with patch('archive.upload_buffer_to_bucket', side_effect=fail_third_upload):
+                with pytest.raises(RuntimeError):
+                    run(rows[:30])
+            assert run(rows) == 35
+
+        keys = [obj['Key'] for obj in s3_client.list_objects_v2(
+            Bucket='my_bucket')['Contents']]
+        assert [key for key in keys if key.startswith(('readings/', 'rollups/5min/'))] == [
+            'readings/date=2024-06-10/1_reading_data.parquet',
+            'rollups/5min/date=2024-06-10/1_reading_data.parquet']
+        reading_object = s3_client.get_object(
+            Bucket='my_bucket', Key='readings/date=2024-06-10/1_reading_data.parquet')
+        archived = pq.read_table(pa.BufferReader(reading_object['Body'].read()))
+        assert archived.column('reading_id').to_pylist() == list(range(1, 36))
+
+
+class TestExportReadingChunk:
+    '''Contains tests for exporting a chunk in the configured format'''
 
-        mock_get_data_from_rds.side_effect = [
-            [{'id': 1, 'value': 'test1'}],
-            [{'id': 2, 'value': 'test2'}],
-            []
+    @patch('archive.stream_query_to_parquet')
+    def test_parquet_objects_keep_partitions(self, mock_stream):
+        '''Tests that each parquet partition is uploaded under its partition path'''
+        buffers = {"date=2024-06-10": io.BytesIO(), "date=2024-06-11": io.BytesIO()}
+        mock_stream.return_value = {
+            "rows": 3, "first_row": {"reading_id": 1}, "last_row": {"reading_id": 3},
+            "partitions": buffers}
+
+        with patch.dict("os.environ", {"ARCHIVE_FORMAT": "parquet"}):
+            _, files = export_reading_chunk(MagicMock(), 0, 3, 'date')
+
+        assert files == {
+            'readings/date=2024-06-10/1_reading_data.parquet': buffers["date=2024-06-10"],
+            'readings/date=2024-06-11/1_reading_data.parquet': buffers["date=2024-06-11"]}
+
+    def test_rollups_are_exported_with_the_chunk(self):
+        '''Tests that the chunk's rollups are written per resolution and bucket date'''
+        rows = TestStreamQueryToParquet.readings
+
+        with patch.dict("os.environ", {"ARCHIVE_FORMAT": "csv"}):
+            _, files = export_reading_chunk(get_mock_conn(rows), 0, 3, 'date')
+
+        day_key = 'rollups/day/date=2024-06-11/1_reading_data.parquet'
+        assert sorted(files)[:3] == [
+            'readings/date/1_reading_data.csv.gz',
+            'rollups/5min/date=2024-06-10/1_reading_data.parquet',
+            'rollups/5min/date=2024-06-11/1_reading_data.parquet']
+        day_rollups = pq.read_table(pa.BufferReader(files[day_key].getvalue())).to_pylist()
+        assert [(r['plant_id'], r['reading_count'], r['temperature_mean'])
+                for r in day_rollups] == [(3, 1, 13.1), (4, 1, 14.1)]
+
+    def test_invalid_format(self):
+        '''Tests that an unknown archive format is rejected'''
+        with patch.dict("os.environ", {"ARCHIVE_FORMAT": "xml"}):
+            with pytest.raises(ValueError):
+                export_reading_chunk(MagicMock(), 0, 3, 'date')
+
+
+class TestStreamQueryToParquet:
+    '''Contains tests for streaming readings into partitioned parquet files'''
+
+    readings = [
+        {'reading_id': 1, 'soil_moisture': 20.5, 'temperature': 12.1,
+         'timestamp': datetime(2024, 6, 10, 23, 59), 'plant_id': 3, 'botanist_id': 1,
+         'last_watered': datetime(2024, 6, 10, 14, 3)},
+        {'reading_id': 2, 'soil_moisture': 21.5, 'temperature': 13.1,
+         'timestamp': datetime(2024, 6, 11, 0, 0), 'plant_id': 3, 'botanist_id': 1,
+         'last_watered': datetime(2024, 6, 10, 14, 3)},
+        {'reading_id': 3, 'soil_moisture': 22.5, 'temperature': 14.1,
+         'timestamp': datetime(2024, 6, 11, 0, 1), 'plant_id': 4, 'botanist_id': 2,
+         'last_watered': datetime(2024, 6, 11, 0, 0)},
+    ]
+
+    def get_mock_conn(self) -> MagicMock:
+        '''Returns a connection whose cursor yields the readings two at a time'''
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchmany.side_effect = [self.readings[:2], self.readings[2:], []]
+        return mock_conn
+
+    def test_partitions_by_date(self):
+        '''Tests that readings are split into one typed file per reading date'''
+        export = stream_query_to_parquet(self.get_mock_conn(), 'SELECT', ())
+
+        assert export["rows"] == 3
+        assert export["last_row"] == self.readings[2]
+        assert sorted(export["partitions"]) == ['date=2024-06-10', 'date=2024-06-11']
+
+        table = pq.read_table(pa.BufferReader(
+            export["partitions"]['date=2024-06-11'].getvalue()))
+        assert table.column('reading_id').to_pylist() == [2, 3]
+        assert str(table.schema.field('plant_id').type) == 'int16'
+
+    def test_partitions_by_plant(self):
+        '''Tests that plant partitions move plant_id out of the files'''
+        export = stream_query_to_parquet(self.get_mock_conn(), 'SELECT', (),
+                                         partition_by_plant=True)
+
+        assert sorted(export["partitions"]) == ['date=2024-06-10/plant_id=3',
+                                                'date=2024-06-11/plant_id=3',
+                                                'date=2024-06-11/plant_id=4']
+        table = pq.read_table(pa.BufferReader(
+            export["partitions"]['date=2024-06-11/plant_id=4'].getvalue()))
+        assert 'plant_id' not in table.column_names
+
+
+class TestUpdateRollups:
+    '''Contains tests for aggregating readings into rollups while streaming'''
+
+    def test_aggregates_per_plant_and_bucket(self):
+        '''Tests that readings in the same bucket are combined into min, max, sum and count'''
+        readings = [
+            {'plant_id': 1, 'timestamp': datetime(2024, 6, 10, 9, 1),
+             'temperature': 10.0, 'soil_moisture': 30.0},
+            {'plant_id': 1, 'timestamp': datetime(2024, 6, 10, 9, 4),
+             'temperature': 14.0, 'soil_moisture': 20.0},
+            {'plant_id': 1, 'timestamp': datetime(2024, 6, 10, 9, 6),
+             'temperature': 12.0, 'soil_moisture': 25.0},
         ]
+        rollups = {}
+
+        update_rollups(rollups, readings[:1])
+        update_rollups(rollups, readings[1:])
+
+        assert rollups[('5min', 1, datetime(2024, 6, 10, 9, 0))] == {
+            'reading_count': 2, 'temperature_min': 10.0, 'temperature_max': 14.0,
+            'temperature_sum': 24.0, 'soil_moisture_min': 20.0,
+            'soil_moisture_max': 30.0, 'soil_moisture_sum': 50.0}
+        assert rollups[('hour', 1, datetime(2024, 6, 10, 9, 0))]['reading_count'] == 3
+        assert rollups[('day', 1, datetime(2024, 6, 10))]['temperature_sum'] == 36.0
+        assert len(rollups) == 4
+
+
+class TestStreamQueryToCsv:
+    '''Contains tests for streaming query results into a csv buffer'''
+
+    rows = [{'reading_id': i, 'temperature': i / 2} for i in range(5)]
+
+    def test_streams_in_fetchmany_chunks(self):
+        '''Tests that rows are written chunk by chunk and the first and last rows kept'''
+        mock_conn = get_mock_conn(None)
+        mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+        mock_cursor.fetchmany.side_effect = [self.rows[:2], self.rows[2:4], self.rows[4:], []]
+        buffer = io.BytesIO()
+
+        export = stream_query_to_csv(mock_conn, 'SELECT', (), 'reading', buffer, fetch_size=2)
+
+        assert export == {"rows": 5, "first_row": self.rows[0], "last_row": self.rows[4]}
+        mock_cursor.fetchmany.assert_called_with(2)
+        csv_text = gzip.decompress(buffer.getvalue()).decode('utf-8')
+        assert list(csv.DictReader(io.StringIO(csv_text)))[3] == {
+            'reading_id': '3', 'temperature': '1.5'}
+
+    def test_uncompressed_leaves_buffer_open(self):
+        '''Tests that plain csv can be written into a buffer that stays usable'''
+        buffer = io.BytesIO()
+
+        stream_query_to_csv(get_mock_conn(self.rows[:1]), 'SELECT', (), 'table', buffer,
+                            compress=False)
+
+        assert not buffer.closed
+        assert buffer.getvalue() == b'reading_id,temperature\r\n0,0.0\r\n'
+
+
+class TestDeleteArchivedReadings:
+    '''Contains tests for deleting archived readings in batches'''
+
+    def test_deletes_in_batches_until_done(self):
+        '''Tests that deletes repeat until a batch deletes fewer rows than its size'''
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        rowcounts = iter([100, 100, 30])
+        mock_cursor.execute.side_effect = lambda *args: setattr(
+            mock_cursor, 'rowcount', next(rowcounts))
+
+        deleted = delete_archived_readings(mock_conn, 500, batch_size=100)
 
-        with patch('archive.TABLES_IN_DATABASE', mock_tables), \
-                patch('archive.METADATA_FOLDER', mock_metadata), \
-                patch('archive.READING_FOLDER', mock_reading):
-            upload_data_to_s3(mock_s3_client, mock_conn,
-                              fake_folder_path, curr_time)
-
-        mock_get_data_from_rds.assert_any_call(mock_conn, 'table1')
-        mock_get_data_from_rds.assert_any_call(mock_conn, 'table2')
-        mock_get_data_from_rds.assert_any_call(mock_conn, 'reading')
-
-        mock_load_into_csv.assert_any_call(
-            [{'id': 1, 'value': 'test1'}], f'{fake_folder_path}/table1_data.csv')
-        mock_load_into_csv.assert_any_call(
-            [{'id': 2, 'value': 'test2'}], f'{fake_folder_path}/table2_data.csv')
-
-        mock_upload_file_to_bucket.assert_any_call(
-            mock_s3_client, f'{fake_folder_path}/table1_data.csv', ENV["BUCKET_NAME"], f'{mock_metadata}table1_data.csv')
-        mock_upload_file_to_bucket.assert_any_call(
-            mock_s3_client, f'{fake_folder_path}/table2_data.csv', ENV["BUCKET_NAME"], f'{mock_metadata}table2_data.csv')
-
-        assert mock_get_data_from_rds.call_count == 3
-        assert mock_load_into_csv.call_count == 2
-        assert mock_upload_file_to_bucket.call_count == 2
+        assert deleted == 230
+        assert mock_cursor.execute.call_count == 3
+        assert mock_cursor.execute.call_args[0][1] == (100, 500)
+        assert mock_conn.commit.call_count == 3
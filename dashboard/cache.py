@@ -0,0 +1,108 @@
+"""Caches database and S3 loads and chart specs across Streamlit reruns."""
+
+from datetime import date, datetime, timedelta
+from os import environ as ENV
+from threading import Lock
+
+import pandas as pd
+import streamlit as st
+from pymssql import Connection, Error  # pylint: disable=no-name-in-module
+
+import utils
+import charts
+
+# The pipeline inserts new readings once a minute and the archive runs daily.
+LIVE_DATA_TTL_IN_SECONDS = int(ENV.get("LIVE_DATA_TTL_IN_SECONDS", 60))
+ARCHIVED_DATA_TTL_IN_SECONDS = int(ENV.get("ARCHIVED_DATA_TTL_IN_SECONDS", 3600))
+# Readings older than a day are archived every night.
+LIVE_DATA_WINDOW_IN_HOURS = int(ENV.get("LIVE_DATA_WINDOW_IN_HOURS", 24))
+
+CHARTS = {
+    "latest_temperature": charts.get_bar_chart_of_latest_temperature_per_plant,
+    "latest_soil_moisture": charts.get_bar_chart_of_latest_soil_moisture_per_plant,
+    "temperature_history": charts.get_line_chart_of_temperature_history,
+    "soil_moisture_history": charts.get_line_chart_of_soil_moisture_history,
+}
+
+
+@st.cache_resource
+def get_shared_connection() -> tuple[Connection, Lock]:
+    """Opens one database connection shared by every session, with a lock
+        so that only one query uses it at a time."""
+    return utils.get_connection(), Lock()
+
+
+def is_connection_healthy(connection: Connection) -> bool:
+    """Checks that a connection can still run a query."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        return True
+    except Error:
+        return False
+
+
+def run_with_connection(query_function, *args):
+    """Runs a query function on the shared connection, reconnecting once if the
+        connection has gone stale. A stale connection is closed while its lock is
+        held, so no other session can still be using it."""
+    connection, lock = get_shared_connection()
+
+    with lock:
+        if is_connection_healthy(connection):
+            return query_function(connection, *args)
+
+        try:
+            connection.close()
+        except Error:
+            pass
+        # Another session may have replaced the stale connection already.
+        if get_shared_connection()[0] is connection:
+            get_shared_connection.clear()
+
+    connection, lock = get_shared_connection()
+    with lock:
+        return query_function(connection, *args)
+
+
+@st.cache_data(ttl=LIVE_DATA_TTL_IN_SECONDS, show_spinner="Fetching live data...")
+def load_live_data() -> pd.DataFrame:
+    """Returns the live readings of the last LIVE_DATA_WINDOW_IN_HOURS, refreshed
+        at most once per TTL."""
+    start_time = datetime.now() - timedelta(hours=LIVE_DATA_WINDOW_IN_HOURS)
+    return run_with_connection(utils.get_live_data, start_time)
+
+
+@st.cache_data(ttl=LIVE_DATA_TTL_IN_SECONDS, show_spinner="Fetching latest readings...")
+def load_latest_readings() -> pd.DataFrame:
+    """Returns the latest reading of each plant, refreshed at most once per TTL."""
+    return run_with_connection(utils.get_latest_readings)
+
+
+@st.cache_data(ttl=ARCHIVED_DATA_TTL_IN_SECONDS, show_spinner="Fetching archived data...")
+def load_archived_data(aws_access_key: str, aws_secret_access_key: str) -> pd.DataFrame:
+    """Returns the archived reading data, synced with S3 at most once per TTL."""
+    return utils.get_archived_data(aws_access_key, aws_secret_access_key)
+
+
+@st.cache_data(ttl=ARCHIVED_DATA_TTL_IN_SECONDS, show_spinner="Fetching reading history...")
+def load_reading_history(aws_access_key: str, aws_secret_access_key: str, resolution: str,
+                         start_date: date, end_date: date) -> pd.DataFrame:
+    """Returns the per-plant rollups of a resolution between two dates, synced with
+        S3 at most once per TTL."""
+    return utils.get_reading_history(aws_access_key, aws_secret_access_key, resolution,
+                                     start_date, end_date)
+
+
+def get_data_version(data: pd.DataFrame) -> str:
+    """Returns a cheap key that changes whenever new readings arrive."""
+    if data.empty:
+        return "empty"
+    return f"{len(data)}-{data['timestamp'].max()}"
+
+
+@st.cache_data(max_entries=len(CHARTS) * 2)
+def get_chart_spec(chart_name: str, data_version: str, _data: pd.DataFrame) -> dict:  # pylint: disable=unused-argument
+    """Builds a chart's Vega-Lite spec once per data version."""
+    return CHARTS[chart_name](_data).to_dict()
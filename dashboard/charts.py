@@ -3,27 +3,25 @@
 import pandas as pd
 import altair as alt
 
+CHART_WIDTH = 1200
 
-def get_bar_chart_of_latest_temperature_per_plant(live_reading_data: pd.DataFrame) -> alt.Chart:
-    """Returns an Altair bar chart of the latest temperature of each plant."""
 
-    latest_readings = live_reading_data.sort_values(
-        'timestamp').drop_duplicates('name', keep='last')
+def get_bar_chart_of_latest_temperature_per_plant(latest_readings: pd.DataFrame) -> alt.Chart:
+    """Returns an Altair bar chart of the latest temperature of each plant,
+        given one latest reading per plant."""
 
     return alt.Chart(latest_readings).mark_bar(color="DarkGreen").encode(
         x=alt.X('name:N', title='Plant Name'),
         y=alt.Y('temperature:Q', title='Temperature (°C)'),
         color=alt.Color('temperature:Q', scale=alt.Scale(scheme='oranges')
                         )).properties(
-        title='Latest Temperature Readings for Each Plant', width=1200, height=400,
+        title='Latest Temperature Readings for Each Plant', width=CHART_WIDTH, height=400,
     ).interactive()
 
 
-def get_bar_chart_of_latest_soil_moisture_per_plant(live_reading_data: pd.DataFrame) -> alt.Chart:
-    """Returns an Altair bar chart of the latest soil moisture of each plant."""
-
-    latest_readings = live_reading_data.sort_values(
-        'timestamp').drop_duplicates('name', keep='last')
+def get_bar_chart_of_latest_soil_moisture_per_plant(latest_readings: pd.DataFrame) -> alt.Chart:
+    """Returns an Altair bar chart of the latest soil moisture of each plant,
+        given one latest reading per plant."""
 
     return alt.Chart(latest_readings).mark_bar(color='green').encode(
         x=alt.X('name:N', title='Plant Name'),
@@ -31,6 +29,34 @@ def get_bar_chart_of_latest_soil_moisture_per_plant(live_reading_data: pd.DataFr
         color=alt.Color('soil_moisture:Q', scale=alt.Scale(scheme='blues'))
     ).properties(
         title='Latest Soil Moisture Readings for Each Plant',
-        width=1200,
+        width=CHART_WIDTH,
         height=400
     ).interactive()
+
+
+def get_line_chart_of_history(history: pd.DataFrame, measurement: str,
+                              title: str) -> alt.Chart:
+    """Returns an Altair line chart of the mean of a measurement per plant over
+        time, from rollups, with its min and max in the tooltip."""
+
+    return alt.Chart(history).mark_line().encode(
+        x=alt.X('timestamp:T', title='Time'),
+        y=alt.Y(f'{measurement}_mean:Q', title=title),
+        color=alt.Color('name:N', title='Plant Name'),
+        tooltip=['name:N', 'timestamp:T', f'{measurement}_min:Q',
+                 f'{measurement}_mean:Q', f'{measurement}_max:Q', 'reading_count:Q']
+    ).properties(
+        title=f'{title} History for Each Plant',
+        width=CHART_WIDTH,
+        height=400
+    ).interactive()
+
+
+def get_line_chart_of_temperature_history(history: pd.DataFrame) -> alt.Chart:
+    """Returns an Altair line chart of each plant's temperature history."""
+    return get_line_chart_of_history(history, 'temperature', 'Temperature (°C)')
+
+
+def get_line_chart_of_soil_moisture_history(history: pd.DataFrame) -> alt.Chart:
+    """Returns an Altair line chart of each plant's soil moisture history."""
+    return get_line_chart_of_history(history, 'soil_moisture', 'Soil Moisture (%)')
@@ -0,0 +1,7 @@
+"""Sets the environment that the dashboard modules read when imported"""
+
+from os import environ as ENV
+
+ENV.setdefault("ACCESS_KEY", "test-access-key")
+ENV.setdefault("SECRET_ACCESS_KEY", "test-secret-access-key")
+ENV.setdefault("BUCKET_NAME", "test-bucket")
@@ -1,11 +1,12 @@
 """Creates dashboard with streamlit"""
 
 from os import environ as ENV
+from datetime import date, timedelta
 from dotenv import load_dotenv
-import pandas as pd
 import streamlit as st
-import utils
+import cache
 import charts
+import utils
 
 AWS_ACCESS_KEY = ENV["ACCESS_KEY"]
 AWS_SECRET_ACCESS_KEY = ENV["SECRET_ACCESS_KEY"]
@@ -17,24 +18,50 @@ if __name__ == "__main__":
 
     load_dotenv()
 
-    conn = utils.get_connection()
+    latest_readings = cache.load_latest_readings()
+    latest_readings_version = cache.get_data_version(latest_readings)
+    live_data = cache.load_live_data()
 
-    live_data = utils.get_live_data(conn)
-    live_data['timestamp'] = pd.to_datetime(live_data['timestamp'])
-
-    archived_data = utils.get_archived_data(
+    archived_data = cache.load_archived_data(
         str(AWS_ACCESS_KEY), str(AWS_SECRET_ACCESS_KEY))
 
-    archived_data['timestamp'] = pd.to_datetime(archived_data['timestamp'])
-
     st.title("🌴 LMNH Plant Health Tracker 🪷")
 
-    st.altair_chart(
-        charts.get_bar_chart_of_latest_temperature_per_plant(live_data))
+    st.vega_lite_chart(
+        cache.get_chart_spec("latest_temperature", latest_readings_version, latest_readings))
 
-    st.altair_chart(
-        charts.get_bar_chart_of_latest_soil_moisture_per_plant(live_data)
+    st.vega_lite_chart(
+        cache.get_chart_spec("latest_soil_moisture", latest_readings_version,
+                             latest_readings)
     )
 
+    st.subheader("Live Data")
+    st.caption(f"Readings from the last {cache.LIVE_DATA_WINDOW_IN_HOURS} hours.")
+    if live_data.empty:
+        st.info("No readings have been taken in this window.")
+    else:
+        st.dataframe(live_data)
+
+    st.subheader("Reading History")
+
+    history_measurement = st.radio("Measurement", ["temperature", "soil_moisture"],
+                                   horizontal=True)
+    history_dates = st.date_input(
+        "History window", (date.today() - timedelta(days=30), date.today()))
+
+    if len(history_dates) == 2:
+        resolution = utils.choose_rollup_resolution(*history_dates, charts.CHART_WIDTH)
+        try:
+            history = cache.load_reading_history(
+                str(AWS_ACCESS_KEY), str(AWS_SECRET_ACCESS_KEY), resolution, *history_dates)
+        except ValueError:
+            st.info("No reading history has been archived yet.")
+        else:
+            st.caption(f"Showing {resolution} rollups.")
+            st.vega_lite_chart(
+                cache.get_chart_spec(f"{history_measurement}_history",
+                                     f"{resolution}-{cache.get_data_version(history)}",
+                                     history))
+
     st.subheader("Archived Data")
     st.dataframe(archived_data)
@@ -0,0 +1,30 @@
+"""Contains the tests for the dashboard's shared connection and caches"""
+
+from unittest.mock import patch, MagicMock
+
+from pymssql import Error  # pylint: disable=no-name-in-module
+
+import cache
+
+
+def make_connection(healthy: bool) -> MagicMock:
+    """Returns a mock connection whose health check succeeds or fails"""
+    connection = MagicMock()
+    if not healthy:
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.side_effect = Error("connection reset")
+        connection.close.side_effect = Error("already closed")
+    return connection
+
+
+def test_stale_connection_is_closed_and_replaced():
+    """Tests that a stale shared connection is closed before the query reconnects"""
+    stale, fresh = make_connection(False), make_connection(True)
+    cache.get_shared_connection.clear()
+
+    with patch("utils.get_connection", side_effect=[stale, fresh]):
+        assert cache.run_with_connection(lambda connection: connection) is fresh
+        assert cache.run_with_connection(lambda connection: connection) is fresh
+
+    stale.close.assert_called_once()
+    cache.get_shared_connection.clear()
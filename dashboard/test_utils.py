@@ -0,0 +1,311 @@
+"""Contains the tests for the dashboard's data loading utilities"""
+
+from datetime import date, datetime
+from unittest.mock import MagicMock
+import io
+import os
+
+import pandas as pd
+import pytest
+
+import utils
+
+READING_HEADER = ("reading_id,soil_moisture,temperature,timestamp,plant_id,botanist_id,"
+                  "last_watered\n")
+
+
+def make_reading_csv(reading_id: int, timestamp: str) -> str:
+    """Returns an archived reading CSV holding a single reading"""
+    return READING_HEADER + f"{reading_id},50.0,12.5,{timestamp},1,1,2024-06-09 10:00:00\n"
+
+
+@pytest.fixture(name="bucket")
+def fixture_bucket(tmp_path, monkeypatch) -> dict:
+    """Points the local archive cache at a temporary folder, returning the fake
+    bucket's (ETag, body) pairs keyed by S3 key"""
+    monkeypatch.setattr(utils, "destination_path", str(tmp_path))
+    monkeypatch.setattr(utils, "parquet_reading_path", f"{tmp_path}/readings")
+    monkeypatch.setattr(utils, "cache_manifest_path", f"{tmp_path}/cache_manifest.json")
+    monkeypatch.setattr(utils, "reading_snapshot_path", f"{tmp_path}/reading_snapshot")
+    monkeypatch.setattr(utils, "rollup_path", f"{tmp_path}/rollups")
+    return {}
+
+
+def sync(bucket: dict, start_date: date = None, end_date: date = None,
+         prefixes: tuple[str, ...] = ("",)) -> dict:
+    """Downloads the fake bucket's objects, returning the cache manifest"""
+    s3_client = MagicMock()
+
+    def download_file(source_bucket, key, path):  # pylint: disable=unused-argument
+        body = bucket[key][1]
+        if isinstance(body, bytes):
+            with open(path, "wb") as local_file:
+                local_file.write(body)
+        else:
+            with open(path, "w", encoding="utf-8") as local_file:
+                local_file.write(body)
+
+    s3_client.download_file.side_effect = download_file
+    bucket_file_info = {"Contents": [{"Key": key, "ETag": etag, "LastModified": "2024-06-10"}
+                                     for key, (etag, _) in bucket.items()]}
+    return utils.download_archived_data(bucket_file_info, s3_client, "test-bucket",
+                                        start_date, end_date, prefixes)
+
+
+def test_download_keeps_changes_until_snapshot_uses_them(bucket):
+    """Tests that a later sync does not drop changes the snapshot has not seen"""
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(1, "2024-06-09 12:00:00"))
+
+    sync(bucket)
+    manifest = sync(bucket)
+
+    assert manifest["changed_keys"] == ["readings/10_06_2024/reading_data.csv"]
+
+    utils.load_reading_snapshot(manifest)
+
+    assert not utils.load_cache_manifest()["changed_keys"]
+
+
+def test_snapshot_appends_only_new_files(bucket):
+    """Tests that new reading files are appended to the snapshot as another part"""
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(1, "2024-06-09 12:00:00"))
+    utils.load_reading_snapshot(sync(bucket))
+
+    bucket["readings/11_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(2, "2024-06-10 12:00:00"))
+    readings = utils.load_reading_snapshot(sync(bucket))
+
+    assert sorted(readings["reading_id"]) == [1, 2]
+    assert len(os.listdir(utils.reading_snapshot_path)) == 2
+
+
+def test_snapshot_rebuilt_when_a_file_changes(bucket):
+    """Tests that a changed file replaces its old readings rather than adding to them"""
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(1, "2024-06-09 12:00:00"))
+    utils.load_reading_snapshot(sync(bucket))
+
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v2", make_reading_csv(3, "2024-06-09 12:00:00"))
+    readings = utils.load_reading_snapshot(sync(bucket))
+
+    assert list(readings["reading_id"]) == [3]
+
+
+def test_snapshot_rebuilt_when_a_file_is_removed(bucket):
+    """Tests that readings of a file removed from the bucket leave the snapshot"""
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(1, "2024-06-09 12:00:00"))
+    bucket["readings/11_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(2, "2024-06-10 12:00:00"))
+    utils.load_reading_snapshot(sync(bucket))
+
+    del bucket["readings/10_06_2024/reading_data.csv"]
+    readings = utils.load_reading_snapshot(sync(bucket))
+
+    assert list(readings["reading_id"]) == [2]
+
+
+def test_snapshot_reads_only_the_date_window(bucket):
+    """Tests that the date window is applied when reading the snapshot"""
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(1, "2024-06-09 12:00:00"))
+    bucket["readings/11_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(2, "2024-06-10 12:00:00"))
+
+    readings = utils.load_reading_snapshot(sync(bucket), date(2024, 6, 10), date(2024, 6, 10))
+
+    assert list(readings["reading_id"]) == [2]
+
+
+def test_snapshot_without_readings(bucket):
+    """Tests that an empty archive gives an empty typed frame"""
+    readings = utils.load_reading_snapshot(sync(bucket))
+
+    assert readings.empty
+    assert readings["temperature"].dtype == "float32"
+
+
+def get_dimension_rows() -> list[list[dict]]:
+    """Returns the plant and botanist rows that the dimension queries answer with"""
+    return [
+        [{"plant_id": 1, "name": "Rafflesia", "scientific_name": "R. arnoldii",
+          "latitude": 1.5, "longitude": 103.8, "town_name": "Singapore",
+          "tz_identifier": "Asia/Singapore", "country_code": "SG"}],
+        [{"botanist_id": 1, "first_name": "Carl", "last_name": "Linnaeus",
+          "email": "carl.linnaeus@lnhm.co.uk", "phone": "001"}],
+    ]
+
+
+def make_live_connection(version: int, readings: list[dict]) -> tuple[MagicMock, MagicMock]:
+    """Returns a mock connection and its cursor, answering the dimension version,
+    dimension and reading queries in the order get_live_data sends them"""
+    connection = MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.fetchone.return_value = {"plant": version, "botanist": version}
+    cursor.fetchall.side_effect = get_dimension_rows() + [readings]
+    return connection, cursor
+
+
+LIVE_READING = {"plant_id": 1, "botanist_id": 1, "soil_moisture": 50.0,
+                "temperature": 12.5, "timestamp": datetime(2024, 6, 10, 12),
+                "last_watered": datetime(2024, 6, 10, 9)}
+
+
+def test_live_data_fetches_window_and_joins_dimensions(monkeypatch):
+    """Tests that only readings in the window are queried and joined by id"""
+    monkeypatch.setattr(utils, "dimension_cache",
+                        {"version": None, "plants": None, "botanists": None})
+    connection, cursor = make_live_connection(1, [LIVE_READING])
+    start_time = datetime(2024, 6, 9, 12)
+
+    live_data = utils.get_live_data(connection, start_time)
+
+    query, params = cursor.execute.call_args.args
+    assert "WHERE timestamp >= %s" in query
+    assert params == (start_time,)
+    assert live_data.loc[0, "name"] == "Rafflesia"
+    assert live_data.loc[0, "email"] == "carl.linnaeus@lnhm.co.uk"
+    assert live_data["temperature"].dtype == "float32"
+    assert "plant_id" not in live_data
+
+
+def test_live_data_empty_window(monkeypatch):
+    """Tests that a window without readings gives an empty frame rather than an error"""
+    monkeypatch.setattr(utils, "dimension_cache",
+                        {"version": None, "plants": None, "botanists": None})
+    connection, _ = make_live_connection(1, [])
+
+    assert utils.get_live_data(connection, datetime(2024, 6, 9, 12)).empty
+
+
+def test_dimension_tables_cached_until_they_change(monkeypatch):
+    """Tests that dimension tables are only fetched again when their checksums change"""
+    monkeypatch.setattr(utils, "dimension_cache",
+                        {"version": None, "plants": None, "botanists": None})
+    connection, cursor = make_live_connection(1, [])
+
+    plants, _ = utils.get_dimension_tables(connection)
+    assert utils.get_dimension_tables(connection)[0] is plants
+    assert cursor.fetchall.call_count == 2
+
+    cursor.fetchone.return_value = {"plant": 2, "botanist": 2}
+    cursor.fetchall.side_effect = get_dimension_rows()
+    assert utils.get_dimension_tables(connection)[0] is not plants
+
+
+def make_listing_client(bucket: dict, page_size: int = 1000) -> MagicMock:
+    """Returns a mock S3 client that lists the fake bucket's keys in order, one page
+    at a time, honouring Prefix and StartAfter as list_objects_v2 does. The keys of
+    every page fetched are kept in listed_keys."""
+    s3_client = MagicMock()
+    s3_client.listed_keys = []
+
+    def paginate(Bucket, Prefix, StartAfter=""):  # pylint: disable=invalid-name,unused-argument
+        files = [{"Key": key, "ETag": etag, "LastModified": "2024-06-10"}
+                 for key, (etag, _) in sorted(bucket.items())
+                 if key.startswith(Prefix) and key > StartAfter]
+        for start in range(0, len(files), page_size):
+            page = files[start:start + page_size]
+            s3_client.listed_keys += [file["Key"] for file in page]
+            yield {"Contents": page}
+
+    s3_client.get_paginator.return_value.paginate.side_effect = paginate
+    return s3_client
+
+
+def test_listing_skips_keys_outside_the_date_window(bucket):
+    """Tests that date-partitioned folders are listed from the start date and stop
+    at the end date, while legacy folders are listed one archive day at a time"""
+    for day in range(1, 31):
+        bucket[f"readings/date=2024-06-{day:02}/1_reading_data.parquet"] = ("v1", "")
+        bucket[f"readings/{day:02}_06_2024/reading_data.csv"] = ("v1", "")
+        bucket[f"rollups/5min/date=2024-06-{day:02}/1_reading_data.parquet"] = ("v1", "")
+    bucket["metadata/plant_data.csv"] = ("v1", "")
+    s3_client = make_listing_client(bucket, page_size=5)
+    paginate = s3_client.get_paginator.return_value.paginate
+
+    bucket_file_info = utils.get_bucket_file_info(s3_client, "test-bucket",
+                                                  date(2024, 6, 10), date(2024, 6, 11))
+
+    assert sorted(file["Key"] for file in bucket_file_info["Contents"]) == [
+        "metadata/plant_data.csv",
+        "readings/10_06_2024/reading_data.csv",
+        "readings/11_06_2024/reading_data.csv",
+        "readings/12_06_2024/reading_data.csv",
+        "readings/date=2024-06-10/1_reading_data.parquet",
+        "readings/date=2024-06-11/1_reading_data.parquet",
+        "rollups/5min/date=2024-06-10/1_reading_data.parquet",
+        "rollups/5min/date=2024-06-11/1_reading_data.parquet",
+    ]
+    assert "readings/date=2024-06-30/1_reading_data.parquet" not in s3_client.listed_keys
+    assert "rollups/5min/date=2024-06-01/1_reading_data.parquet" not in s3_client.listed_keys
+    listed_prefixes = [call.kwargs["Prefix"] for call in paginate.call_args_list]
+    assert "readings/" not in listed_prefixes
+    assert "readings/10_06_2024/" in listed_prefixes
+    assert paginate.call_args_list[listed_prefixes.index("readings/date=")].kwargs[
+        "StartAfter"] == "readings/date=2024-06-10"
+
+
+def test_history_sync_leaves_readings_alone(bucket):
+    """Tests that syncing the history only lists and downloads rollups and metadata,
+    keeping the cached readings it did not list"""
+    bucket["readings/10_06_2024/reading_data.csv"] = (
+        "v1", make_reading_csv(1, "2024-06-09 12:00:00"))
+    sync(bucket)
+
+    s3_client = make_listing_client(bucket)
+    bucket_file_info = utils.get_bucket_file_info(s3_client, "test-bucket",
+                                                  prefixes=utils.history_prefixes)
+    manifest = utils.download_archived_data(bucket_file_info, s3_client, "test-bucket",
+                                            prefixes=utils.history_prefixes)
+
+    assert not bucket_file_info["Contents"]
+    s3_client.download_file.assert_not_called()
+    assert "readings/10_06_2024/reading_data.csv" in manifest["objects"]
+
+
+METADATA_TABLES = {
+    "plant": "plant_id,name,location_id\n1,Rafflesia,1\n",
+    "location": "location_id,town_id\n1,1\n",
+    "town": "town_id,timezone_id,country_id,town_name\n1,1,1,Singapore\n",
+    "timezone": "timezone_id,tz_identifier\n1,Asia/Singapore\n",
+    "country": "country_id,country_code\n1,SG\n",
+    "botanist": "botanist_id,email\n1,carl.linnaeus@lnhm.co.uk\n",
+}
+
+
+def make_rollup_parquet(reading_count: int, temperature: float) -> bytes:
+    """Returns a 5min rollup object holding one bucket of plant 1 with the given
+    number of readings, all at the given temperature"""
+    rollup = {"plant_id": [1], "timestamp": [pd.Timestamp("2024-06-10 12:00")],
+              "reading_count": [reading_count]}
+    for measurement, value in (("temperature", temperature), ("soil_moisture", 50.0)):
+        rollup |= {f"{measurement}_min": [value], f"{measurement}_max": [value],
+                   f"{measurement}_sum": [value * reading_count],
+                   f"{measurement}_mean": [value]}
+
+    buffer = io.BytesIO()
+    pd.DataFrame(rollup).astype({"plant_id": "int16", "reading_count": "int32",
+                                 "timestamp": "datetime64[s]"}).to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def test_reuploaded_rollup_chunk_replaces_earlier_rollups(bucket):
+    """Tests that a chunk re-uploaded under the same name replaces its rollups
+    rather than being counted twice"""
+    for table, rows in METADATA_TABLES.items():
+        bucket[f"metadata/{table}_data.csv"] = ("v1", rows)
+    key = "rollups/5min/date=2024-06-10/1_reading_data.parquet"
+
+    bucket[key] = ("v1", make_rollup_parquet(2, 12.0))
+    sync(bucket, prefixes=utils.history_prefixes)
+    bucket[key] = ("v2", make_rollup_parquet(3, 15.0))
+    sync(bucket, prefixes=utils.history_prefixes)
+
+    history = utils.read_rollups("5min", date(2024, 6, 10), date(2024, 6, 10))
+
+    assert history[["name", "reading_count", "temperature_mean"]].to_dict("records") == [
+        {"name": "Rafflesia", "reading_count": 3, "temperature_mean": 15.0}]
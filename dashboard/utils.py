@@ -1,6 +1,11 @@
 from os import environ as ENV
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 import os
+import json
+import shutil
 import pandas as pd
+import pyarrow.dataset as ds
 from pymssql import connect, Connection, exceptions  # pylint: disable=no-name-in-module
 from dotenv import load_dotenv
 import boto3
@@ -12,6 +17,37 @@ AWS_ACCESS_KEY = ENV["ACCESS_KEY"]
 AWS_SECRET_ACCESS_KEY = ENV["SECRET_ACCESS_KEY"]
 source_bucket = ENV["BUCKET_NAME"]
 destination_path = "./data"
+parquet_reading_path = f"{destination_path}/readings"
+cache_manifest_path = f"{destination_path}/cache_manifest.json"
+reading_snapshot_path = f"{destination_path}/reading_snapshot"
+rollup_path = f"{destination_path}/rollups"
+rollup_resolutions = {
+    "5min": timedelta(minutes=5),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+archive_prefixes = ("metadata/", "readings/", "rollups/")
+# The history view only reads rollups and the metadata that names the plants.
+history_prefixes = ("metadata/", "rollups/")
+download_workers = 16
+reading_dtypes = {
+    "reading_id": "int64",
+    "soil_moisture": "float32",
+    "temperature": "float32",
+    "timestamp": "datetime64[s]",
+    "plant_id": "int16",
+    "botanist_id": "int16",
+    "last_watered": "datetime64[s]",
+}
+live_reading_dtypes = {
+    "plant_id": "int16",
+    "botanist_id": "int16",
+    "soil_moisture": "float32",
+    "temperature": "float32",
+    "timestamp": "datetime64[s]",
+    "last_watered": "datetime64[s]",
+}
+dimension_cache = {"version": None, "plants": None, "botanists": None}
 
 
 def create_s3_client(access_key: str, secret_access_key: str) -> boto3.client:
@@ -26,74 +62,407 @@ def create_s3_client(access_key: str, secret_access_key: str) -> boto3.client:
         raise RuntimeError(f"Error creating S3 client: {e}") from e
 
 
-def get_bucket_file_info(s3_client: boto3.client, source_bucket: str) -> dict:
+def get_date_folder(key: str) -> str | None:
+    """Returns the folder that dates an archived reading or rollup object, or None
+        for metadata."""
+
+    parts = key.split("/")
+
+    if len(parts) < 3 or parts[0] not in ("readings", "rollups"):
+        return None
+
+    return next((part for part in parts[1:-1] if part.startswith("date=")), parts[1])
+
+
+def get_archive_date(key: str) -> date | None:
+    """Returns the date of an archived reading or rollup object from its folder,
+        which is either the reading date (date=YYYY-MM-DD/) or the day it was
+        archived (readings/dd_mm_yyyy/)."""
+
+    date_folder = get_date_folder(key)
+
+    if date_folder is None:
+        return None
+
+    try:
+        if date_folder.startswith("date="):
+            return date.fromisoformat(date_folder.removeprefix("date="))
+        return datetime.strptime(date_folder, "%d_%m_%Y").date()
+    except ValueError:
+        return None
+
+
+def is_in_date_window(key: str, start_date: date = None, end_date: date = None) -> bool:
+    """Checks whether an object is needed for readings between the given dates.
+        Metadata is always needed. Folders named after the archive day hold the
+        readings of the days before, so they are included up to a day after end_date."""
+
+    archive_date = get_archive_date(key)
+
+    if archive_date is None:
+        return True
+
+    if not get_date_folder(key).startswith("date=") and end_date:
+        end_date += timedelta(days=1)
+
+    return ((start_date is None or archive_date >= start_date)
+            and (end_date is None or archive_date <= end_date))
+
+
+def get_listing_ranges(archive_prefix: str, start_date: date = None,
+                       end_date: date = None) -> list[tuple[str, str, str]]:
+    """Returns the (prefix, start after, stop at) key ranges to list for an archive
+        folder so that only objects in the date window are listed. Date-partitioned
+        folders sort by date, so the window maps to one key range. Folders named
+        after the archive day (dd_mm_yyyy) do not sort by date, so each day in the
+        window is listed on its own, or every one is listed without a full window."""
+
+    if archive_prefix == "metadata/":
+        return [(archive_prefix, "", None)]
+
+    if archive_prefix == "rollups/":
+        date_folders = [f"{archive_prefix}{resolution}/" for resolution in rollup_resolutions]
+        legacy_ranges = []
+    elif start_date and end_date:
+        date_folders = [archive_prefix]
+        legacy_ranges = [(f"{archive_prefix}{start_date + timedelta(days=day):%d_%m_%Y}/", "", None)
+                         for day in range((end_date - start_date).days + 2)]
+    else:
+        date_folders = [archive_prefix]
+        legacy_ranges = [(archive_prefix, "", f"{archive_prefix}date=")]
+
+    date_ranges = [(f"{folder}date=",
+                    f"{folder}date={start_date}" if start_date else "",
+                    f"{folder}date={end_date + timedelta(days=1)}" if end_date else None)
+                   for folder in date_folders]
+    return legacy_ranges + date_ranges
+
+
+def list_key_range(s3_client: boto3.client, source_bucket: str, prefix: str,
+                   start_after: str = "", stop_at: str = None) -> list[dict]:
+    """Lists the objects under a prefix with keys after start_after and before stop_at,
+        following pages only until the range ends."""
+
+    paginator = s3_client.get_paginator("list_objects_v2")
+    arguments = {"Bucket": source_bucket, "Prefix": prefix}
+    if start_after:
+        arguments["StartAfter"] = start_after
+
+    files = []
+    for page in paginator.paginate(**arguments):
+        for file in page.get("Contents", []):
+            if stop_at and file["Key"] >= stop_at:
+                return files
+            files.append(file)
+
+    return files
+
+
+def get_bucket_file_info(s3_client: boto3.client, source_bucket: str,
+                         start_date: date = None, end_date: date = None,
+                         prefixes: tuple[str, ...] = ("",)) -> dict:
     """
-    Retrieves information on the files in an s3 bucket.
+    Retrieves information on the files in an s3 bucket under the given prefixes,
+    only listing metadata and the key ranges of objects in the given date window.
     """
+    listing_ranges = [listing_range
+                      for archive_prefix in archive_prefixes
+                      if archive_prefix.startswith(prefixes)
+                      for listing_range in get_listing_ranges(archive_prefix,
+                                                              start_date, end_date)]
     try:
-        return s3_client.list_objects_v2(Bucket=source_bucket)
+        contents = [file
+                    for listing_range in listing_ranges
+                    for file in list_key_range(s3_client, source_bucket, *listing_range)
+                    if is_in_date_window(file["Key"], start_date, end_date)]
     except botocore.exceptions.ClientError as e:
         raise RuntimeError(
             f"Error retrieving files from the S3 bucket: {e}") from e
 
+    return {"Contents": contents}
+
+
+def get_local_path(key: str) -> str | None:
+    """Returns where an archived object is stored locally, or None for folders."""
+
+    filename = key.split("/")[-1]
+
+    if not filename:
+        return None
+
+    if key.startswith("metadata/"):
+        return f"{destination_path}/{filename}"
+
+    if key.startswith(("readings/", "rollups/")) and filename.endswith(".parquet"):
+        return os.path.join(destination_path, key)
+
+    if key.startswith("readings/"):
+        date = key.split("/")[1]
+        return f"{destination_path}/{date}-{filename}"
+
+    return None
+
+
+def load_cache_manifest() -> dict:
+    """Loads the record of which object versions are already downloaded."""
+
+    if not os.path.exists(cache_manifest_path):
+        return {"objects": {}, "snapshot_keys": []}
+
+    with open(cache_manifest_path, encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
 
-def download_archived_data(bucket_file_info: dict, s3_client: boto3.client, source_bucket: str) -> None:
-    """Downloads all the archived reading data and metadata from the S3 Bucket."""
+
+def save_cache_manifest(manifest: dict) -> None:
+    """Saves the record of which object versions are already downloaded."""
+
+    with open(cache_manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file)
+
+
+def is_cached(file: dict, cached_object: dict | None) -> bool:
+    """Checks whether the local copy of an object matches its ETag and LastModified."""
+
+    return (cached_object is not None
+            and cached_object["etag"] == file.get("ETag")
+            and cached_object["last_modified"] == str(file.get("LastModified"))
+            and os.path.exists(cached_object["path"]))
+
+
+def download_files(s3_client: boto3.client, source_bucket: str, downloads: dict) -> None:
+    """Downloads each key to its local path on a bounded pool of threads."""
+
+    def download_file(key: str) -> None:
+        os.makedirs(os.path.dirname(downloads[key]), exist_ok=True)
+        s3_client.download_file(source_bucket, key, downloads[key])
+
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        list(executor.map(download_file, downloads))
+
+
+def download_archived_data(bucket_file_info: dict, s3_client: boto3.client,
+                           source_bucket: str, start_date: date = None,
+                           end_date: date = None, prefixes: tuple[str, ...] = ("",)) -> dict:
+    """Downloads the archived reading data and metadata from the S3 Bucket in parallel,
+        skipping objects whose ETag and LastModified match the local cache. Only the
+        cached objects inside the date window and under the listed prefixes are
+        checked for removal. Returns the
+        updated cache manifest with the keys that changed or were removed since the
+        reading snapshot last caught up with them."""
+
+    os.makedirs(destination_path, exist_ok=True)
+    manifest = load_cache_manifest()
+    cached_objects = manifest["objects"]
+    bucket_objects = {key: cached_object for key, cached_object in cached_objects.items()
+                      if not (key.startswith(prefixes)
+                              and is_in_date_window(key, start_date, end_date))}
+    listed_keys = set()
+    downloads = {}
 
     for file in bucket_file_info.get("Contents", []):
 
-        filename_and_folder = file.get("Key", "")
-        filename = filename_and_folder.split("/")[-1]
+        key = file.get("Key", "")
+        local_path = get_local_path(key)
 
-        if not filename:
+        if not local_path:
             continue
 
-        if filename_and_folder.startswith("metadata/"):
-            s3_client.download_file(source_bucket, filename_and_folder, f"{
-                                    destination_path}/{filename}")
+        listed_keys.add(key)
+        bucket_objects[key] = {"etag": file.get("ETag"),
+                               "last_modified": str(file.get("LastModified")),
+                               "path": local_path}
+
+        if not is_cached(file, cached_objects.get(key)):
+            downloads[key] = local_path
+
+    download_files(s3_client, source_bucket, downloads)
+    changed_keys = list(downloads)
+
+    removed_keys = [key for key in cached_objects if key not in bucket_objects]
+    for key in removed_keys:
+        if os.path.exists(cached_objects[key]["path"]):
+            os.remove(cached_objects[key]["path"])
+
+    reused_count = len(listed_keys) - len(changed_keys)
+    print(f"Archive cache: {len(changed_keys)} downloaded, {reused_count} reused, "
+          f"{len(removed_keys)} removed.")
+
+    manifest["objects"] = bucket_objects
+    manifest["changed_keys"] = sorted(set(manifest.get("changed_keys", [])) | set(changed_keys))
+    manifest["removed_keys"] = sorted(set(manifest.get("removed_keys", [])) | set(removed_keys))
+    save_cache_manifest(manifest)
+    return manifest
+
+
+def read_reading_object(local_path: str) -> pd.DataFrame:
+    """Reads a single archived reading file, restoring any parquet partition columns."""
+
+    if local_path.endswith(".parquet"):
+        readings = ds.dataset([local_path], format="parquet", partitioning="hive",
+                              partition_base_dir=parquet_reading_path).to_table().to_pandas()
+    else:
+        readings = pd.read_csv(local_path, parse_dates=["timestamp", "last_watered"])
+
+    return readings[list(reading_dtypes)].astype(reading_dtypes)
+
 
-        if filename_and_folder.startswith("readings/"):
-            date = filename_and_folder.split("/")[1]
-            s3_client.download_file(source_bucket, filename_and_folder, f"{
-                                    destination_path}/{date}-{filename}")
+def load_reading_snapshot(manifest: dict, start_date: date = None,
+                          end_date: date = None) -> pd.DataFrame:
+    """Returns the archived readings taken between the optional dates from the
+        pre-merged snapshot on disk, appending only the reading files it does not
+        contain yet. The snapshot is rebuilt if a file it contains has changed or
+        been removed, after which the pending changes are cleared."""
 
+    reading_keys = sorted(key for key in manifest["objects"] if key.startswith("readings/"))
+    snapshot_keys = set(manifest.get("snapshot_keys", []))
+    stale_keys = snapshot_keys & set(manifest.get("changed_keys", [])
+                                     + manifest.get("removed_keys", []))
 
-def merge_reading_files() -> pd.DataFrame:
-    """Merges the reading CSVs into a single DataFrame."""
+    if (stale_keys or manifest.get("snapshot_dtypes") != reading_dtypes
+            or not os.path.isdir(reading_snapshot_path)):
+        shutil.rmtree(reading_snapshot_path, ignore_errors=True)
+        os.makedirs(reading_snapshot_path)
+        snapshot_keys = set()
 
-    reading_dfs = []
+    new_keys = [key for key in reading_keys if key not in snapshot_keys]
+    if new_keys:
+        new_readings = pd.concat([read_reading_object(manifest["objects"][key]["path"])
+                                  for key in new_keys], ignore_index=True)
+        part_number = len(os.listdir(reading_snapshot_path))
+        new_readings.to_parquet(f"{reading_snapshot_path}/part-{part_number:05d}.parquet",
+                                index=False)
 
-    for filename in os.listdir(destination_path):
-        if filename.endswith("reading_data.csv"):
-            file_path = os.path.join(destination_path, filename)
-            df = pd.read_csv(file_path)
-            reading_dfs.append(df)
+    manifest["snapshot_keys"] = sorted(snapshot_keys | set(new_keys))
+    manifest["snapshot_dtypes"] = reading_dtypes
+    manifest["changed_keys"] = []
+    manifest["removed_keys"] = []
+    save_cache_manifest(manifest)
 
-    joined_reading_dfs = pd.concat(reading_dfs, ignore_index=True)
-    return joined_reading_dfs
+    print(f"Reading snapshot: {len(new_keys)} files appended.")
+
+    if not manifest["snapshot_keys"]:
+        return pd.DataFrame(columns=list(reading_dtypes)).astype(reading_dtypes)
+
+    filters = []
+    if start_date:
+        filters.append(("timestamp", ">=", pd.Timestamp(start_date)))
+    if end_date:
+        filters.append(("timestamp", "<", pd.Timestamp(end_date + timedelta(days=1))))
+
+    return pd.read_parquet(reading_snapshot_path, engine="pyarrow", filters=filters or None)
+
+
+def categorise_dimension(dimension: pd.DataFrame) -> pd.DataFrame:
+    """Stores a dimension table's repeated strings as categoricals and its
+        coordinates as floats."""
+    for column in dimension.columns:
+        if column in ("latitude", "longitude"):
+            dimension[column] = dimension[column].astype("float32")
+        else:
+            dimension[column] = dimension[column].astype("category")
+    return dimension
+
+
+def to_dimension_frame(rows: list[dict], index: str) -> pd.DataFrame:
+    """Builds a dimension table from query rows, indexed by its id."""
+    return categorise_dimension(pd.DataFrame(rows).set_index(index))
+
+
+def join_dimensions(readings: pd.DataFrame, plants: pd.DataFrame,
+                    botanists: pd.DataFrame) -> pd.DataFrame:
+    """Adds plant and botanist attributes to the readings by indexed lookup on
+        their ids, without merging copies of the reading frame, and drops the ids."""
+    joined = readings.drop(columns=["reading_id", "plant_id", "botanist_id"],
+                           errors="ignore")
+
+    for dimension, key in ((plants, "plant_id"), (botanists, "botanist_id")):
+        ids = readings[key].to_numpy()
+        for column in dimension.columns:
+            joined[column] = dimension[column].reindex(ids).array
+
+    return joined
+
+
+def read_metadata_table(table: str) -> pd.DataFrame:
+    """Reads a downloaded metadata CSV, indexed by its id column."""
+    return pd.read_csv(f'{destination_path}/{table}_data.csv', index_col=f'{table}_id')
+
+
+def get_archived_dimension_tables() -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Builds the plant and botanist dimension tables from the downloaded metadata
+        CSVs. Only these small tables are joined, never the readings."""
+
+    plants = (read_metadata_table('plant')
+              .join(read_metadata_table('location'), on='location_id')
+              .join(read_metadata_table('town'), on='town_id')
+              .join(read_metadata_table('timezone'), on='timezone_id')
+              .join(read_metadata_table('country'), on='country_id')
+              .drop(columns=['location_id', 'town_id', 'timezone_id', 'country_id']))
+
+    return categorise_dimension(plants), categorise_dimension(read_metadata_table('botanist'))
 
 
 def merge_metadata_with_reading(readings: pd.DataFrame) -> pd.DataFrame:
-    """Merges metadata CSVs with the reading DataFrame."""
+    """Merges metadata CSVs with the reading DataFrame by indexed lookup, keeping
+        repeated attributes as categoricals."""
+    plants, botanists = get_archived_dimension_tables()
+    return join_dimensions(readings, plants, botanists)
+
+
+def choose_rollup_resolution(start_date: date, end_date: date, chart_width: int) -> str:
+    """Returns the finest rollup resolution that gives each plant no more points
+        than the chart is wide in pixels."""
+
+    window = end_date - start_date + timedelta(days=1)
+
+    for resolution, interval in rollup_resolutions.items():
+        if window / interval <= chart_width:
+            return resolution
 
-    country_df = pd.read_csv(f'{destination_path}/country_data.csv')
-    timezone_df = pd.read_csv(f'{destination_path}/timezone_data.csv')
-    town_df = pd.read_csv(f'{destination_path}/town_data.csv')
-    botanist_df = pd.read_csv(f'{destination_path}/botanist_data.csv')
-    location_df = pd.read_csv(f'{destination_path}/location_data.csv')
-    plant_df = pd.read_csv(f'{destination_path}/plant_data.csv')
+    return list(rollup_resolutions)[-1]
 
-    merged_df = pd.merge(readings, plant_df, on='plant_id', how='left')
-    merged_df = pd.merge(merged_df, location_df, on='location_id', how='left')
-    merged_df = pd.merge(merged_df, town_df, on='town_id', how='left')
-    merged_df = pd.merge(merged_df, timezone_df, on='timezone_id', how='left')
-    merged_df = pd.merge(merged_df, country_df, on='country_id', how='left')
-    merged_df = pd.merge(merged_df, botanist_df, on='botanist_id', how='left')
 
-    merged_df.drop(['location_id', 'town_id', 'plant_id',
-                   'timezone_id', 'country_id', 'botanist_id', 'reading_id'], inplace=True, axis=1)
+def combine_rollups(rollups: pd.DataFrame) -> pd.DataFrame:
+    """Combines rollup rows of the same plant and bucket, which are split when a
+        bucket spans two archived chunks, and recomputes their means."""
 
-    return merged_df
+    aggregations = {"reading_count": "sum"}
+    for measurement in ("temperature", "soil_moisture"):
+        aggregations |= {f"{measurement}_min": "min", f"{measurement}_max": "max",
+                         f"{measurement}_sum": "sum"}
+
+    combined = rollups.groupby(["plant_id", "timestamp"], as_index=False,
+                               sort=False).agg(aggregations)
+
+    for measurement in ("temperature", "soil_moisture"):
+        combined[f"{measurement}_mean"] = (combined[f"{measurement}_sum"]
+                                           / combined["reading_count"])
+
+    return combined.drop(columns=["temperature_sum", "soil_moisture_sum"])
+
+
+def read_rollups(resolution: str, start_date: date = None,
+                 end_date: date = None) -> pd.DataFrame:
+    """Reads the downloaded rollups of a resolution between the optional dates,
+        naming each plant."""
+
+    resolution_path = f"{rollup_path}/{resolution}"
+
+    if not os.path.isdir(resolution_path):
+        raise ValueError(f"No {resolution} rollups have been archived")
+
+    filters = []
+    if start_date:
+        filters.append(("timestamp", ">=", pd.Timestamp(start_date)))
+    if end_date:
+        filters.append(("timestamp", "<", pd.Timestamp(end_date + timedelta(days=1))))
+
+    rollups = pd.read_parquet(resolution_path, engine="pyarrow", filters=filters or None)
+    history = combine_rollups(rollups.drop(columns="date", errors="ignore"))
+
+    plants, _ = get_archived_dimension_tables()
+    history["name"] = plants["name"].reindex(history["plant_id"].to_numpy()).array
+    return history.sort_values("timestamp", ignore_index=True)
 
 
 def get_connection() -> Connection:
@@ -115,51 +484,159 @@ def get_connection() -> Connection:
             f"Error connecting to database: {e}") from e
 
 
-def get_live_data(connection: Connection) -> pd.DataFrame:
-    """Retrieves plant data from the database, returning it as
-        a Pandas DataFrame."""
+def get_dimension_version(connection: Connection) -> tuple:
+    """Returns checksums of the dimension tables, which change whenever their rows do."""
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+                       SELECT
+                           (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM delta.country) AS country,
+                           (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM delta.timezone) AS timezone,
+                           (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM delta.town) AS town,
+                           (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM delta.location) AS location,
+                           (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM delta.plant) AS plant,
+                           (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM delta.botanist) AS botanist
+                       """)
+        return tuple(cursor.fetchone().values())
+
+
+def get_dimension_tables(connection: Connection) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Returns the plant and botanist dimension tables, only querying them again
+        when their checksums show that they have changed."""
+
+    version = get_dimension_version(connection)
+    if dimension_cache["version"] == version:
+        return dimension_cache["plants"], dimension_cache["botanists"]
+
+    print("Fetching dimension tables...")
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+                       SELECT p.plant_id, p.name, p.scientific_name, l.latitude, l.longitude,
+                           t.town_name, tz.tz_identifier, c.country_code
+                       FROM delta.plant AS p
+                       JOIN delta.location AS l ON p.location_id = l.location_id
+                       JOIN delta.town AS t ON l.town_id = t.town_id
+                       JOIN delta.timezone AS tz ON t.timezone_id = tz.timezone_id
+                       JOIN delta.country AS c ON t.country_id = c.country_id
+                       """)
+        plants = to_dimension_frame(cursor.fetchall(), "plant_id")
+
+        cursor.execute("""
+                       SELECT botanist_id, first_name, last_name, email, phone
+                       FROM delta.botanist
+                       """)
+        botanists = to_dimension_frame(cursor.fetchall(), "botanist_id")
+
+    dimension_cache.update(version=version, plants=plants, botanists=botanists)
+    return plants, botanists
+
+
+def get_live_data(connection: Connection, start_time: datetime = None,
+                  end_time: datetime = None) -> pd.DataFrame:
+    """Retrieves readings taken between the optional start and end times as narrow
+        typed columns, joins them locally with the cached dimension tables and
+        returns them as a Pandas DataFrame, which is empty if no readings were taken
+        in the window. The connection is left open for reuse."""
 
     print("Fetching live data...")
 
     try:
+        plants, botanists = get_dimension_tables(connection)
+
+        conditions, params = [], []
+        if start_time:
+            conditions.append("timestamp >= %s")
+            params.append(start_time)
+        if end_time:
+            conditions.append("timestamp < %s")
+            params.append(end_time)
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
         with connection.cursor() as cursor:
 
-            query = """
-                    SELECT *
-                    FROM delta.country AS c
-                    JOIN delta.town AS t ON c.country_id = t.country_id
-                    JOIN delta.timezone AS tz ON t.timezone_id = tz.timezone_id
-                    JOIN delta.location AS l ON t.town_id = l.town_id
-                    JOIN delta.plant AS p ON l.location_id = p.location_id
-                    JOIN delta.reading AS r ON p.plant_id = r.plant_id
-                    JOIN delta.botanist AS b ON r.botanist_id = b.botanist_id
+            query = f"""
+                    SELECT plant_id, botanist_id, soil_moisture, temperature,
+                        timestamp, last_watered
+                    FROM delta.reading
+                    {where_clause}
                     """
-            cursor.execute(query)
+            cursor.execute(query, tuple(params))
             data = cursor.fetchall()
 
-        if not data:
-            raise ValueError("No reading data found in the database")
-
-        reading_data = pd.DataFrame(data)
-
-        reading_data.drop(['location_id', 'town_id', 'plant_id',
-                           'timezone_id', 'country_id', 'botanist_id', 'reading_id'], inplace=True, axis=1)
-        return reading_data
+        readings = pd.DataFrame(data, columns=list(live_reading_dtypes))
+        return join_dimensions(readings.astype(live_reading_dtypes), plants, botanists)
     except Exception as e:
         raise Exception(f"Error: {e}") from e
-    finally:
-        connection.close()
 
 
-def get_archived_data(aws_access_key: str, aws_secret_access_key: str) -> pd.DataFrame:
+def get_latest_readings(connection: Connection) -> pd.DataFrame:
+    """Retrieves only the latest reading of each plant from the database, seeking
+        the (plant_id, timestamp) index once per plant, and returns it as a
+        Pandas DataFrame with one row per plant name."""
+
+    print("Fetching latest readings...")
+
+    with connection.cursor() as cursor:
+
+        query = """
+                WITH latest_reading AS (
+                    SELECT p.name, r.temperature, r.soil_moisture, r.timestamp, r.last_watered,
+                        ROW_NUMBER() OVER (PARTITION BY p.name ORDER BY r.timestamp DESC)
+                            AS name_rank
+                    FROM delta.plant AS p
+                    CROSS APPLY (
+                        SELECT TOP 1 temperature, soil_moisture, timestamp, last_watered
+                        FROM delta.reading
+                        WHERE plant_id = p.plant_id
+                        ORDER BY timestamp DESC
+                    ) AS r
+                )
+                SELECT name, temperature, soil_moisture, timestamp, last_watered
+                FROM latest_reading
+                WHERE name_rank = 1
+                ORDER BY name
+                """
+        cursor.execute(query)
+        data = cursor.fetchall()
+
+    if not data:
+        raise ValueError("No reading data found in the database")
+
+    latest_readings = pd.DataFrame(data)
+    latest_readings['timestamp'] = pd.to_datetime(latest_readings['timestamp'])
+    return latest_readings
+
+
+def get_archived_data(aws_access_key: str, aws_secret_access_key: str,
+                      start_date: date = None, end_date: date = None) -> pd.DataFrame:
     """Downloads the archived data files from S3 bucket, merges them, and returns
-        as a Pandas DataFrame."""
+        as a Pandas DataFrame. Only readings taken between the optional start and
+        end dates are fetched and returned."""
 
     print("Fetching and processing archived data...")
 
     s3 = create_s3_client(aws_access_key, aws_secret_access_key)
-    bucket_file_info = get_bucket_file_info(s3, source_bucket)
+    bucket_file_info = get_bucket_file_info(s3, source_bucket, start_date, end_date)
+
+    manifest = download_archived_data(bucket_file_info, s3, source_bucket,
+                                      start_date, end_date)
+    reading_data = load_reading_snapshot(manifest, start_date, end_date)
 
-    download_archived_data(bucket_file_info, s3, source_bucket)
-    reading_data = merge_reading_files()
     return merge_metadata_with_reading(reading_data)
+
+
+def get_reading_history(aws_access_key: str, aws_secret_access_key: str, resolution: str,
+                        start_date: date, end_date: date) -> pd.DataFrame:
+    """Syncs the rollups and metadata between the given dates from the S3 bucket and
+        returns the per-plant rollups of the requested resolution."""
+
+    print(f"Fetching {resolution} reading history...")
+
+    s3 = create_s3_client(aws_access_key, aws_secret_access_key)
+    bucket_file_info = get_bucket_file_info(s3, source_bucket, start_date, end_date,
+                                            history_prefixes)
+    download_archived_data(bucket_file_info, s3, source_bucket, start_date, end_date,
+                           history_prefixes)
+
+    return read_rollups(resolution, start_date, end_date)
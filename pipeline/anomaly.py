@@ -0,0 +1,188 @@
+"""Flags anomalous plant readings against rolling per-plant statistics"""
+
+from datetime import datetime
+from threading import Lock
+import logging
+
+from pymssql import Connection  # pylint: disable=no-name-in-module
+
+from load import chunk_rows
+from metrics import increment
+
+MEASUREMENTS = ("temperature", "soil_moisture")
+# Weight of the newest reading, roughly averaging over the last 20 minutes of readings.
+EWMA_ALPHA = 0.1
+ANOMALY_THRESHOLD_IN_STDDEVS = 3
+MIN_READINGS_FOR_ALERTS = 30
+
+STATISTICS_COLUMNS = ("plant_id", "reading_count", "temperature_mean", "temperature_variance",
+                      "soil_moisture_mean", "soil_moisture_variance", "updated_at")
+ALERT_COLUMNS = ("plant_id", "timestamp", "measurement", "value",
+                 "expected_mean", "expected_stddev")
+# SQL Server caps a VALUES list at 1000 rows and a statement at 2100 parameters.
+MAX_STATISTICS_PER_MERGE = min(1000, 2099 // len(STATISTICS_COLUMNS))
+MAX_ALERTS_PER_INSERT = min(1000, 2099 // len(ALERT_COLUMNS))
+
+# Kept at module level so that warm Lambda invocations skip loading the state.
+PLANT_STATISTICS = {}
+PLANT_STATISTICS_LOCK = Lock()
+
+
+def load_plant_statistics(connection: Connection) -> dict:
+    """Returns the rolling statistics of every plant, only reading them from the
+        database on a cold start."""
+    if PLANT_STATISTICS:
+        return PLANT_STATISTICS
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT * FROM delta.plant_statistics")
+        rows = cursor.fetchall()
+    increment("db_round_trips")
+
+    for row in rows:
+        PLANT_STATISTICS[row.pop("plant_id")] = row
+
+    logging.info("Loaded rolling statistics of %s plants.", len(PLANT_STATISTICS))
+    return PLANT_STATISTICS
+
+
+def update_ewma(mean: float, variance: float, value: float,
+                alpha: float = EWMA_ALPHA) -> tuple[float, float]:
+    """Returns the exponentially weighted mean and variance after adding a value."""
+    difference = value - mean
+    step = alpha * difference
+    return mean + step, (1 - alpha) * (variance + difference * step)
+
+
+def check_reading(plant_statistics: dict, reading: dict) -> list[dict]:
+    """Returns an alert for each measurement of the reading that is more than
+        ANOMALY_THRESHOLD_IN_STDDEVS standard deviations from the plant's mean."""
+    if plant_statistics["reading_count"] < MIN_READINGS_FOR_ALERTS:
+        return []
+
+    alerts = []
+    for measurement in MEASUREMENTS:
+        mean = plant_statistics[f"{measurement}_mean"]
+        stddev = plant_statistics[f"{measurement}_variance"] ** 0.5
+        if abs(reading[measurement] - mean) > ANOMALY_THRESHOLD_IN_STDDEVS * stddev:
+            alerts.append({"plant_id": reading["plant_id"],
+                           "timestamp": reading["timestamp"],
+                           "measurement": measurement,
+                           "value": reading[measurement],
+                           "expected_mean": mean,
+                           "expected_stddev": stddev})
+    return alerts
+
+
+def update_plant_statistics(plant_statistics: dict | None, reading: dict) -> dict:
+    """Returns the plant's statistics after adding a reading, starting them from
+        the reading if the plant has none yet."""
+    if plant_statistics is None:
+        return {"reading_count": 1,
+                **{f"{measurement}_mean": reading[measurement]
+                   for measurement in MEASUREMENTS},
+                **{f"{measurement}_variance": 0.0 for measurement in MEASUREMENTS}}
+
+    updated = {"reading_count": plant_statistics["reading_count"] + 1}
+    for measurement in MEASUREMENTS:
+        updated[f"{measurement}_mean"], updated[f"{measurement}_variance"] = update_ewma(
+            plant_statistics[f"{measurement}_mean"],
+            plant_statistics[f"{measurement}_variance"], reading[measurement])
+    return updated
+
+
+def detect_anomalies(readings: list[dict], statistics: dict) -> tuple[list[dict], set[int]]:
+    """Checks each reading against its plant's statistics before adding it to them,
+        returning the alerts raised and the ids of the plants updated."""
+    alerts = []
+    updated_plant_ids = set()
+
+    for reading in sorted(readings, key=lambda reading: reading["timestamp"]):
+        plant_id = reading["plant_id"]
+        if plant_id in statistics:
+            alerts.extend(check_reading(statistics[plant_id], reading))
+        statistics[plant_id] = update_plant_statistics(statistics.get(plant_id), reading)
+        updated_plant_ids.add(plant_id)
+
+    return alerts, updated_plant_ids
+
+
+def build_values_list(row_count: int, column_count: int) -> str:
+    """Returns a VALUES list of placeholders for the given number of rows."""
+    row_placeholder = "(" + ", ".join(["%s"] * column_count) + ")"
+    return "VALUES " + ", ".join([row_placeholder] * row_count)
+
+
+def build_statistics_merge(row_count: int) -> str:
+    """Returns a MERGE statement that upserts the given number of plant statistics rows."""
+    columns = ", ".join(STATISTICS_COLUMNS)
+    updates = ", ".join(f"{column} = source.{column}" for column in STATISTICS_COLUMNS[1:])
+    source_columns = ", ".join(f"source.{column}" for column in STATISTICS_COLUMNS)
+    return (f"MERGE delta.plant_statistics AS target "
+            f"USING ({build_values_list(row_count, len(STATISTICS_COLUMNS))}) "
+            f"AS source({columns}) "
+            "ON target.plant_id = source.plant_id "
+            f"WHEN MATCHED THEN UPDATE SET {updates} "
+            f"WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({source_columns});")
+
+
+def build_alert_insert(row_count: int) -> str:
+    """Returns an INSERT statement for the given number of alert rows."""
+    return (f"INSERT INTO delta.reading_alert({', '.join(ALERT_COLUMNS)}) "
+            + build_values_list(row_count, len(ALERT_COLUMNS)))
+
+
+def save_plant_statistics(statistics: dict, plant_ids: set[int],
+                          connection: Connection) -> None:
+    """Upserts the statistics of the given plants with one set-based MERGE per chunk
+        of plants."""
+    now = datetime.now()
+    rows = [(plant_id, *(statistics[plant_id][column] for column in STATISTICS_COLUMNS[1:-1]),
+             now) for plant_id in sorted(plant_ids)]
+
+    with connection.cursor() as cursor:
+        for chunk in chunk_rows(rows, MAX_STATISTICS_PER_MERGE):
+            cursor.execute(build_statistics_merge(len(chunk)),
+                           tuple(value for row in chunk for value in row))
+            increment("db_round_trips")
+
+
+def insert_alerts(alerts: list[dict], connection: Connection) -> None:
+    """Inserts the alerts raised for anomalous readings as multi-row INSERT statements."""
+    rows = [tuple(alert[column] for column in ALERT_COLUMNS) for alert in alerts]
+
+    with connection.cursor() as cursor:
+        for chunk in chunk_rows(rows, MAX_ALERTS_PER_INSERT):
+            cursor.execute(build_alert_insert(len(chunk)),
+                           tuple(value for row in chunk for value in row))
+            increment("db_round_trips")
+
+
+def record_anomalies(readings: list[dict], connection: Connection,
+                     commit: bool = True) -> int:
+    """Updates the rolling statistics of the plants in a batch of readings and stores
+        an alert for every anomalous reading, returning the number of alerts. Batches
+        loaded on different threads update the statistics one at a time."""
+    if not readings:
+        return 0
+
+    with PLANT_STATISTICS_LOCK:
+        statistics = load_plant_statistics(connection)
+        alerts, updated_plant_ids = detect_anomalies(readings, statistics)
+
+        try:
+            save_plant_statistics(statistics, updated_plant_ids, connection)
+            if alerts:
+                insert_alerts(alerts, connection)
+            if commit:
+                connection.commit()
+                increment("db_round_trips")
+        except Exception:
+            PLANT_STATISTICS.clear()
+            raise
+
+    for alert in alerts:
+        logging.warning("Anomalous %s of %s for plant %s (expected %.2f ± %.2f)",
+                        alert["measurement"], alert["value"], alert["plant_id"],
+                        alert["expected_mean"], alert["expected_stddev"])
+    return len(alerts)
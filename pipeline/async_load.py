@@ -0,0 +1,84 @@
+"""Loads plant readings into the database from asyncio code without blocking the event loop"""
+
+import asyncio
+import logging
+
+from pymssql import Connection, Error  # pylint: disable=no-name-in-module
+
+from load import get_shared_connection, close_shared_connection, load_batch, \
+    remember_reading_keys, get_reading_key
+from anomaly import record_anomalies, PLANT_STATISTICS, PLANT_STATISTICS_LOCK
+from metrics import increment, timer
+
+CONNECTION_POOL_SIZE = 3
+
+
+class AsyncReadingLoader:
+    """Loads batches of readings on a small pool of warm connections, running the
+    blocking pymssql calls on worker threads so that fetching carries on meanwhile.
+    Each connection is used by one batch at a time, and each batch is committed in
+    its own short transaction so that dashboard reads are never held up for long."""
+
+    def __init__(self, pool_size: int = CONNECTION_POOL_SIZE):
+        self.pool_size = pool_size
+        self.idle_slots = asyncio.Queue()
+        self.connections = {}
+
+    async def __aenter__(self) -> "AsyncReadingLoader":
+        connections = await asyncio.gather(
+            *(asyncio.to_thread(get_shared_connection, slot) for slot in range(self.pool_size)))
+
+        for slot, connection in enumerate(connections):
+            self.connections[slot] = connection
+            self.idle_slots.put_nowait(slot)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is None:
+            return
+
+        logging.error("Loading failed, closing the pooled connections: %s", exc)
+        await asyncio.gather(*(asyncio.to_thread(close_shared_connection, slot)
+                               for slot in self.connections))
+
+    def commit(self, slot: int, batch: list[dict]) -> None:
+        """Commits a loaded batch, only then remembering its readings as stored."""
+        self.connections[slot].commit()
+        increment("db_round_trips")
+        remember_reading_keys([get_reading_key(reading) for reading in batch])
+
+    def rollback(self, slot: int) -> None:
+        """Rolls back a failed batch, forgetting the statistics it may have updated."""
+        try:
+            self.connections[slot].rollback()
+        except Error as e:
+            logging.warning("Error rolling back database connection: %s", e)
+        with PLANT_STATISTICS_LOCK:
+            PLANT_STATISTICS.clear()
+
+    def load_on_connection(self, batch: list[dict], slot: int) -> int:
+        """Inserts a batch and records anomalies among the readings it actually
+        inserted in one transaction on one connection. Returns the number of
+        readings inserted."""
+        connection: Connection = self.connections[slot]
+        try:
+            with timer("load"):
+                inserted = load_batch(batch, connection, commit=False)
+            with timer("anomaly_detection"):
+                alerts = record_anomalies(inserted, connection, commit=False)
+            self.commit(slot, batch)
+        except Exception:
+            self.rollback(slot)
+            raise
+
+        increment("alerts", alerts)
+        return len(inserted)
+
+    async def load(self, batch: list[dict]) -> int:
+        """Loads a batch on the next idle connection, waiting for one if all are busy.
+        Returns the number of readings inserted."""
+        slot = await self.idle_slots.get()
+        try:
+            return await asyncio.to_thread(self.load_on_connection, batch, slot)
+        finally:
+            self.idle_slots.put_nowait(slot)
@@ -0,0 +1,253 @@
+"""Benchmarks the pipeline end to end against a local fake plant API and database"""
+
+from datetime import datetime
+from time import perf_counter, sleep
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+import load
+from extract import get_all_plant_data, close_shared_session, MAX_CONCURRENT_REQUESTS
+from transform import transform_data, parse_last_watered, RECORDING_FORMAT, DATE_FORMAT
+
+BOTANIST_EMAILS = ("carl.linnaeus@lnhm.co.uk", "gertrude.jekyll@lnhm.co.uk",
+                   "eliza.andrews@lnhm.co.uk")
+DEFAULT_PLANT_COUNT = 1000
+DEFAULT_LATENCY_IN_SECONDS = 0.02
+DEFAULT_ERROR_RATE = 0.0
+DEFAULT_DB_ROUND_TRIP_IN_SECONDS = 0.002
+# Budgets for the default scenario; stages slower than these count as regressions.
+STAGE_THRESHOLDS_IN_SECONDS = {
+    "get_all_plant_data": 3.0,
+    "transform_data": 0.5,
+    "insert_to_database": 0.5,
+}
+
+
+def create_fake_api(latency: float = DEFAULT_LATENCY_IN_SECONDS,
+                    error_rate: float = DEFAULT_ERROR_RATE,
+                    seed: int = 0) -> web.Application:
+    """Creates an API that answers like the plant API after the given latency,
+    failing the given fraction of requests with a server error"""
+    randomiser = random.Random(seed)
+    recording_taken = datetime.now().strftime(RECORDING_FORMAT)
+
+    async def get_plant(request: web.Request) -> web.Response:
+        plant_id = int(request.match_info["plant_id"])
+        await asyncio.sleep(latency)
+
+        if randomiser.random() < error_rate:
+            return web.json_response({"error": "server error"}, status=500)
+
+        return web.json_response({
+            "botanist": {"email": BOTANIST_EMAILS[plant_id % len(BOTANIST_EMAILS)]},
+            "last_watered": "Mon, 10 Jun 2024 14:03:04 GMT",
+            "plant_id": plant_id,
+            "recording_taken": recording_taken,
+            "soil_moisture": randomiser.uniform(10, 100),
+            "temperature": randomiser.uniform(8, 20),
+        })
+
+    app = web.Application()
+    app.router.add_get("/plants/{plant_id}", get_plant)
+    return app
+
+
+class BenchmarkCursor:
+    """Local stand-in for a pymssql cursor where every statement costs a round-trip."""
+
+    def __init__(self, connection: "BenchmarkConnection"):
+        self.connection = connection
+        self.rowcount = 0
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, statement: str, params: tuple = ()) -> None:
+        """Simulates a statement sent to the server."""
+        self.connection.round_trips += 1
+        sleep(self.connection.round_trip_seconds)
+
+        if "FROM delta.botanist" in statement:
+            self.results = [{"botanist_id": BOTANIST_EMAILS.index(email) + 1, "email": email}
+                            for email in params if email in BOTANIST_EMAILS]
+        elif statement.startswith("INSERT"):
+            rows = [params[i:i + len(load.READING_COLUMNS)]
+                    for i in range(0, len(params), len(load.READING_COLUMNS))]
+            self.results = [{"plant_id": row[3], "timestamp": row[2]} for row in rows]
+            self.rowcount = len(rows)
+            self.connection.rows_inserted += self.rowcount
+        else:
+            self.results = [{"": 1}]
+
+    def executemany(self, statement: str, rows: list[tuple]) -> None:
+        """Simulates pymssql sending one statement per row."""
+        rowcount = 0
+        for row in rows:
+            self.execute(statement, row)
+            rowcount += self.rowcount
+        self.rowcount = rowcount
+
+    def fetchall(self) -> list[dict]:
+        """Returns the results of the last query."""
+        return self.results
+
+
+class BenchmarkConnection:
+    """Local stand-in for a pymssql connection that counts round-trips."""
+
+    def __init__(self, round_trip_seconds: float = DEFAULT_DB_ROUND_TRIP_IN_SECONDS):
+        self.round_trip_seconds = round_trip_seconds
+        self.round_trips = 0
+        self.rows_inserted = 0
+
+    def cursor(self) -> BenchmarkCursor:
+        """Returns a new cursor."""
+        return BenchmarkCursor(self)
+
+    def commit(self) -> None:
+        """Simulates a commit round-trip."""
+        self.round_trips += 1
+        sleep(self.round_trip_seconds)
+
+    def close(self) -> None:
+        """Nothing to close."""
+
+
+async def fetch_from_fake_api(plant_count: int, latency: float, error_rate: float,
+                              max_concurrency: int, seed: int) -> list[dict]:
+    """Serves the fake API on a free local port and fetches every plant from it"""
+    runner = web.AppRunner(create_fake_api(latency, error_rate, seed))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    try:
+        return await get_all_plant_data(range(plant_count), f"http://{host}:{port}/plants/",
+                                        max_concurrency)
+    finally:
+        await close_shared_session()
+        await runner.cleanup()
+
+
+def run_benchmark(plant_count: int = DEFAULT_PLANT_COUNT,
+                  latency: float = DEFAULT_LATENCY_IN_SECONDS,
+                  error_rate: float = DEFAULT_ERROR_RATE,
+                  max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                  db_round_trip: float = DEFAULT_DB_ROUND_TRIP_IN_SECONDS,
+                  seed: int = 0) -> dict:
+    """Runs each pipeline stage against the local stand-ins, returning its timings in
+    seconds along with the plant, error, reading and round-trip counts"""
+    report = {"plants": plant_count}
+
+    start = perf_counter()
+    raw_data = asyncio.run(fetch_from_fake_api(plant_count, latency, error_rate,
+                                               max_concurrency, seed))
+    report["get_all_plant_data"] = perf_counter() - start
+    report["errors"] = sum(1 for plant in raw_data if plant.get("error"))
+
+    start = perf_counter()
+    transformed = transform_data(raw_data)
+    report["transform_data"] = perf_counter() - start
+
+    connection = BenchmarkConnection(db_round_trip)
+    load.BOTANIST_CACHE.clear()
+    load.RECENT_READING_KEYS.clear()
+    load.CONNECTION_CACHE[0] = connection
+    try:
+        start = perf_counter()
+        load.insert_to_database(transformed)
+        report["insert_to_database"] = perf_counter() - start
+    finally:
+        load.CONNECTION_CACHE.pop(0, None)
+
+    report["readings"] = connection.rows_inserted
+    report["round_trips"] = connection.round_trips
+    return report
+
+
+def benchmark_insert_modes(reading_count: int = 500,
+                           db_round_trip: float = DEFAULT_DB_ROUND_TRIP_IN_SECONDS) -> dict:
+    """Inserts the same readings with each insert mode against the local stand-in
+    database, returning each mode's time in seconds and round-trips"""
+    reading_tuples = [(1.0, 2.0, datetime(2024, 6, 10, i // 3600, i // 60 % 60, i % 60),
+                       i % 51, datetime(2024, 6, 10), 1) for i in range(reading_count)]
+    report = {}
+
+    for insert_mode in load.INSERT_MODES:
+        connection = BenchmarkConnection(db_round_trip)
+        start = perf_counter()
+        load.load_readings(reading_tuples, connection, insert_mode)
+        report[f"insert_{insert_mode}"] = perf_counter() - start
+        report[f"insert_{insert_mode}_round_trips"] = connection.round_trips
+
+    return report
+
+
+def benchmark_date_parsing(value_count: int = 20_000, distinct_count: int = 50) -> dict:
+    """Times strptime against the uncached and memoised last watered parsers,
+    returning each one's time in seconds"""
+    values = [datetime(2024, 6, 1 + i % 28, i % 24, i % 60, i % 60).strftime(DATE_FORMAT)
+              for i in range(value_count)]
+    report = {}
+
+    start = perf_counter()
+    for value in values:
+        datetime.strptime(value, DATE_FORMAT)
+    report["parse_strptime"] = perf_counter() - start
+
+    start = perf_counter()
+    for value in values:
+        parse_last_watered.__wrapped__(value)
+    report["parse_sliced"] = perf_counter() - start
+
+    parse_last_watered.cache_clear()
+    start = perf_counter()
+    for value in values[:distinct_count] * (value_count // distinct_count):
+        parse_last_watered(value)
+    report["parse_memoised"] = perf_counter() - start
+
+    return report
+
+
+def check_regressions(report: dict,
+                      thresholds: dict = None) -> list[str]:
+    """Returns a message for every stage that took longer than its threshold"""
+    thresholds = thresholds or STAGE_THRESHOLDS_IN_SECONDS
+    return [f"{stage} took {report[stage]:.3f}s, over its {threshold:.3f}s threshold"
+            for stage, threshold in thresholds.items() if report[stage] > threshold]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plants", type=int, default=DEFAULT_PLANT_COUNT)
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY_IN_SECONDS)
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_ERROR_RATE)
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument("--db-round-trip", type=float,
+                        default=DEFAULT_DB_ROUND_TRIP_IN_SECONDS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    benchmark = run_benchmark(args.plants, args.latency, args.error_rate,
+                              args.concurrency, args.db_round_trip, args.seed)
+    benchmark.update(benchmark_insert_modes(db_round_trip=args.db_round_trip))
+    benchmark.update(benchmark_date_parsing())
+    for name, value in benchmark.items():
+        print(f"{name}: {value:.3f}" if isinstance(value, float) else f"{name}: {value}")
+
+    if any(value != parser.get_default(name) for name, value in vars(args).items()):
+        print("Thresholds only apply to the default scenario, skipping regression checks.")
+        raise SystemExit(0)
+
+    regressions = check_regressions(benchmark)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    raise SystemExit(1 if regressions else 0)
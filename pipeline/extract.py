@@ -1,53 +1,246 @@
 """This file is responsible for extracting plant data from the Heroku API."""
 
-from time import time, perf_counter
-from os import path, mkdir
+from time import perf_counter
+from os import path, makedirs
+from queue import SimpleQueue
+from typing import AsyncIterator
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import itertools
 import logging
 import asyncio
 
 import aiohttp
 
+from metrics import increment, observe
+
 LOG_FOLDER = "/tmp/log"
+LOG_FILE_NAME = "pipeline.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+# Only every nth per-plant info log is kept; warnings and errors are always kept.
+PLANT_LOG_SAMPLE_EVERY = 10
+PER_PLANT_LOG = {"per_plant": True}
 PLANT_DATA_HOST_URL = "https://data-eng-plants-api.herokuapp.com/plants/"
 PLANT_DATA_RANGE = 51
-MAX_TIMEOUT_IN_SECONDS = 100
+MAX_TIMEOUT_IN_SECONDS = 15
+MAX_CONCURRENT_REQUESTS = 25
+CONNECTION_LIMIT_PER_HOST = 25
+DNS_CACHE_TTL_IN_SECONDS = 300
+KEEP_ALIVE_TIMEOUT_IN_SECONDS = 60
+MAX_RETRIES = 3
+BACKOFF_BASE_IN_SECONDS = 0.5
+OVERALL_DEADLINE_IN_SECONDS = 45
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+RESPONSE_QUEUE_SIZE = 100
+
+# Kept at module level so that warm Lambda invocations reuse open connections.
+SESSION_CACHE = {}
+LOG_LISTENER = {}
+
+
+class PlantLogSampler(logging.Filter):
+    """Keeps one in every sample_every per-plant info logs, letting everything
+    else through"""
+
+    def __init__(self, sample_every: int = PLANT_LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.sample_every = sample_every
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not getattr(record, "per_plant", False):
+            return True
+        return next(self.counter) % self.sample_every == 0
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues log records without formatting them, leaving the formatting to the
+    listener thread. Log arguments must not be mutated after logging."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def create_error_response(plant_id: int, error: str) -> dict:
+    """Returns the response used in place of plant data when a request fails"""
+    return {"error": error,
+            "plant_id": plant_id,
+            "response": 400}
 
 
 async def fetch_data_from_api(session, plant_id: int,
                               host_url: str = PLANT_DATA_HOST_URL,
-                              max_timeout: int = MAX_TIMEOUT_IN_SECONDS) -> dict:
-    """Gets content from URL with specified plant id"""
-    try:
-        async with session.get(host_url + str(plant_id), timeout=max_timeout) as response:
-            logging.info("Plant id %s data called.", plant_id)
-            return await response.json()
+                              max_timeout: int = MAX_TIMEOUT_IN_SECONDS,
+                              max_retries: int = MAX_RETRIES,
+                              backoff_base: float = BACKOFF_BASE_IN_SECONDS) -> dict:
+    """Gets content from URL with specified plant id, retrying timeouts, connection
+    errors and server errors with exponential backoff"""
+    error = "request failed"
 
-    except asyncio.TimeoutError:
-        logging.error("Plant id %s timed out.", plant_id)
-        return {"error": "request timed out",
-                "plant_id": plant_id,
-                "response": 400}
+    for attempt in range(max_retries + 1):
+        start = perf_counter()
+        try:
+            async with session.get(host_url + str(plant_id),
+                                   timeout=aiohttp.ClientTimeout(total=max_timeout)) as response:
+                logging.info("Plant id %s data called.", plant_id, extra=PER_PLANT_LOG)
+                if response.status not in RETRY_STATUS_CODES:
+                    plant = await response.json()
+                    observe("fetch_latency", (perf_counter() - start) * 1000)
+                    return plant
+                error = f"server error {response.status}"
+
+        except asyncio.TimeoutError:
+            error = "request timed out"
+        except aiohttp.ClientError as e:
+            error = f"request failed: {e}"
+
+        if attempt < max_retries:
+            increment("fetch_retries")
+            logging.warning("Plant id %s attempt %s failed (%s), retrying.",
+                            plant_id, attempt + 1, error)
+            await asyncio.sleep(backoff_base * 2 ** attempt)
+
+    increment("fetch_errors")
+    logging.error("Plant id %s failed after %s attempts: %s.",
+                  plant_id, max_retries + 1, error)
+    return create_error_response(plant_id, error)
+
+
+def create_log(log_folder: str = LOG_FOLDER) -> None:
+    """Creates the log folder and starts logging through a queue to a size-bounded,
+    rotating file written on a background thread. Calling it again does nothing."""
+    if LOG_LISTENER:
+        return
+
+    makedirs(log_folder, exist_ok=True)
+    file_handler = RotatingFileHandler(path.join(log_folder, LOG_FILE_NAME),
+                                       maxBytes=LOG_MAX_BYTES,
+                                       backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 
+    log_queue = SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(PlantLogSampler())
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
 
-def create_log() -> None:
-    """Creates log folder and starts logging"""
-    if not path.exists(LOG_FOLDER):
-        mkdir(LOG_FOLDER)
-    logging.basicConfig(filename=path.join(LOG_FOLDER, f"pipeline_{int(time())}.log"),
-                        encoding="utf-8", level=logging.INFO)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(logging.INFO)
+    LOG_LISTENER.update(listener=listener, handler=queue_handler)
+    atexit.register(stop_log)
 
 
-async def get_all_plant_data() -> list[dict]:
-    """Gets all plant data hosted from an API"""
+def stop_log() -> None:
+    """Flushes any queued logs to the file and detaches the queue from logging."""
+    if not LOG_LISTENER:
+        return
+
+    logging.getLogger().removeHandler(LOG_LISTENER.pop("handler"))
+    listener = LOG_LISTENER.pop("listener")
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def create_session(connection_limit: int = MAX_CONCURRENT_REQUESTS) -> aiohttp.ClientSession:
+    """Creates a client session whose connector keeps connections alive, caches DNS
+    lookups and limits the number of open connections"""
+    connector = aiohttp.TCPConnector(limit=connection_limit,
+                                     limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                                     ttl_dns_cache=DNS_CACHE_TTL_IN_SECONDS,
+                                     keepalive_timeout=KEEP_ALIVE_TIMEOUT_IN_SECONDS)
+    return aiohttp.ClientSession(connector=connector)
+
+
+def get_shared_session(connection_limit: int = MAX_CONCURRENT_REQUESTS) -> aiohttp.ClientSession:
+    """Returns the client session shared by warm invocations, creating a new one if
+    it has been closed or belongs to an earlier event loop"""
+    loop = asyncio.get_running_loop()
+    session = SESSION_CACHE.get("session")
+
+    if session is None or session.closed or SESSION_CACHE.get("loop") is not loop:
+        session = create_session(connection_limit)
+        SESSION_CACHE.update(session=session, loop=loop)
+
+    return session
+
+
+async def close_shared_session() -> None:
+    """Closes and forgets the shared client session"""
+    session = SESSION_CACHE.pop("session", None)
+    SESSION_CACHE.pop("loop", None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def stream_plant_data(plant_ids: range = range(PLANT_DATA_RANGE),
+                            host_url: str = PLANT_DATA_HOST_URL,
+                            max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                            deadline: float = OVERALL_DEADLINE_IN_SECONDS,
+                            queue_size: int = RESPONSE_QUEUE_SIZE) -> AsyncIterator[dict]:
+    """Yields plant data from the API as each response arrives. A pool of
+    max_concurrency workers fetches the plants into a bounded queue, so workers pause
+    when the consumer falls behind. Plants still unfinished at the deadline are
+    yielded as error responses."""
     create_log()
+    loop = asyncio.get_running_loop()
+    end_time = loop.time() + deadline
+    queue = asyncio.Queue(maxsize=queue_size)
+    remaining_ids = iter(plant_ids)
+    in_flight_ids = set()
+
+    async def worker(session) -> None:
+        for plant_id in remaining_ids:
+            in_flight_ids.add(plant_id)
+            try:
+                response = await fetch_data_from_api(session, plant_id, host_url)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logging.error("Plant id %s failed unexpectedly: %s", plant_id, e)
+                response = create_error_response(plant_id, f"unexpected error: {e}")
+            await queue.put(response)
+            in_flight_ids.discard(plant_id)
+        await queue.put(None)
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_data_from_api(session, plant_id)
-                 for plant_id in range(PLANT_DATA_RANGE)]
-        responses = await asyncio.gather(*tasks)
+    session = get_shared_session(max_concurrency)
+    workers = [asyncio.create_task(worker(session)) for _ in range(max_concurrency)]
+    finished_workers = 0
 
-    return responses
+    try:
+        while finished_workers < len(workers):
+            response = await asyncio.wait_for(queue.get(), end_time - loop.time())
+            if response is None:
+                finished_workers += 1
+            else:
+                yield response
+    except asyncio.TimeoutError:
+        logging.error("Deadline reached before all plants were fetched.")
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
+    while not queue.empty():
+        response = queue.get_nowait()
+        if response is not None:
+            yield response
+
+    for plant_id in [*in_flight_ids, *remaining_ids]:
+        yield create_error_response(plant_id, "deadline exceeded")
+
+
+async def get_all_plant_data(plant_ids: range = range(PLANT_DATA_RANGE),
+                             host_url: str = PLANT_DATA_HOST_URL,
+                             max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                             deadline: float = OVERALL_DEADLINE_IN_SECONDS) -> list[dict]:
+    """Gets all plant data hosted from an API in the order it arrives"""
+    try:
+        return [response async for response in
+                stream_plant_data(plant_ids, host_url, max_concurrency, deadline)]
+    finally:
+        await close_shared_session()
 
 if __name__ == "__main__":
     start = perf_counter()
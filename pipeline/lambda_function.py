@@ -1,13 +1,123 @@
 """Runs the whole ETL pipeline"""
 
 import asyncio
-from extract import get_all_plant_data
-from transform import transform_data
-from load import insert_to_database
+import logging
+
+from extract import stream_plant_data
+from transform import stream_transformed_data
+from load import remove_duplicate_readings
+from async_load import AsyncReadingLoader
+from metrics import reset_metrics, emit_metrics, increment, timer
+
+READING_QUEUE_SIZE = 200
+INSERT_BATCH_SIZE = 100
+MAX_BATCH_WAIT_IN_SECONDS = 2
+
+# Kept at module level so that the shared aiohttp session stays on a live loop
+# across warm invocations.
+EVENT_LOOP_CACHE = {}
+
+
+async def produce_readings(queue: asyncio.Queue) -> None:
+    """Puts transformed readings on the queue as plant responses arrive,
+    waiting whenever the queue is full."""
+    with timer("extract_and_transform"):
+        async for reading in stream_transformed_data(stream_plant_data()):
+            increment("readings_transformed")
+            await queue.put(reading)
+    await queue.put(None)
+
+
+async def insert_batch(batch: list[dict], loader: AsyncReadingLoader) -> int:
+    """Inserts a batch of readings and records any anomalies among them without
+    blocking the event loop, leaving out recently seen readings."""
+    batch = remove_duplicate_readings(batch)
+    if not batch:
+        return 0
+    return await loader.load(batch)
+
+
+async def consume_readings(queue: asyncio.Queue, loader: AsyncReadingLoader,
+                           batch_size: int = INSERT_BATCH_SIZE,
+                           max_wait: float = MAX_BATCH_WAIT_IN_SECONDS) -> int:
+    """Inserts readings from the queue in micro-batches, flushing a batch once it is
+    full or no reading has arrived for max_wait seconds. Batches load in the
+    background while more readings arrive, at most one per pooled connection.
+    Returns the number of readings inserted, logging how many duplicates were skipped."""
+    batch = []
+    received = 0
+    in_flight = set()
+    loaded = []
+
+    async def dispatch(batch: list[dict]) -> None:
+        if len(in_flight) >= loader.pool_size:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            in_flight.difference_update(done)
+            loaded.extend(task.result() for task in done)
+        in_flight.add(asyncio.create_task(insert_batch(batch, loader)))
+
+    try:
+        while True:
+            try:
+                reading = await asyncio.wait_for(queue.get(), max_wait)
+            except asyncio.TimeoutError:
+                if batch:
+                    await dispatch(batch)
+                    batch = []
+                continue
+
+            if reading is None:
+                break
+
+            batch.append(reading)
+            received += 1
+            if len(batch) >= batch_size:
+                await dispatch(batch)
+                batch = []
+
+        if batch:
+            await dispatch(batch)
+        loaded.extend(await asyncio.gather(*in_flight))
+    except BaseException:
+        # Batches still loading on worker threads must finish before the loader
+        # closes their connections.
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        raise
+
+    inserted = sum(loaded)
+    logging.info("Skipped %s duplicate readings.", received - inserted)
+    return inserted
+
+
+async def run_pipeline() -> int:
+    """Streams plant data from the API through the transform into the database,
+    returning the number of readings inserted. The pooled database connections
+    are kept open for the next warm invocation unless the run fails."""
+    async with AsyncReadingLoader() as loader:
+        queue = asyncio.Queue(maxsize=READING_QUEUE_SIZE)
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(produce_readings(queue))
+            consumer = task_group.create_task(consume_readings(queue, loader))
+
+    logging.info("Inserted %s readings.", consumer.result())
+    return consumer.result()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Returns the event loop reused by warm invocations, creating it if needed."""
+    loop = EVENT_LOOP_CACHE.get("loop")
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        EVENT_LOOP_CACHE["loop"] = loop
+    return loop
 
 
 def handler(event, context):  # pylint: disable=unused-argument
-    """Executes the ETL Process."""
-    raw_data = asyncio.run(get_all_plant_data())
-    clean_data = transform_data(raw_data)
-    insert_to_database(clean_data)
+    """Executes the ETL Process, emitting its metrics at the end of the invocation."""
+    reset_metrics()
+    try:
+        with timer("invocation"):
+            get_event_loop().run_until_complete(run_pipeline())
+    finally:
+        emit_metrics()
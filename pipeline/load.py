@@ -1,15 +1,37 @@
 """Script for loading the transformed plant data to the Microsoft SQL Server Database"""
 
 from os import environ as ENV
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
 import logging
 import asyncio
 
+import pandas as pd
 from dotenv import load_dotenv
-from pymssql import connect, Connection, exceptions  # pylint: disable=no-name-in-module
+from pymssql import connect, Connection, Error, exceptions  # pylint: disable=no-name-in-module
 
 from extract import get_all_plant_data
+from metrics import increment
 from transform import transform_data
 
+BOTANIST_CACHE_TTL_IN_SECONDS = 3600
+
+READING_COLUMNS = ("soil_moisture", "temperature", "timestamp",
+                   "plant_id", "last_watered", "botanist_id")
+# SQL Server caps a VALUES list at 1000 rows and a statement at 2100 parameters.
+MAX_ROWS_PER_INSERT = min(1000, 2099 // len(READING_COLUMNS))
+INSERT_MODES = ("bulk", "executemany")
+DEFAULT_INSERT_MODE = "bulk"
+
+# Kept at module level so that warm Lambda invocations reuse earlier lookups.
+BOTANIST_CACHE = {}
+CONNECTION_CACHE = {}
+# Roughly the last two hours of readings, so retried invocations skip them early.
+RECENT_READING_KEYS = OrderedDict()
+RECENT_READING_KEYS_SIZE = 6000
+RECENT_READING_KEYS_LOCK = Lock()
+
 
 def get_connection() -> Connection:
     """Creates a connection to the database, returning a connection object."""
@@ -33,72 +55,317 @@ def get_connection() -> Connection:
             f"Error connecting to database: {e}") from e
 
 
+def is_connection_healthy(connection: Connection) -> bool:
+    """Checks that a connection can still run a query."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        return True
+    except Error as e:
+        logging.warning("Database connection is unhealthy: %s", e)
+        return False
+
+
+def close_shared_connection(slot: int = 0) -> None:
+    """Closes and forgets a shared connection so the next use reconnects."""
+    connection = CONNECTION_CACHE.pop(slot, None)
+    if connection is None:
+        return
+    try:
+        connection.close()
+    except Error as e:
+        logging.warning("Error closing database connection: %s", e)
+
+
+def get_shared_connection(slot: int = 0) -> Connection:
+    """Returns a connection shared by warm invocations, checking it is still
+        usable and transparently reconnecting if it is not. Each slot holds its
+        own connection so that a pool of them can be kept warm."""
+    connection = CONNECTION_CACHE.get(slot)
+    if connection is not None and is_connection_healthy(connection):
+        return connection
+
+    close_shared_connection(slot)
+    load_dotenv()
+    CONNECTION_CACHE[slot] = get_connection()
+    return CONNECTION_CACHE[slot]
+
+
 def dictionary_to_tuple(reading_dicts: list[dict]) -> list[tuple]:
     """Converts the transformed plant reading data from a list of dictionaries
         to a list of tuples, returning the list."""
     return [tuple(reading.values()) for reading in reading_dicts]
 
 
+def get_cached_botanist_ids(emails: set[str]) -> tuple[dict, set[str]]:
+    """Splits the given emails into those with a fresh cached botanist ID and those
+        that must be looked up, counting the cache hits and misses of this run."""
+    now = monotonic()
+    cached_ids = {}
+    missing_emails = set()
+
+    for email in emails:
+        entry = BOTANIST_CACHE.get(email)
+        if entry and now - entry[1] < BOTANIST_CACHE_TTL_IN_SECONDS:
+            cached_ids[email] = entry[0]
+            increment("botanist_cache_hits")
+        else:
+            missing_emails.add(email)
+            increment("botanist_cache_misses")
+
+    return cached_ids, missing_emails
+
+
+def query_botanist_ids(emails: set[str], connection: Connection) -> dict:
+    """Resolves all given botanist emails with a single query, caching and
+        returning the email to botanist ID mapping."""
+    if not emails:
+        return {}
+
+    email_params = tuple(sorted(emails))
+    placeholders = ", ".join(["%s"] * len(email_params))
+    query = f"SELECT botanist_id, email FROM delta.botanist WHERE email IN ({placeholders})"
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, email_params)
+        rows = cursor.fetchall()
+
+    increment("db_round_trips")
+    increment("botanist_queries")
+    now = monotonic()
+    botanist_ids = {}
+    for row in rows:
+        botanist_ids[row["email"]] = row["botanist_id"]
+        BOTANIST_CACHE[row["email"]] = (row["botanist_id"], now)
+
+    return botanist_ids
+
+
+def get_botanist_ids(emails: set[str], connection: Connection) -> dict:
+    """Returns the botanist ID of every given email, only querying the database
+        for emails that are not already cached."""
+    botanist_ids, missing_emails = get_cached_botanist_ids(emails)
+    botanist_ids.update(query_botanist_ids(missing_emails, connection))
+    return botanist_ids
+
+
 def retrieve_botanist_ids_and_remove_botanist_emails(
         reading_dicts: list[dict], connection: Connection) -> list[dict]:
-    """Queries the database and retrieves the corresponding botanist ID for each reading
-        via their associated email in the reading dict, adding it to each plant reading
-        data dictionary and removing the email."""
+    """Retrieves the corresponding botanist ID for each reading via their associated
+        email in the reading dict, adding it to each plant reading data dictionary
+        and removing the email. All distinct emails are resolved in one batch."""
 
-    with connection.cursor() as cursor:
-        for reading in reading_dicts:
-            email = reading["email"]
+    botanist_ids = get_botanist_ids(
+        {reading["email"] for reading in reading_dicts}, connection)
 
-            query = "SELECT botanist_id FROM delta.botanist WHERE email = %s"
-            cursor.execute(query, email)
+    for reading in reading_dicts:
+        email = reading.pop("email")
 
-            result = cursor.fetchone()
-            if result:
-                reading["botanist_id"] = result["botanist_id"]
-            else:
-                logging.error("Botanist with email %s not found in database.", email)
-                raise ValueError(f"Botanist with email {\
-                                 email} not found in database.")
+        if email not in botanist_ids:
+            logging.error("Botanist with email %s not found in database.", email)
+            raise ValueError(f"Botanist with email {email} not found in database.")
 
-            reading.pop("email")
+        reading["botanist_id"] = botanist_ids[email]
 
     return reading_dicts
 
 
-def insert_readings(reading_tuples: list[tuple], connection: Connection) -> None:
-    """Batch-inserts the plant reading data into the Microsoft SQL Server Database."""
+def get_reading_key(reading: dict) -> tuple:
+    """Returns the (plant_id, timestamp) pair that identifies a reading."""
+    return reading["plant_id"], reading["timestamp"]
+
+
+def remove_duplicate_readings(reading_dicts: list[dict]) -> list[dict]:
+    """Drops readings repeated within the batch or inserted by a recent run."""
+    batch_keys = set()
+    unique_readings = []
+
+    with RECENT_READING_KEYS_LOCK:
+        for reading in reading_dicts:
+            key = get_reading_key(reading)
+            if key in batch_keys or key in RECENT_READING_KEYS:
+                continue
+            batch_keys.add(key)
+            unique_readings.append(reading)
+
+    if len(unique_readings) < len(reading_dicts):
+        increment("duplicates_skipped", len(reading_dicts) - len(unique_readings))
+        logging.info("Skipped %s recently seen readings.",
+                     len(reading_dicts) - len(unique_readings))
+    return unique_readings
+
+
+def remember_reading_keys(reading_keys: list[tuple]) -> None:
+    """Records inserted reading keys, forgetting the oldest beyond the filter size."""
+    with RECENT_READING_KEYS_LOCK:
+        for key in reading_keys:
+            RECENT_READING_KEYS[key] = None
+            RECENT_READING_KEYS.move_to_end(key)
+
+        while len(RECENT_READING_KEYS) > RECENT_READING_KEYS_SIZE:
+            RECENT_READING_KEYS.popitem(last=False)
+
+
+def build_deduplicating_insert(row_count: int) -> str:
+    """Returns an INSERT statement for the given number of VALUES rows that skips
+        any reading whose (plant_id, timestamp) is already stored, outputting the
+        keys of the readings it did insert."""
+    row_placeholder = "(" + ", ".join(["%s"] * len(READING_COLUMNS)) + ")"
+    columns = ", ".join(READING_COLUMNS)
+    return (f"INSERT INTO delta.reading({columns}) "
+            "OUTPUT inserted.plant_id, inserted.timestamp "
+            f"SELECT {columns} FROM (VALUES "
+            + ", ".join([row_placeholder] * row_count)
+            + f") AS new_reading({columns}) "
+            "WHERE NOT EXISTS (SELECT 1 FROM delta.reading AS r "
+            "WHERE r.plant_id = new_reading.plant_id "
+            "AND r.timestamp = new_reading.timestamp)")
+
+
+def insert_readings(reading_tuples: list[tuple], connection: Connection,
+                    commit: bool = True) -> list[tuple]:
+    """Inserts the plant reading data into the Microsoft SQL Server Database one
+        statement per reading, skipping readings that are already stored.
+        Returns the keys of the readings inserted."""
+    statement = build_deduplicating_insert(1)
+    inserted_keys = []
 
     with connection.cursor() as cursor:
         logging.info("Inserting to database")
-        statement = """
-                    INSERT INTO delta.reading(soil_moisture, temperature, timestamp, plant_id, last_watered, botanist_id)
-                    VALUES
-                        (%s, %s, %s, %s, %s, %s)
-                    """
-        cursor.executemany(statement, reading_tuples)
-
-    connection.commit()
+        for reading in reading_tuples:
+            cursor.execute(statement, reading)
+            inserted_keys.extend(get_reading_key(row) for row in cursor.fetchall())
+    increment("db_round_trips", len(reading_tuples))
+
+    if commit:
+        connection.commit()
+        increment("db_round_trips")
     logging.info("Inserted to database!")
+    return inserted_keys
 
-def insert_to_database(transformed_data: list[dict]) -> None:
-    """Inserts the transformed plant data into the database"""
-    load_dotenv()
+def chunk_rows(rows: list[tuple], chunk_size: int) -> list[list[tuple]]:
+    """Splits the rows into consecutive chunks of at most chunk_size rows."""
+    return [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+
+
+def insert_readings_in_bulk(reading_tuples: list[tuple], connection: Connection,
+                            chunk_size: int = MAX_ROWS_PER_INSERT,
+                            commit: bool = True) -> list[tuple]:
+    """Inserts the plant reading data as set-based INSERT statements, sending one
+        statement per chunk instead of one per reading and skipping readings that
+        are already stored. Returns the keys of the readings inserted."""
+
+    chunk_size = min(chunk_size, MAX_ROWS_PER_INSERT)
+    inserted_keys = []
+
+    with connection.cursor() as cursor:
+        logging.info("Bulk inserting %s readings to database", len(reading_tuples))
+        for chunk in chunk_rows(reading_tuples, chunk_size):
+            params = tuple(value for reading in chunk for value in reading)
+            cursor.execute(build_deduplicating_insert(len(chunk)), params)
+            inserted_keys.extend(get_reading_key(row) for row in cursor.fetchall())
+            increment("db_round_trips")
+
+    if commit:
+        connection.commit()
+        increment("db_round_trips")
+    logging.info("Inserted to database!")
+    return inserted_keys
 
-    try:
-        conn = get_connection()
 
-        reading_data = retrieve_botanist_ids_and_remove_botanist_emails(
-            transformed_data, conn)
+def get_insert_mode() -> str:
+    """Returns the configured reading insert mode."""
+    insert_mode = ENV.get("READING_INSERT_MODE", DEFAULT_INSERT_MODE).lower()
+    if insert_mode not in INSERT_MODES:
+        raise ValueError(
+            f"Invalid READING_INSERT_MODE {insert_mode}, expected one of {INSERT_MODES}.")
+    return insert_mode
 
-        reading_tuples = dictionary_to_tuple(reading_data)
 
-        insert_readings(reading_tuples, conn)
+def load_readings(reading_tuples: list[tuple], connection: Connection,
+                  insert_mode: str = None, commit: bool = True) -> list[tuple]:
+    """Inserts the plant reading data using the configured insert mode, returning
+        the keys of the readings inserted. Readings already stored are reported as
+        duplicates. With commit=False the caller is responsible for committing."""
+    if not reading_tuples:
+        logging.info("No readings to insert.")
+        return []
+
+    if (insert_mode or get_insert_mode()) == "executemany":
+        inserted_keys = insert_readings(reading_tuples, connection, commit)
+    else:
+        inserted_keys = insert_readings_in_bulk(reading_tuples, connection, commit=commit)
+
+    increment("rows_inserted", len(inserted_keys))
+    if len(inserted_keys) < len(reading_tuples):
+        increment("duplicates_skipped", len(reading_tuples) - len(inserted_keys))
+        logging.info("Skipped %s readings already in the database.",
+                     len(reading_tuples) - len(inserted_keys))
+    return inserted_keys
+
+
+def load_batch(transformed_data: list[dict], connection: Connection,
+               commit: bool = True) -> list[dict]:
+    """Resolves botanist IDs for a batch of transformed readings and inserts them,
+        skipping duplicates, and returns the readings that were actually inserted.
+        With commit=False the caller commits and then remembers the batch's keys."""
+    reading_data = retrieve_botanist_ids_and_remove_botanist_emails(
+        remove_duplicate_readings(transformed_data), connection)
+
+    inserted_keys = set(load_readings(dictionary_to_tuple(reading_data), connection,
+                                      commit=commit))
+    if commit:
+        remember_reading_keys([get_reading_key(reading) for reading in reading_data])
+    return [reading for reading in reading_data if get_reading_key(reading) in inserted_keys]
+
+
+def load_columnar_batch(readings: pd.DataFrame, connection: Connection) -> int:
+    """Resolves botanist IDs for a columnar batch of transformed readings and inserts
+        them, skipping duplicates, and returns the number of readings inserted."""
+    if readings.empty:
+        return 0
+
+    readings = readings.drop_duplicates(["plant_id", "timestamp"])
+    reading_keys = list(zip(readings["plant_id"].tolist(),
+                            readings["timestamp"].dt.to_pydatetime()))
+    with RECENT_READING_KEYS_LOCK:
+        is_new = [key not in RECENT_READING_KEYS for key in reading_keys]
+    readings = readings[is_new]
+    if readings.empty:
+        return 0
+
+    botanist_ids = get_botanist_ids(set(readings["email"].unique()), connection)
+    botanist_id_column = readings["email"].map(botanist_ids)
+
+    if botanist_id_column.isna().any():
+        missing_emails = set(readings["email"][botanist_id_column.isna()])
+        logging.error("Botanists with emails %s not found in database.", missing_emails)
+        raise ValueError(f"Botanists with emails {missing_emails} not found in database.")
+
+    reading_tuples = list(zip(
+        readings["soil_moisture"].tolist(),
+        readings["temperature"].tolist(),
+        list(readings["timestamp"].dt.to_pydatetime()),
+        readings["plant_id"].tolist(),
+        list(readings["last_watered"].dt.to_pydatetime()),
+        botanist_id_column.astype("int64").tolist()))
+
+    inserted_keys = load_readings(reading_tuples, connection)
+    remember_reading_keys([(reading[3], reading[2]) for reading in reading_tuples])
+    return len(inserted_keys)
+
+
+def insert_to_database(transformed_data: list[dict]) -> None:
+    """Inserts the transformed plant data into the database on the shared
+        connection, dropping the connection if anything fails"""
+    try:
+        load_batch(transformed_data, get_shared_connection())
 
     except Exception as e:
         logging.error("An error occurred: %s", e)
+        close_shared_connection()
         raise Exception(f"An error occurred: {e}") from e
-    finally:
-        conn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+"""Collects pipeline timings and counts and emits them as a CloudWatch Embedded
+Metric Format log line"""
+
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, time
+from typing import Iterator
+import json
+
+METRIC_NAMESPACE = "PlantPipeline"
+SERVICE_NAME = "plant-pipeline"
+# CloudWatch accepts at most 100 values for a single metric in one EMF line.
+MAX_HISTOGRAM_VALUES = 100
+
+# Kept at module level so that any stage can record without passing state around.
+METRICS = {"timers": {}, "counters": {}, "histograms": {}}
+# Database loads record metrics from several worker threads at once.
+METRICS_LOCK = Lock()
+
+
+def reset_metrics() -> None:
+    """Clears the metrics recorded by the previous invocation."""
+    with METRICS_LOCK:
+        for metrics in METRICS.values():
+            metrics.clear()
+
+
+def increment(name: str, value: int = 1) -> None:
+    """Adds to a counter."""
+    with METRICS_LOCK:
+        METRICS["counters"][name] = METRICS["counters"].get(name, 0) + value
+
+
+def observe(name: str, value: float) -> None:
+    """Records a single value of a histogram, such as one request's latency."""
+    with METRICS_LOCK:
+        METRICS["histograms"].setdefault(name, []).append(value)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """Adds the time spent inside the block to a timer, in milliseconds."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (perf_counter() - start) * 1000
+        with METRICS_LOCK:
+            METRICS["timers"][name] = METRICS["timers"].get(name, 0) + elapsed
+
+
+def downsample(values: list[float], max_values: int = MAX_HISTOGRAM_VALUES) -> list[float]:
+    """Returns at most max_values evenly spaced quantiles of the values."""
+    values = sorted(values)
+    if len(values) <= max_values:
+        return values
+    step = (len(values) - 1) / (max_values - 1)
+    return [values[round(i * step)] for i in range(max_values)]
+
+
+def build_emf_record() -> dict:
+    """Builds an Embedded Metric Format record of every recorded metric."""
+    definitions = []
+    record = {"Service": SERVICE_NAME}
+
+    for name, value in METRICS["timers"].items():
+        definitions.append({"Name": name, "Unit": "Milliseconds"})
+        record[name] = round(value, 3)
+    for name, value in METRICS["counters"].items():
+        definitions.append({"Name": name, "Unit": "Count"})
+        record[name] = value
+    for name, values in METRICS["histograms"].items():
+        definitions.append({"Name": name, "Unit": "Milliseconds"})
+        record[name] = [round(value, 3) for value in downsample(values)]
+
+    record["_aws"] = {
+        "Timestamp": int(time() * 1000),
+        "CloudWatchMetrics": [{"Namespace": METRIC_NAMESPACE,
+                               "Dimensions": [["Service"]],
+                               "Metrics": definitions}],
+    }
+    return record
+
+
+def emit_metrics() -> None:
+    """Prints the metrics as one JSON line, which CloudWatch turns into metrics
+    when it reads the Lambda's output."""
+    print(json.dumps(build_emf_record()), flush=True)
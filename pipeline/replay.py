@@ -0,0 +1,133 @@
+"""Replays captured plant API responses into the database, for backfills and rebuilds"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator
+import argparse
+import gzip
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+from transform import transform_data_columnar
+from load import get_connection, load_columnar_batch
+
+REPLAY_BATCH_SIZE = 5000
+MAX_REPLAY_WORKERS = 4
+CHECKPOINT_PATH = "replay_checkpoint.json"
+
+
+def open_capture(capture_path: str):
+    """Opens a JSONL capture file as text, decompressing it if it is gzipped"""
+    if capture_path.endswith(".gz"):
+        return gzip.open(capture_path, "rt", encoding="utf-8")
+    return open(capture_path, encoding="utf-8")
+
+
+def read_capture_batches(capture_path: str,
+                         batch_size: int = REPLAY_BATCH_SIZE) -> Iterator[list[dict]]:
+    """Yields the plant responses of a capture file in batches, holding at most
+    batch_size responses in memory and skipping lines that are not valid JSON"""
+    batch = []
+
+    with open_capture(capture_path) as capture:
+        for line_number, line in enumerate(capture, start=1):
+            if not line.strip():
+                continue
+            try:
+                batch.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning("Skipping malformed line %s of %s.", line_number, capture_path)
+                continue
+
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def replay_file(capture_path: str, batch_size: int = REPLAY_BATCH_SIZE) -> dict:
+    """Transforms and loads every response of a capture file on its own connection,
+    returning the number of responses read and readings inserted"""
+    load_dotenv()
+    connection = get_connection()
+    summary = {"path": capture_path, "responses": 0, "inserted": 0}
+
+    try:
+        for batch in read_capture_batches(capture_path, batch_size):
+            summary["inserted"] += load_columnar_batch(transform_data_columnar(batch),
+                                                       connection)
+            summary["responses"] += len(batch)
+    finally:
+        connection.close()
+
+    logging.info("Replayed %s: %s responses, %s readings inserted.", capture_path,
+                 summary["responses"], summary["inserted"])
+    return summary
+
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """Loads the record of which capture files have been fully replayed"""
+    if not os.path.exists(checkpoint_path):
+        return {"completed": {}}
+
+    with open(checkpoint_path, encoding="utf-8") as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: dict) -> None:
+    """Saves the checkpoint atomically so an interrupted write cannot corrupt it"""
+    temporary_path = f"{checkpoint_path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def replay_captures(capture_paths: list[str], checkpoint_path: str = CHECKPOINT_PATH,
+                    max_workers: int = MAX_REPLAY_WORKERS,
+                    batch_size: int = REPLAY_BATCH_SIZE) -> int:
+    """Replays capture files in parallel across processes, skipping files the
+    checkpoint marks as complete and recording each file as it finishes. A file
+    interrupted part way is replayed again from the start, and the readings it
+    already loaded are skipped as duplicates. Returns the number of readings
+    inserted."""
+    checkpoint = load_checkpoint(checkpoint_path)
+    pending_paths = [path for path in capture_paths if path not in checkpoint["completed"]]
+    logging.info("Replaying %s capture files, %s already complete.",
+                 len(pending_paths), len(capture_paths) - len(pending_paths))
+    inserted = 0
+
+    def record(summary: dict) -> None:
+        nonlocal inserted
+        inserted += summary["inserted"]
+        checkpoint["completed"][summary["path"]] = summary
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    if max_workers == 1:
+        for path in pending_paths:
+            record(replay_file(path, batch_size))
+        return inserted
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(replay_file, path, batch_size) for path in pending_paths]
+        for future in as_completed(futures):
+            record(future.result())
+
+    return inserted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("captures", nargs="+",
+                        help="JSONL capture files of plant API responses, optionally gzipped")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--workers", type=int, default=MAX_REPLAY_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=REPLAY_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    total = replay_captures(args.captures, args.checkpoint, args.workers, args.batch_size)
+    print(f"Inserted {total} readings.")
@@ -0,0 +1,95 @@
+"""Contains the tests for the anomaly detection stage"""
+
+from unittest.mock import patch, MagicMock
+from datetime import datetime, timedelta
+import pytest
+from anomaly import update_ewma, detect_anomalies, record_anomalies, MIN_READINGS_FOR_ALERTS, \
+    MAX_STATISTICS_PER_MERGE
+
+
+def get_reading(minute: int, temperature: float, plant_id: int = 1) -> dict:
+    """Returns a transformed reading taken the given number of minutes in"""
+    return {"plant_id": plant_id, "temperature": temperature, "soil_moisture": 50.0,
+            "timestamp": datetime(2024, 6, 10) + timedelta(minutes=minute)}
+
+
+def test_update_ewma_converges_on_constant_value():
+    """Tests that the mean converges on a constant value as its variance decays"""
+    mean, variance = 0.0, 0.0
+    for _ in range(200):
+        mean, variance = update_ewma(mean, variance, 10.0)
+
+    assert mean == pytest.approx(10.0)
+    assert variance == pytest.approx(0.0, abs=1e-6)
+
+
+def test_detect_anomalies_flags_outlier():
+    """Tests that only a reading far outside the plant's rolling range is flagged"""
+    readings = [get_reading(i, 12.0 + (i % 3) * 0.1)
+                for i in range(MIN_READINGS_FOR_ALERTS)]
+    statistics = {}
+
+    alerts, updated_plant_ids = detect_anomalies(readings, statistics)
+    assert not alerts
+    assert updated_plant_ids == {1}
+
+    alerts, _ = detect_anomalies([get_reading(100, 30.0), get_reading(101, 12.1, 2)],
+                                 statistics)
+    assert [(alert["plant_id"], alert["measurement"]) for alert in alerts] == [
+        (1, "temperature")]
+    assert statistics[1]["reading_count"] == MIN_READINGS_FOR_ALERTS + 1
+    assert statistics[2]["reading_count"] == 1
+
+
+def test_no_alerts_before_enough_readings():
+    """Tests that plants with too few readings are never flagged"""
+    statistics = {}
+    alerts, _ = detect_anomalies([get_reading(0, 10.0), get_reading(1, 40.0)], statistics)
+
+    assert not alerts
+
+
+@patch.dict("anomaly.PLANT_STATISTICS", clear=True)
+def test_record_anomalies_loads_state_once():
+    """Tests that the state is read on a cold start only and saved with one statement"""
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    mock_cursor.fetchall.return_value = [
+        {"plant_id": 1, "reading_count": 100, "temperature_mean": 12.0,
+         "temperature_variance": 0.01, "soil_moisture_mean": 50.0,
+         "soil_moisture_variance": 0.01, "updated_at": datetime(2024, 6, 10)}]
+
+    assert record_anomalies([get_reading(0, 12.0), get_reading(1, 20.0)], mock_conn) == 1
+    assert record_anomalies([get_reading(2, 12.0, 2)], mock_conn) == 0
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert [statement.split()[0] for statement in statements] == [
+        "SELECT", "MERGE", "INSERT", "MERGE"]
+    mock_cursor.executemany.assert_not_called()
+    assert mock_conn.commit.call_count == 2
+
+
+@patch.dict("anomaly.PLANT_STATISTICS", clear=True)
+def test_record_anomalies_saves_many_plants_in_chunks():
+    """Tests that statistics and alerts are sent as set-based statements within SQL
+    Server's parameter limit rather than one statement per row"""
+    mock_conn = MagicMock()
+    mock_cursor = mock_conn.cursor.return_value.__enter__.return_value
+    plant_ids = range(MAX_STATISTICS_PER_MERGE + 1)
+    mock_cursor.fetchall.return_value = [
+        {"plant_id": plant_id, "reading_count": 100, "temperature_mean": 12.0,
+         "temperature_variance": 0.01, "soil_moisture_mean": 50.0,
+         "soil_moisture_variance": 0.01, "updated_at": datetime(2024, 6, 10)}
+        for plant_id in plant_ids]
+
+    readings = [get_reading(0, 20.0, plant_id) for plant_id in plant_ids]
+    assert record_anomalies(readings, mock_conn) == len(readings)
+
+    calls = mock_cursor.execute.call_args_list
+    merges = [call.args for call in calls if call.args[0].startswith("MERGE")]
+    inserts = [call.args for call in calls if call.args[0].startswith("INSERT")]
+    assert [len(params) for _, params in merges] == [
+        MAX_STATISTICS_PER_MERGE * 7, 7]
+    assert len(inserts) == 1
+    assert inserts[0][0].count("(%s, %s, %s, %s, %s, %s)") == len(readings)
+    assert inserts[0][1][:3] == (0, readings[0]["timestamp"], "temperature")
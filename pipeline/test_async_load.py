@@ -0,0 +1,100 @@
+"""Contains the tests for the async database loader"""
+
+from unittest.mock import patch, MagicMock
+import asyncio
+
+import pytest
+
+from async_load import AsyncReadingLoader
+from load import RECENT_READING_KEYS
+from anomaly import PLANT_STATISTICS
+
+
+def load_batches(batches: list, pool_size: int) -> AsyncReadingLoader:
+    """Loads the batches concurrently through a loader, returning the closed loader"""
+
+    async def run() -> AsyncReadingLoader:
+        async with AsyncReadingLoader(pool_size) as loader:
+            await asyncio.gather(*(loader.load(batch) for batch in batches))
+        return loader
+
+    return asyncio.run(run())
+
+
+@patch("async_load.record_anomalies", return_value=0)
+@patch("async_load.load_batch")
+@patch("async_load.get_shared_connection")
+def test_loader_uses_one_connection_per_slot(mock_get_connection, mock_load_batch,
+                                             mock_record_anomalies):
+    """Tests that each pooled slot opens its own connection and batches spread over them"""
+    mock_get_connection.side_effect = lambda slot: MagicMock(name=f"connection {slot}")
+    mock_load_batch.side_effect = lambda batch, connection, commit: batch
+
+    loader = load_batches([[{"plant_id": i, "timestamp": "t"}] for i in range(6)],
+                          pool_size=3)
+
+    assert sorted(call.args[0] for call in mock_get_connection.call_args_list) == [0, 1, 2]
+    assert all(call.kwargs["commit"] is False for call in mock_load_batch.call_args_list)
+    assert mock_record_anomalies.call_count == 6
+    used = {call.args[1] for call in mock_load_batch.call_args_list}
+    assert used <= set(loader.connections.values())
+
+
+@patch.dict("load.RECENT_READING_KEYS", clear=True)
+@patch("async_load.record_anomalies", return_value=0)
+@patch("async_load.load_batch")
+@patch("async_load.get_shared_connection")
+def test_loader_commits_each_batch(mock_get_connection, mock_load_batch,
+                                   mock_record_anomalies):  # pylint: disable=unused-argument
+    """Tests that every batch is committed on its own and only then remembered"""
+    connection = mock_get_connection.return_value
+
+    def check_uncommitted(batch, connection, commit):  # pylint: disable=unused-argument
+        assert (batch[0]["plant_id"], "t") not in RECENT_READING_KEYS
+        return batch
+
+    mock_load_batch.side_effect = check_uncommitted
+
+    load_batches([[{"plant_id": i, "timestamp": "t"}] for i in range(5)], pool_size=1)
+
+    assert connection.commit.call_count == 5
+    assert list(RECENT_READING_KEYS) == [(i, "t") for i in range(5)]
+
+
+@patch.dict("anomaly.PLANT_STATISTICS", {0: {"reading_count": 1}})
+@patch.dict("load.RECENT_READING_KEYS", clear=True)
+@patch("async_load.close_shared_connection")
+@patch("async_load.record_anomalies", return_value=0)
+@patch("async_load.load_batch")
+@patch("async_load.get_shared_connection")
+def test_loader_failure_rolls_back_batch(mock_get_connection, mock_load_batch,
+                                         mock_record_anomalies,  # pylint: disable=unused-argument
+                                         mock_close_connection):
+    """Tests that a failed batch is rolled back and forgotten while earlier ones stay"""
+    connection = mock_get_connection.return_value
+    connection.commit.side_effect = [None, RuntimeError("deadlock")]
+    mock_load_batch.side_effect = lambda batch, connection, commit: batch
+
+    with pytest.raises(RuntimeError):
+        load_batches([[{"plant_id": 1, "timestamp": "t"}],
+                      [{"plant_id": 2, "timestamp": "t"}]], pool_size=1)
+
+    connection.rollback.assert_called_once()
+    mock_close_connection.assert_called_once_with(0)
+    assert list(RECENT_READING_KEYS) == [(1, "t")]
+    assert not PLANT_STATISTICS
+
+
+@patch("async_load.record_anomalies", return_value=0)
+@patch("async_load.load_batch")
+@patch("async_load.get_shared_connection")
+def test_loader_checks_only_inserted_readings(
+        mock_get_connection, mock_load_batch,  # pylint: disable=unused-argument
+        mock_record_anomalies):
+    """Tests that readings already stored are left out of the anomaly statistics"""
+    mock_load_batch.return_value = [{"plant_id": 2, "timestamp": "t"}]
+
+    load_batches([[{"plant_id": 1, "timestamp": "t"}, {"plant_id": 2, "timestamp": "t"}]],
+                 pool_size=1)
+
+    assert mock_record_anomalies.call_args.args[0] == [{"plant_id": 2, "timestamp": "t"}]
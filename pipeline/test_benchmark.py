@@ -0,0 +1,48 @@
+"""Contains the tests for the pipeline benchmark harness"""
+
+import asyncio
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+from benchmark import run_benchmark, check_regressions, fetch_from_fake_api, create_fake_api
+
+
+def test_run_benchmark_small_scenario():
+    """Tests that every plant flows through all stages and each stage is timed"""
+    report = run_benchmark(plant_count=60, latency=0, db_round_trip=0)
+
+    assert report["plants"] == 60
+    assert report["errors"] == 0
+    assert report["readings"] == 60
+    assert report["round_trips"] == 4
+    assert all(report[stage] >= 0 for stage in
+               ("get_all_plant_data", "transform_data", "insert_to_database"))
+
+
+def test_fake_api_fails_requested_fraction():
+    """Tests that the fake API fails every request at an error rate of one"""
+
+    async def get_status() -> int:
+        app = create_fake_api(latency=0, error_rate=1)
+        async with TestServer(app) as server, ClientSession() as session:
+            async with session.get(server.make_url("/plants/1")) as response:
+                return response.status
+
+    assert asyncio.run(get_status()) == 500
+
+
+def test_fetch_from_fake_api_concurrently():
+    """Tests that plants are fetched from the fake API over a local port"""
+    responses = asyncio.run(fetch_from_fake_api(10, 0, 0, 5, 0))
+
+    assert sorted(response["plant_id"] for response in responses) == list(range(10))
+
+
+def test_check_regressions():
+    """Tests that only stages over their threshold are reported"""
+    report = {"get_all_plant_data": 2.0, "transform_data": 0.1}
+
+    regressions = check_regressions(report, {"get_all_plant_data": 1.0, "transform_data": 1.0})
+
+    assert regressions == ["get_all_plant_data took 2.000s, over its 1.000s threshold"]
@@ -2,8 +2,11 @@
 
 from unittest.mock import patch, MagicMock
 import asyncio
+import logging
 
-from extract import get_all_plant_data, PLANT_DATA_RANGE
+from extract import get_all_plant_data, fetch_data_from_api, stream_plant_data, \
+    close_shared_session, create_log, stop_log, PLANT_DATA_RANGE, PLANT_LOG_SAMPLE_EVERY, \
+    PER_PLANT_LOG, LOG_FILE_NAME
 
 
 class TestGetResponseFromAPI:
@@ -86,3 +89,154 @@ class TestGetAllPlantData:
         asyncio.run(get_all_plant_data())
 
         assert mock_get_response.call_count == PLANT_DATA_RANGE
+
+
+class FakeResponse:
+    '''Stand-in for an aiohttp response'''
+
+    def __init__(self, status: int, data: dict):
+        self.status = status
+        self.data = data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def json(self) -> dict:
+        '''Returns the response body'''
+        return self.data
+
+
+class FakeSession:
+    '''Stand-in for an aiohttp session returning the given outcomes in order'''
+
+    def __init__(self, outcomes: list):
+        self.outcomes = outcomes
+        self.calls = 0
+
+    def get(self, url, timeout):  # pylint: disable=unused-argument
+        '''Returns the next outcome, raising it if it is an exception'''
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class TestFetchDataRetries:
+    '''Contains tests for retrying failed requests'''
+
+    def test_retries_server_errors(self) -> None:
+        '''Tests that 5xx responses are retried until a success'''
+        session = FakeSession([FakeResponse(503, {}), FakeResponse(200, {"plant_id": 1})])
+
+        contents = asyncio.run(fetch_data_from_api(session, 1, backoff_base=0))
+
+        assert contents == {"plant_id": 1}
+        assert session.calls == 2
+
+    def test_retries_timeouts_then_gives_up(self) -> None:
+        '''Tests that an error response is returned once retries run out'''
+        session = FakeSession([asyncio.TimeoutError()])
+
+        contents = asyncio.run(fetch_data_from_api(session, 4, max_retries=2, backoff_base=0))
+
+        assert contents == {"error": "request timed out", "plant_id": 4, "response": 400}
+        assert session.calls == 3
+
+    def test_client_errors_are_not_retried(self) -> None:
+        '''Tests that 4xx responses are returned as they are'''
+        session = FakeSession([FakeResponse(404, {"error": "plant not found"})])
+
+        contents = asyncio.run(fetch_data_from_api(session, 7, backoff_base=0))
+
+        assert contents == {"error": "plant not found"}
+        assert session.calls == 1
+
+
+class TestGetAllPlantDataLimits:
+    '''Contains tests for the worker pool and overall deadline'''
+
+    @patch("extract.fetch_data_from_api")
+    def test_concurrency_is_bounded(self, mock_fetch) -> None:
+        '''Tests that no more than max_concurrency requests run at once'''
+        in_flight = {"now": 0, "max": 0}
+
+        async def fake_fetch(session, plant_id, host_url):  # pylint: disable=unused-argument
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            await asyncio.sleep(0.01)
+            in_flight["now"] -= 1
+            return {"plant_id": plant_id}
+
+        mock_fetch.side_effect = fake_fetch
+
+        responses = asyncio.run(get_all_plant_data(range(20), max_concurrency=4))
+
+        assert in_flight["max"] == 4
+        assert sorted(response["plant_id"] for response in responses) == list(range(20))
+
+    @patch("extract.fetch_data_from_api")
+    def test_deadline_returns_partial_results(self, mock_fetch) -> None:
+        '''Tests that slow plants are reported as errors once the deadline passes'''
+
+        async def fake_fetch(session, plant_id, host_url):  # pylint: disable=unused-argument
+            if plant_id == 2:
+                await asyncio.sleep(10)
+            return {"plant_id": plant_id}
+
+        mock_fetch.side_effect = fake_fetch
+
+        responses = asyncio.run(get_all_plant_data(range(3), deadline=0.2))
+
+        assert sorted(responses[:2], key=lambda r: r["plant_id"]) == [
+            {"plant_id": 0}, {"plant_id": 1}]
+        assert responses[2] == {"error": "deadline exceeded", "plant_id": 2, "response": 400}
+
+    @patch("extract.fetch_data_from_api")
+    def test_session_reused_across_runs_on_one_loop(self, mock_fetch) -> None:
+        '''Tests that consecutive runs on the same event loop share one client session'''
+        sessions = []
+
+        async def fake_fetch(session, plant_id, host_url):  # pylint: disable=unused-argument
+            sessions.append(session)
+            return {"plant_id": plant_id}
+
+        async def run_twice() -> None:
+            for _ in range(2):
+                _ = [response async for response in stream_plant_data(range(2))]
+            await close_shared_session()
+
+        mock_fetch.side_effect = fake_fetch
+        asyncio.run(run_twice())
+
+        assert len(sessions) == 4
+        assert len(set(map(id, sessions))) == 1
+        assert sessions[0].closed
+
+
+class TestCreateLog:
+    '''Contains tests for the queue-based, rotating log'''
+
+    def test_create_log_is_idempotent_and_samples(self, tmp_path) -> None:
+        '''Tests that repeated calls add one handler and per-plant info logs are sampled'''
+        stop_log()
+        root_logger = logging.getLogger()
+        handler_count = len(root_logger.handlers)
+
+        create_log(str(tmp_path))
+        create_log(str(tmp_path))
+        assert len(root_logger.handlers) == handler_count + 1
+
+        for plant_id in range(PLANT_LOG_SAMPLE_EVERY * 2):
+            logging.info("Plant id %s data called.", plant_id, extra=PER_PLANT_LOG)
+        logging.warning("Plant id %s failed.", 3, extra=PER_PLANT_LOG)
+        stop_log()
+
+        log_lines = (tmp_path / LOG_FILE_NAME).read_text(encoding="utf-8").splitlines()
+        assert len(root_logger.handlers) == handler_count
+        assert [line.split(": ")[-1] for line in log_lines] == [
+            "Plant id 0 data called.", f"Plant id {PLANT_LOG_SAMPLE_EVERY} data called.",
+            "Plant id 3 failed."]
@@ -0,0 +1,171 @@
+"""Contains the tests for the streaming pipeline in the lambda function"""
+
+from unittest.mock import patch
+from time import sleep
+import asyncio
+
+import pytest
+from lambda_function import consume_readings, run_pipeline, handler, get_event_loop
+from async_load import AsyncReadingLoader, CONNECTION_POOL_SIZE
+
+
+class FakeLoader:
+    """Stands in for the async loader, recording the size of each batch"""
+
+    pool_size = 2
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    async def load(self, batch: list[dict]) -> int:
+        """Records the batch and reports every reading as inserted"""
+        self.batch_sizes.append(len(batch))
+        await asyncio.sleep(0)
+        return len(batch)
+
+
+def run_consumer(readings: list, batch_size: int, max_wait: float = 1) -> tuple[int, list]:
+    """Feeds the readings to the consumer, returning the count inserted and the
+    batch sizes passed to the loader"""
+    loader = FakeLoader()
+
+    async def feed() -> int:
+        queue = asyncio.Queue(maxsize=2)
+        consumer = asyncio.create_task(
+            consume_readings(queue, loader, batch_size, max_wait))
+        for reading in readings:
+            await queue.put(reading)
+        await queue.put(None)
+        return await consumer
+
+    inserted = asyncio.run(feed())
+    return inserted, loader.batch_sizes
+
+
+def test_consume_readings_micro_batches():
+    """Tests that readings are inserted in batches of the configured size"""
+    inserted, batch_sizes = run_consumer(
+        [{"plant_id": i, "timestamp": "t"} for i in range(7)], 3)
+
+    assert inserted == 7
+    assert batch_sizes == [3, 3, 1]
+
+
+def test_consume_readings_skips_duplicates():
+    """Tests that readings repeated within a batch are only loaded once"""
+    inserted, batch_sizes = run_consumer(
+        [{"plant_id": i % 2, "timestamp": "t"} for i in range(4)], 4)
+
+    assert inserted == 2
+    assert batch_sizes == [2]
+
+
+def test_consume_readings_no_readings():
+    """Tests that nothing is inserted when the stream is empty"""
+    inserted, batch_sizes = run_consumer([], 3)
+
+    assert inserted == 0
+    assert not batch_sizes
+
+
+@patch("async_load.record_anomalies", return_value=0)
+@patch("async_load.load_batch")
+@patch("async_load.get_shared_connection")
+@patch("lambda_function.stream_plant_data")
+def test_run_pipeline_streams_into_loader(mock_stream, mock_get_connection, mock_load_batch,
+                                          mock_record_anomalies):
+    """Tests that transformed readings reach the loader, are committed and the
+    connections are kept open"""
+
+    async def fake_stream():
+        yield {"error": "plant not found", "plant_id": 7}
+        yield {
+            "botanist": {"email": "carl.linnaeus@lnhm.co.uk"},
+            "last_watered": "Mon, 10 Jun 2024 14:03:04 GMT",
+            "plant_id": 0,
+            "recording_taken": "2024-06-10 16:01:56",
+            "soil_moisture": 93.0958352536302,
+            "temperature": 13.137477117877957
+        }
+
+    mock_stream.return_value = fake_stream()
+    mock_load_batch.side_effect = lambda batch, connection, commit: batch
+
+    assert asyncio.run(run_pipeline()) == 1
+    assert mock_load_batch.call_args[0][0][0]["plant_id"] == 0
+    assert mock_load_batch.call_args.kwargs["commit"] is False
+    mock_record_anomalies.assert_called_once()
+    mock_get_connection.return_value.commit.assert_called_once()
+    mock_get_connection.return_value.close.assert_not_called()
+
+
+@patch("async_load.close_shared_connection")
+@patch("async_load.get_shared_connection")
+@patch("lambda_function.stream_plant_data")
+def test_run_pipeline_failure_drops_connection(mock_stream, mock_get_connection,
+                                               mock_close_connection):
+    """Tests that a failed run closes the pooled connections so the next one reconnects"""
+
+    async def failing_stream():
+        raise RuntimeError("API down")
+        yield  # pylint: disable=unreachable
+
+    mock_stream.return_value = failing_stream()
+
+    with pytest.raises(ExceptionGroup):
+        asyncio.run(run_pipeline())
+    assert mock_close_connection.call_count == CONNECTION_POOL_SIZE
+    mock_get_connection.return_value.commit.assert_not_called()
+
+
+@patch("async_load.close_shared_connection")
+@patch("async_load.record_anomalies", return_value=0)
+@patch("async_load.load_batch")
+@patch("async_load.get_shared_connection")
+def test_failed_run_waits_for_loads_in_flight(
+        mock_get_connection, mock_load_batch,  # pylint: disable=unused-argument
+        mock_record_anomalies, mock_close_connection):  # pylint: disable=unused-argument
+    """Tests that batches still loading finish before their connections are closed"""
+    events = []
+
+    def slow_load_batch(batch, connection, commit):  # pylint: disable=unused-argument
+        sleep(0.05)
+        events.append("load")
+        return batch
+
+    mock_load_batch.side_effect = slow_load_batch
+    mock_close_connection.side_effect = lambda slot: events.append("close")
+
+    async def failing_producer(queue: asyncio.Queue) -> None:
+        for plant_id in range(2):
+            await queue.put({"plant_id": plant_id, "timestamp": "t"})
+        await asyncio.sleep(0.01)
+        raise RuntimeError("API down")
+
+    async def run() -> None:
+        async with AsyncReadingLoader(pool_size=2) as loader:
+            queue = asyncio.Queue()
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(failing_producer(queue))
+                task_group.create_task(consume_readings(queue, loader, batch_size=1))
+
+    with pytest.raises(ExceptionGroup):
+        asyncio.run(run())
+
+    assert events == ["load", "load", "close", "close"]
+
+
+@patch("lambda_function.run_pipeline")
+def test_handler_reuses_event_loop(mock_run_pipeline):
+    """Tests that warm invocations run on the same event loop"""
+    loops = []
+
+    async def record_loop():
+        loops.append(asyncio.get_running_loop())
+
+    mock_run_pipeline.side_effect = record_loop
+
+    handler(None, None)
+    handler(None, None)
+
+    assert loops[0] is loops[1] is get_event_loop()
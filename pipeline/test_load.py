@@ -2,9 +2,16 @@
 
 from unittest.mock import patch, MagicMock
 from os import environ as ENV
+from datetime import datetime
 import pytest
+import pandas as pd
+import load
+from metrics import reset_metrics, METRICS
+from benchmark import BenchmarkConnection
+from transform import transform_data_columnar
 from load import get_connection, dictionary_to_tuple, \
-    retrieve_botanist_ids_and_remove_botanist_emails, insert_readings
+    retrieve_botanist_ids_and_remove_botanist_emails, insert_readings, \
+    insert_readings_in_bulk, load_readings, load_columnar_batch, MAX_ROWS_PER_INSERT, INSERT_MODES
 
 
 @patch("load.connect")
@@ -67,33 +74,90 @@ def test_dictionary_to_tuple():
 
 
 def test_retrieve_botanist_ids_and_remove_botanist_emails():
-    """Tests that the output is as expected, and all methods are called
-        the correct number of times."""
+    """Tests that the output is as expected, and that all emails are resolved
+        with a single query."""
 
     mock_connection = MagicMock()
     mock_cursor_instance = MagicMock()
     mock_connection.cursor.return_value.__enter__.return_value = mock_cursor_instance
 
-    mock_cursor_instance.fetchone.side_effect = [
-        {"botanist_id": 1}, {"botanist_id": 2}]
+    mock_cursor_instance.fetchall.return_value = [
+        {"botanist_id": 1, "email": "email1@test.com"},
+        {"botanist_id": 2, "email": "email2@test.com"}]
 
     reading_dicts = [
         {"email": "email1@test.com", "other_key": "value1"},
         {"email": "email2@test.com", "other_key": "value2"},
+        {"email": "email1@test.com", "other_key": "value3"},
     ]
 
     expected_output = [
         {"botanist_id": 1, "other_key": "value1"},
         {"botanist_id": 2, "other_key": "value2"},
+        {"botanist_id": 1, "other_key": "value3"},
     ]
 
-    result = retrieve_botanist_ids_and_remove_botanist_emails(
-        reading_dicts, mock_connection)
+    with patch.dict("load.BOTANIST_CACHE", clear=True):
+        result = retrieve_botanist_ids_and_remove_botanist_emails(
+            reading_dicts, mock_connection)
 
     assert result == expected_output
 
-    assert mock_cursor_instance.execute.call_count == 2
-    assert mock_cursor_instance.fetchone.call_count == 2
+    assert mock_cursor_instance.execute.call_count == 1
+    assert mock_cursor_instance.execute.call_args[0][1] == (
+        "email1@test.com", "email2@test.com")
+
+
+def test_retrieve_botanist_ids_uses_cache():
+    """Tests that cached botanist emails do not query the database again."""
+
+    mock_connection = MagicMock()
+    mock_cursor_instance = MagicMock()
+    mock_connection.cursor.return_value.__enter__.return_value = mock_cursor_instance
+    mock_cursor_instance.fetchall.return_value = [
+        {"botanist_id": 1, "email": "email1@test.com"}]
+
+    reset_metrics()
+    with patch.dict("load.BOTANIST_CACHE", clear=True):
+        for _ in range(3):
+            retrieve_botanist_ids_and_remove_botanist_emails(
+                [{"email": "email1@test.com"}], mock_connection)
+
+    counters = METRICS["counters"]
+    assert (counters["botanist_cache_hits"], counters["botanist_cache_misses"],
+            counters["botanist_queries"]) == (2, 1, 1)
+
+    assert mock_cursor_instance.execute.call_count == 1
+
+
+def test_retrieve_botanist_ids_expired_cache():
+    """Tests that expired cache entries are looked up again."""
+
+    mock_connection = MagicMock()
+    mock_cursor_instance = MagicMock()
+    mock_connection.cursor.return_value.__enter__.return_value = mock_cursor_instance
+    mock_cursor_instance.fetchall.return_value = [
+        {"botanist_id": 1, "email": "email1@test.com"}]
+
+    with patch.dict("load.BOTANIST_CACHE", {"email1@test.com": (1, -10_000)}, clear=True):
+        retrieve_botanist_ids_and_remove_botanist_emails(
+            [{"email": "email1@test.com"}], mock_connection)
+
+    assert mock_cursor_instance.execute.call_count == 1
+
+
+def test_retrieve_botanist_ids_unknown_email():
+    """Tests that a ValueError is raised for an email not in the database."""
+
+    mock_connection = MagicMock()
+    mock_cursor_instance = MagicMock()
+    mock_connection.cursor.return_value.__enter__.return_value = mock_cursor_instance
+    mock_cursor_instance.fetchall.return_value = []
+
+    with patch.dict("load.BOTANIST_CACHE", clear=True):
+        with pytest.raises(ValueError):
+            retrieve_botanist_ids_and_remove_botanist_emails(
+                [{"email": "unknown@test.com"}], mock_connection)
 
 
 def test_insert_readings():
@@ -102,21 +166,180 @@ def test_insert_readings():
     mock_connection = MagicMock()
     mock_cursor_instance = MagicMock()
     mock_connection.cursor.return_value.__enter__.return_value = mock_cursor_instance
+    mock_cursor_instance.fetchall.side_effect = [
+        [{"plant_id": 1, "timestamp": "2021-01-01 00:00:00"}], []]
 
     reading_tuples = [
         (1, 2, "2021-01-01 00:00:00", 1, "2021-01-01", 1),
         (3, 4, "2021-01-01 00:00:00", 2, "2021-01-01", 2),
     ]
 
-    insert_readings(reading_tuples, mock_connection)
+    assert insert_readings(reading_tuples, mock_connection) == [(1, "2021-01-01 00:00:00")]
+
+    assert mock_cursor_instance.execute.call_count == 2
+    statement, params = mock_cursor_instance.execute.call_args[0]
+    assert statement.count("(%s, %s, %s, %s, %s, %s)") == 1
+    assert "WHERE NOT EXISTS" in statement
+    assert "OUTPUT inserted.plant_id, inserted.timestamp" in statement
+    assert params == reading_tuples[1]
+
+    mock_connection.commit.assert_called_once()
 
-    statement = """
-                    INSERT INTO delta.reading(soil_moisture, temperature, timestamp, plant_id, last_watered, botanist_id)
-                    VALUES
-                        (%s, %s, %s, %s, %s, %s)
-                    """
 
-    mock_cursor_instance.executemany.assert_called_once_with(
-        statement, reading_tuples)
+def test_insert_readings_in_bulk_chunks_statements():
+    """Tests that readings are sent as multi-row statements within SQL Server's
+        parameter limit."""
 
+    mock_connection = MagicMock()
+    mock_cursor_instance = MagicMock()
+    mock_connection.cursor.return_value.__enter__.return_value = mock_cursor_instance
+
+    mock_cursor_instance.fetchall.return_value = [
+        {"plant_id": 0, "timestamp": "2021-01-01 00:00:00"}]
+    reading_tuples = [(1, 2, "2021-01-01 00:00:00", i, "2021-01-01", 1)
+                      for i in range(MAX_ROWS_PER_INSERT + 1)]
+
+    assert len(insert_readings_in_bulk(reading_tuples, mock_connection)) == 2
+
+    assert mock_cursor_instance.execute.call_count == 2
+    first_statement, first_params = mock_cursor_instance.execute.call_args_list[0][0]
+    assert first_statement.count("(%s, %s, %s, %s, %s, %s)") == MAX_ROWS_PER_INSERT
+    assert len(first_params) == MAX_ROWS_PER_INSERT * 6 < 2100
+    assert mock_cursor_instance.execute.call_args_list[1][0][1] == reading_tuples[-1]
     mock_connection.commit.assert_called_once()
+
+
+def test_load_readings_uses_configured_mode():
+    """Tests that the insert mode can be selected through the environment."""
+
+    with patch("load.insert_readings", return_value=[(1, "t")]) as mock_executemany, \
+            patch("load.insert_readings_in_bulk", return_value=[(1, "t")]) as mock_bulk:
+        with patch.dict("os.environ", {"READING_INSERT_MODE": "executemany"}):
+            load_readings([(1,)], MagicMock())
+        with patch.dict("os.environ", {"READING_INSERT_MODE": "bulk"}):
+            load_readings([(1,)], MagicMock())
+
+    assert mock_executemany.call_count == 1
+    assert mock_bulk.call_count == 1
+
+
+def test_load_readings_invalid_mode():
+    """Tests that an unknown insert mode is rejected."""
+
+    with patch.dict("os.environ", {"READING_INSERT_MODE": "fast"}):
+        with pytest.raises(ValueError):
+            load_readings([(1,)], MagicMock())
+
+
+def test_bulk_insert_round_trips_against_executemany():
+    """Tests that both insert paths store every reading, the bulk one in far fewer
+        round-trips."""
+
+    reading_tuples = [(1.0, 2.0, datetime(2021, 1, 1, 0, i // 60, i % 60), i % 51,
+                       datetime(2021, 1, 1), 1) for i in range(500)]
+    round_trips = {}
+
+    for insert_mode in INSERT_MODES:
+        connection = BenchmarkConnection(round_trip_seconds=0)
+        inserted_keys = load_readings(reading_tuples, connection, insert_mode)
+        round_trips[insert_mode] = connection.round_trips
+
+        assert inserted_keys == [(reading[3], reading[2]) for reading in reading_tuples]
+
+    # Both paths end with a single commit.
+    assert round_trips == {"bulk": 3, "executemany": 501}
+
+
+def test_load_columnar_batch():
+    """Tests that columnar readings are converted to rows with botanist IDs."""
+
+    readings = pd.DataFrame({
+        "email": pd.Series(["email1@test.com", "email2@test.com"], dtype="category"),
+        "soil_moisture": [1.0, 3.0],
+        "temperature": [2.0, 4.0],
+        "timestamp": pd.to_datetime(["2021-01-01 00:00:00", "2021-01-01 00:01:00"]),
+        "plant_id": [1, 2],
+        "last_watered": pd.to_datetime(["2021-01-01", "2021-01-01"]),
+    })
+
+    with patch("load.get_botanist_ids") as mock_get_botanist_ids, \
+            patch("load.load_readings", return_value=[(1, "t"), (2, "t")]) as mock_load_readings, \
+            patch.dict("load.RECENT_READING_KEYS", clear=True):
+        mock_get_botanist_ids.return_value = {"email1@test.com": 1, "email2@test.com": 2}
+        assert load_columnar_batch(readings, MagicMock()) == 2
+        assert load_columnar_batch(readings, MagicMock()) == 0
+
+    reading_tuples = mock_load_readings.call_args[0][0]
+    assert reading_tuples[1] == (3.0, 4.0, datetime(2021, 1, 1, 0, 1), 2,
+                                 datetime(2021, 1, 1), 2)
+    assert isinstance(reading_tuples[0][2], datetime)
+
+
+def test_load_columnar_batch_only_errors():
+    """Tests that a batch made up of error responses loads nothing."""
+
+    readings = transform_data_columnar([{"error": "plant not found", "plant_id": 7}])
+
+    with patch("load.load_readings") as mock_load_readings:
+        assert load_columnar_batch(readings, MagicMock()) == 0
+
+    mock_load_readings.assert_not_called()
+
+
+def test_load_columnar_batch_unknown_botanist():
+    """Tests that a ValueError is raised for unknown botanist emails."""
+
+    readings = pd.DataFrame({"email": ["unknown@test.com"], "plant_id": [1],
+                             "timestamp": pd.to_datetime(["2021-01-01"])})
+
+    with patch("load.get_botanist_ids", return_value={}):
+        with pytest.raises(ValueError):
+            load_columnar_batch(readings, MagicMock())
+
+
+@patch.dict("load.RECENT_READING_KEYS", clear=True)
+def test_load_batch_skips_duplicates():
+    """Tests that repeated and recently inserted readings are not sent again"""
+    readings = [{"email": "email1@test.com", "soil_moisture": 1.0, "temperature": 2.0,
+                 "timestamp": datetime(2021, 1, 1, 0, minute), "plant_id": 1,
+                 "last_watered": datetime(2021, 1, 1)} for minute in (0, 0, 1)]
+
+    with patch("load.get_botanist_ids", return_value={"email1@test.com": 1}), \
+            patch("load.load_readings",
+                  side_effect=lambda rows, conn, commit: [(row[3], row[2]) for row in rows[1:]]) \
+            as mock_load:
+        inserted = load.load_batch([dict(reading) for reading in readings], MagicMock())
+        assert load.load_batch([dict(reading) for reading in readings], MagicMock()) == []
+
+    assert [reading["timestamp"] for reading in inserted] == [datetime(2021, 1, 1, 0, 1)]
+
+    assert len(mock_load.call_args_list[0][0][0]) == 2
+    assert mock_load.call_args_list[1][0][0] == []
+
+
+@patch.dict("load.CONNECTION_CACHE", clear=True)
+@patch("load.get_connection")
+def test_shared_connection_reused_while_healthy(mock_get_connection):
+    """Tests that a healthy connection is reused and a broken one replaced"""
+    healthy, broken, replacement = MagicMock(), MagicMock(), MagicMock()
+    broken.cursor.return_value.__enter__.return_value.execute.side_effect = \
+        load.Error("connection reset")
+    mock_get_connection.side_effect = [healthy, broken, replacement]
+
+    assert load.get_shared_connection() is healthy
+    assert load.get_shared_connection() is healthy
+
+    load.close_shared_connection()
+    assert load.get_shared_connection() is broken
+    assert load.get_shared_connection() is replacement
+    broken.close.assert_called_once()
+
+
+@patch.dict("load.CONNECTION_CACHE", clear=True)
+@patch("load.get_connection")
+def test_insert_to_database_connection_failure(mock_get_connection):
+    """Tests that a failed connection is reported instead of raising NameError"""
+    mock_get_connection.side_effect = KeyError("DB_HOST")
+
+    with pytest.raises(Exception, match="An error occurred"):
+        load.insert_to_database([])
@@ -0,0 +1,71 @@
+"""Contains the tests for the pipeline metrics"""
+
+from unittest.mock import patch
+from threading import Thread
+import json
+
+import metrics
+from metrics import reset_metrics, increment, observe, timer, downsample, build_emf_record
+from lambda_function import handler
+
+
+def test_emf_record_describes_every_metric():
+    """Tests that timers, counters and histograms are declared with their units"""
+    reset_metrics()
+    with timer("load"):
+        increment("rows_inserted", 5)
+    increment("rows_inserted", 2)
+    observe("fetch_latency", 12.5)
+    observe("fetch_latency", 30.0)
+
+    record = build_emf_record()
+
+    assert record["rows_inserted"] == 7
+    assert record["fetch_latency"] == [12.5, 30.0]
+    assert record["load"] >= 0
+    definitions = record["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    assert {"Name": "rows_inserted", "Unit": "Count"} in definitions
+    assert {"Name": "fetch_latency", "Unit": "Milliseconds"} in definitions
+    assert record["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Service"]]
+
+
+def test_downsample_keeps_extremes():
+    """Tests that long histograms are reduced to evenly spaced quantiles"""
+    values = downsample(list(range(1000)), max_values=11)
+
+    assert values == [0, 100, 200, 300, 400, 500, 599, 699, 799, 899, 999]
+
+
+@patch("lambda_function.run_pipeline")
+def test_handler_emits_one_metrics_line(mock_run_pipeline, capsys):
+    """Tests that each invocation starts from fresh metrics and prints them as JSON"""
+
+    async def fake_run_pipeline():
+        increment("rows_inserted", 51)
+
+    mock_run_pipeline.side_effect = fake_run_pipeline
+    increment("rows_inserted", 1000)
+
+    handler(None, None)
+
+    record = json.loads(capsys.readouterr().out.strip())
+    assert record["rows_inserted"] == 51
+    assert record["invocation"] > 0
+    assert metrics.METRICS["counters"]["rows_inserted"] == 51
+
+
+def test_increment_from_threads():
+    """Tests that counts recorded from several worker threads are not lost"""
+    reset_metrics()
+
+    def record():
+        for _ in range(10000):
+            increment("rows_inserted")
+
+    workers = [Thread(target=record) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert metrics.METRICS["counters"]["rows_inserted"] == 80000
@@ -0,0 +1,74 @@
+"""Contains the tests for replaying captured plant responses"""
+
+from unittest.mock import patch
+import gzip
+import json
+
+from replay import read_capture_batches, replay_file, replay_captures, load_checkpoint
+
+PLANT_RESPONSE = {
+    "botanist": {"email": "carl.linnaeus@lnhm.co.uk"},
+    "last_watered": "Mon, 10 Jun 2024 14:03:04 GMT",
+    "plant_id": 0,
+    "recording_taken": "2024-06-10 16:01:56",
+    "soil_moisture": 93.0958352536302,
+    "temperature": 13.137477117877957
+}
+
+
+def write_capture(path, responses: list, compress: bool = False) -> str:
+    """Writes responses to a JSONL capture file, returning its path"""
+    lines = "".join(json.dumps(response) + "\n" for response in responses)
+    if compress:
+        path = path.with_suffix(".jsonl.gz")
+        with gzip.open(path, "wt", encoding="utf-8") as capture:
+            capture.write(lines)
+    else:
+        path.write_text(lines, encoding="utf-8")
+    return str(path)
+
+
+def test_read_capture_batches_gzip(tmp_path):
+    """Tests that gzipped captures are read in batches and bad lines skipped"""
+    capture_path = write_capture(tmp_path / "capture.jsonl",
+                                 [PLANT_RESPONSE] * 5, compress=True)
+    with gzip.open(capture_path, "at", encoding="utf-8") as capture:
+        capture.write("not json\n")
+
+    batches = list(read_capture_batches(capture_path, batch_size=2))
+
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0] == PLANT_RESPONSE
+
+
+@patch("replay.load_columnar_batch")
+@patch("replay.get_connection")
+def test_replay_file_loads_transformed_batches(mock_get_connection, mock_load, tmp_path):
+    """Tests that error responses are dropped and each batch is loaded"""
+    capture_path = write_capture(
+        tmp_path / "capture.jsonl",
+        [PLANT_RESPONSE, {"error": "plant not found", "plant_id": 7}, PLANT_RESPONSE])
+    mock_load.side_effect = lambda readings, connection: len(readings)
+
+    summary = replay_file(capture_path, batch_size=2)
+
+    assert summary == {"path": capture_path, "responses": 3, "inserted": 2}
+    assert mock_load.call_count == 2
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+@patch("replay.replay_file")
+def test_replay_captures_resumes_from_checkpoint(mock_replay_file, tmp_path):
+    """Tests that completed files are recorded and skipped on the next run"""
+    mock_replay_file.side_effect = lambda path, batch_size: {
+        "path": path, "responses": 1, "inserted": 1}
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    assert replay_captures(["a.jsonl", "b.jsonl"], checkpoint_path, max_workers=1) == 2
+    assert replay_captures(["a.jsonl", "b.jsonl", "c.jsonl"], checkpoint_path,
+                           max_workers=1) == 1
+
+    assert [call.args[0] for call in mock_replay_file.call_args_list] == [
+        "a.jsonl", "b.jsonl", "c.jsonl"]
+    assert sorted(load_checkpoint(checkpoint_path)["completed"]) == [
+        "a.jsonl", "b.jsonl", "c.jsonl"]
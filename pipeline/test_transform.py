@@ -1,8 +1,12 @@
 """Testing Transform file"""
 
 import datetime
+import asyncio
 
-from transform import transform_data
+import pytest
+
+from transform import transform_data, transform_data_columnar, stream_transformed_data, \
+    parse_last_watered, DATE_FORMAT
 
 
 class TestTransformData:
@@ -73,3 +77,75 @@ class TestTransformData:
         }]
         extracted_data = transform_data(sample_error_data)
         assert not extracted_data
+
+    def test_stream_transformed_data_skips_errors(self) -> None:
+        '''Tests that streamed responses are transformed as they arrive'''
+
+        async def plant_stream():
+            yield {'error': 'plant sensor fault', 'plant_id': 8}
+            yield TestTransformData.sample_data[0]
+
+        async def collect() -> list[dict]:
+            return [reading async for reading in stream_transformed_data(plant_stream())]
+
+        readings = asyncio.run(collect())
+
+        assert len(readings) == 1
+        assert readings[0]['plant_id'] == 0
+
+
+class TestTransformDataColumnar:
+    """Tests the columnar transform function"""
+
+    def test_columnar_matches_row_transform(self) -> None:
+        """Tests that the columnar transform produces the same readings"""
+        plant_data = TestTransformData.sample_data + [{'error': 'plant sensor fault',
+                                                       'plant_id': 8}]
+
+        columns = transform_data_columnar(plant_data)
+
+        assert columns.to_dict("records") == transform_data(plant_data)
+
+    def test_columnar_types(self) -> None:
+        """Tests that the columns are typed for the loader"""
+        columns = transform_data_columnar(TestTransformData.sample_data * 3)
+
+        assert len(columns) == 3
+        assert str(columns["soil_moisture"].dtype) == "float64"
+        assert str(columns["plant_id"].dtype) == "int64"
+        assert columns["timestamp"].dt.year.tolist() == [2024] * 3
+        assert columns["last_watered"].dt.hour.tolist() == [14] * 3
+
+    def test_columnar_all_errors(self) -> None:
+        """Tests that a batch of errors gives an empty frame"""
+        assert transform_data_columnar([{'error': 'plant not found', 'plant_id': 7}]).empty
+
+
+class TestParseLastWatered:
+    """Tests the fast last watered parser"""
+
+    def test_matches_strptime(self) -> None:
+        """Tests that the parser agrees with strptime across months and days"""
+        for month in range(1, 13):
+            expected = datetime.datetime(2024, month, 9, 23, 5, 59)
+            last_watered = expected.strftime(DATE_FORMAT)
+            assert parse_last_watered(last_watered) == expected
+
+    def test_malformed_input_falls_back_to_strptime(self) -> None:
+        """Tests that unexpected layouts are still parsed or rejected by strptime"""
+        assert parse_last_watered("Mon, 3 Jun 2024 14:03:04 GMT") == datetime.datetime(
+            2024, 6, 3, 14, 3, 4)
+        with pytest.raises(ValueError):
+            parse_last_watered("Mon, 10 Foo 2024 14:03:04 GMT")
+
+    def test_matches_strptime_over_many_values(self) -> None:
+        """Tests that the uncached and memoised parsers agree with strptime"""
+        values = [datetime.datetime(2024, 6, 1 + i % 28, i % 24, i % 60, i % 60).strftime(
+            DATE_FORMAT) for i in range(2_000)]
+        expected = [datetime.datetime.strptime(value, DATE_FORMAT) for value in values]
+
+        assert [parse_last_watered.__wrapped__(value) for value in values] == expected
+
+        parse_last_watered.cache_clear()
+        assert [parse_last_watered(value) for value in values[:50] * 4] == expected[:50] * 4
+        assert parse_last_watered.cache_info().hits == 150
@@ -1,37 +1,108 @@
 """This file receives the plant data from the extract file and transforms it for the load file"""
 
 from datetime import datetime
+from functools import lru_cache
+from typing import AsyncIterator
 import logging
 import asyncio
 
-from extract import get_all_plant_data
+import pandas as pd
+
+from extract import get_all_plant_data, PER_PLANT_LOG
 
 
 DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+RECORDING_FORMAT = "%Y-%m-%d %H:%M:%S"
+MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+          "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+LAST_WATERED_CACHE_SIZE = 1024
+COLUMNAR_READING_COLUMNS = ["email", "soil_moisture", "temperature",
+                            "timestamp", "plant_id", "last_watered"]
+
+
+@lru_cache(maxsize=LAST_WATERED_CACHE_SIZE)
+def parse_last_watered(last_watered: str) -> datetime:
+    """Parses an RFC 1123 date such as 'Mon, 10 Jun 2024 14:03:04 GMT' by slicing its
+    fixed-width fields, falling back to strptime for anything malformed. Results are
+    memoised because a plant's last watered time rarely changes between runs."""
+    if (len(last_watered) == 29 and last_watered[3:5] == ", "
+            and last_watered[19] == last_watered[22] == ":"
+            and last_watered.endswith(" GMT")):
+        try:
+            return datetime(int(last_watered[12:16]), MONTHS[last_watered[8:11]],
+                            int(last_watered[5:7]), int(last_watered[17:19]),
+                            int(last_watered[20:22]), int(last_watered[23:25]))
+        except (KeyError, ValueError):
+            pass
+
+    return datetime.strptime(last_watered, DATE_FORMAT)
+
+
+def transform_plant(plant: dict) -> dict | None:
+    """Selects useful data from a single plant response and transforms it to the
+    correct data type, returning None for error responses"""
+    if plant.get("error"):
+        logging.error("Plant id %s returned an error: %s",
+                      plant.get("plant_id"), plant["error"])
+        return None
+
+    reading_data = {
+        "email": plant["botanist"]["email"],
+        "soil_moisture": float(plant["soil_moisture"]),
+        "temperature": float(plant["temperature"]),
+        "timestamp": datetime.fromisoformat(plant["recording_taken"]),
+        "plant_id": int(plant["plant_id"]),
+        "last_watered": parse_last_watered(plant["last_watered"])
+    }
+
+    logging.info("Transformed reading of plant %s taken at %s.", reading_data["plant_id"],
+                 plant["recording_taken"], extra=PER_PLANT_LOG)
+    return reading_data
 
 
 def transform_data(plant_data: list[dict]) -> list[dict]:
     """Selects useful data and transform to correct data type"""
     data = []
     for plant in plant_data:
-        if plant.get("error"):
-            logging.error(plant)
-        else:
-            reading_data = {
-                "email": plant["botanist"]["email"],
-                "soil_moisture": float(plant["soil_moisture"]),
-                "temperature": float(plant["temperature"]),
-                "timestamp": datetime.fromisoformat(plant["recording_taken"]),
-                "plant_id": int(plant["plant_id"]),
-                "last_watered": datetime.strptime(plant["last_watered"], DATE_FORMAT)
-            }
-
-            logging.info(reading_data)
+        reading_data = transform_plant(plant)
+        if reading_data:
             data.append(reading_data)
 
     return data
 
 
+def transform_data_columnar(plant_data: list[dict]) -> pd.DataFrame:
+    """Transforms a batch of plant responses into typed columns, parsing the
+    timestamps of the whole batch at once rather than reading by reading"""
+    plants = [plant for plant in plant_data if not plant.get("error")]
+    if len(plants) < len(plant_data):
+        logging.error("%s plant responses had errors.", len(plant_data) - len(plants))
+
+    if not plants:
+        return pd.DataFrame(columns=COLUMNAR_READING_COLUMNS)
+
+    return pd.DataFrame({
+        "email": pd.Series([plant["botanist"]["email"] for plant in plants],
+                           dtype="category"),
+        "soil_moisture": pd.Series(
+            [plant["soil_moisture"] for plant in plants]).astype("float64"),
+        "temperature": pd.Series(
+            [plant["temperature"] for plant in plants]).astype("float64"),
+        "timestamp": pd.to_datetime(
+            [plant["recording_taken"] for plant in plants], format=RECORDING_FORMAT),
+        "plant_id": pd.Series([plant["plant_id"] for plant in plants]).astype("int64"),
+        "last_watered": pd.to_datetime(
+            [plant["last_watered"] for plant in plants], format=DATE_FORMAT)
+    })
+
+
+async def stream_transformed_data(plant_stream: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    """Transforms plant responses as they arrive from the extract stream"""
+    async for plant in plant_stream:
+        reading_data = transform_plant(plant)
+        if reading_data:
+            yield reading_data
+
 if __name__ == "__main__":
     plants = transform_data(
         asyncio.run(get_all_plant_data())
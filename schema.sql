@@ -1,4 +1,6 @@
 -- remove any existing tables
+DROP TABLE IF EXISTS delta.reading_alert;
+DROP TABLE IF EXISTS delta.plant_statistics;
 DROP TABLE IF EXISTS delta.reading;
 DROP TABLE IF EXISTS delta.plant;
 DROP TABLE IF EXISTS delta.location;
@@ -69,6 +71,35 @@ CREATE TABLE delta.reading(
     FOREIGN KEY (botanist_id) REFERENCES delta.botanist(botanist_id)
 );
 
+-- index the latest readings of each plant, allowing one reading per plant and timestamp
+CREATE UNIQUE INDEX ix_reading_plant_id_timestamp
+ON delta.reading(plant_id, timestamp DESC)
+INCLUDE (temperature, soil_moisture, last_watered);
+
+-- create plant statistics table
+CREATE TABLE delta.plant_statistics(
+    plant_id SMALLINT NOT NULL PRIMARY KEY,
+    reading_count INT NOT NULL,
+    temperature_mean FLOAT NOT NULL,
+    temperature_variance FLOAT NOT NULL,
+    soil_moisture_mean FLOAT NOT NULL,
+    soil_moisture_variance FLOAT NOT NULL,
+    updated_at DATETIME2(0) NOT NULL,
+    FOREIGN KEY (plant_id) REFERENCES delta.plant(plant_id)
+);
+
+-- create reading alert table
+CREATE TABLE delta.reading_alert(
+    alert_id BIGINT IDENTITY(1,1) PRIMARY KEY,
+    plant_id SMALLINT NOT NULL,
+    timestamp DATETIME2(0) NOT NULL,
+    measurement VARCHAR(20) NOT NULL,
+    value FLOAT NOT NULL,
+    expected_mean FLOAT NOT NULL,
+    expected_stddev FLOAT NOT NULL,
+    FOREIGN KEY (plant_id) REFERENCES delta.plant(plant_id)
+);
+
 -- seed data into country table
 INSERT INTO delta.country(country_code)
 VALUES